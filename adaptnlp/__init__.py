@@ -1,39 +1,63 @@
 __version__ = "0.3.6"
 
+from importlib import import_module
 from pathlib import Path
 
 # global variable like Flair's cache_root
 cache_root = Path.home()/".adaptnlp"
 
-# Inference modules
-from .inference.embeddings import (
-    EasyWordEmbeddings,
-    EasyStackedEmbeddings,
-    EasyDocumentEmbeddings
-)
+# Everything else is imported from its submodule on first access, so `import adaptnlp` stays cheap
+# and only the dependencies (flair, fastai, datasets, ...) of the modules actually used get loaded
+_LAZY_IMPORTS = {
+    # Inference modules
+    "EasyWordEmbeddings": ".inference.embeddings",
+    "EasyStackedEmbeddings": ".inference.embeddings",
+    "EasyDocumentEmbeddings": ".inference.embeddings",
+    "EasySequenceClassifier": ".inference.sequence_classification",
+    "TransformersSequenceClassifier": ".inference.sequence_classification",
+    "FlairSequenceClassifier": ".inference.sequence_classification",
+    "EasyTokenTagger": ".inference.token_classification",
+    "EasyQuestionAnswering": ".inference.question_answering",
+    "TransformersQuestionAnswering": ".inference.question_answering",
+    "EasySummarizer": ".inference.summarization",
+    "TransformersSummarizer": ".inference.summarization",
+    "EasyTranslator": ".inference.translation",
+    "TransformersTranslator": ".inference.translation",
+    "EasyTextGenerator": ".inference.text_generation",
+    "TransformersTextGenerator": ".inference.text_generation",
+    "DetailLevel": ".result",
+    "InferenceEngine": ".model",
+    "ModelCache": ".model_cache",
+    "shared_model_cache": ".model_cache",
+    # Huggingface Hub bits
+    "HFModelHub": ".model_hub",
+    "FlairModelHub": ".model_hub",
+    "HF_TASKS": ".model_hub",
+    "FLAIR_TASKS": ".model_hub",
+    # Training API
+    "Strategy": ".training.core",
+    "TaskDatasets": ".training.core",
+    "AdaptiveTuner": ".training.core",
+    "AdaptiveDataLoaders": ".training.core",
+    "SequenceClassificationTuner": ".training.sequence_classification",
+    "SequenceClassificationDatasets": ".training.sequence_classification",
+    "LanguageModelTuner": ".training.language_model",
+    "LanguageModelDatasets": ".training.language_model",
+    "NERMetric": ".training.token_classification",
+    "TokenClassificationDatasets": ".training.token_classification",
+    "TokenClassificationTuner": ".training.token_classification",
+}
 
-from .inference.sequence_classification import (
-    EasySequenceClassifier,
-    TransformersSequenceClassifier,
-    FlairSequenceClassifier
-)
+def __getattr__(name):
+    if name not in _LAZY_IMPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(_LAZY_IMPORTS[name], __name__), name)
+    # Later accesses find it directly, without going through `__getattr__`
+    globals()[name] = value
+    return value
 
-from .inference.token_classification import EasyTokenTagger
-from .inference.question_answering import EasyQuestionAnswering, TransformersQuestionAnswering
-from .inference.summarization import EasySummarizer, TransformersSummarizer
-from .inference.translation import EasyTranslator, TransformersTranslator
-from .inference.text_generation import EasyTextGenerator, TransformersTextGenerator
-
-from .result import DetailLevel
-
-# Huggingface Hub bits
-from .model_hub import HFModelHub, FlairModelHub, HF_TASKS, FLAIR_TASKS
-
-# Training API
-from .training.core import Strategy, TaskDatasets, AdaptiveTuner, AdaptiveDataLoaders
-from .training.sequence_classification import SequenceClassificationTuner, SequenceClassificationDatasets
-from .training.language_model import LanguageModelTuner, LanguageModelDatasets
-from .training.token_classification import NERMetric, TokenClassificationDatasets, TokenClassificationTuner
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_IMPORTS))
 
 
 __all__ = [
@@ -54,6 +78,9 @@ __all__ = [
     "EasyTextGenerator",
     "TransformersTextGenerator",
     "DetailLevel",
+    "InferenceEngine",
+    "ModelCache",
+    "shared_model_cache",
     "HFModelHub",
     "FlairModelHub",
     "HF_TASKS",
@@ -69,4 +96,4 @@ __all__ = [
     "NERMetric",
     "TokenClassificationDatasets",
     "TokenClassificationTuner"
-]
\ No newline at end of file
+]
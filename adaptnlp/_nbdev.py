@@ -6,16 +6,29 @@ index = {"SentenceResult": "00_result.ipynb",
          "GatherInputsCallback": "01_callback.ipynb",
          "SetInputsCallback": "01_callback.ipynb",
          "GeneratorCallback": "01_callback.ipynb",
+         "logger": "21_model_cache.ipynb",
          "HFModelResult": "02_model_hub.ipynb",
+         "HubIndex": "02_model_hub.ipynb",
+         "hub_index": "02_model_hub.ipynb",
          "HFModelHub": "02_model_hub.ipynb",
          "FLAIR_MODELS": "02_model_hub.ipynb",
          "FlairModelResult": "02_model_hub.ipynb",
          "FlairModelHub": "02_model_hub.ipynb",
          "DataLoader.one_batch": "03_model.ipynb",
          "GatherPredsCallback.after_validate": "03_model.ipynb",
+         "token_budget_batches": "03_model.ipynb",
+         "PadCollate": "03_model.ipynb",
+         "QUANTIZED_WEIGHTS_NAME": "03_model.ipynb",
+         "quantize_dynamic_int8": "03_model.ipynb",
+         "is_quantized": "03_model.ipynb",
+         "quantization_report": "03_model.ipynb",
+         "load_quantized": "03_model.ipynb",
+         "load_pretrained_model": "03_model.ipynb",
+         "run_sharded": "03_model.ipynb",
+         "close_shard_pools": "03_model.ipynb",
+         "run_pipelined": "03_model.ipynb",
          "CudaCallback": "03_model.ipynb",
          "AdaptiveModel": "03_model.ipynb",
-         "logger": "11_inference.utils.ipynb",
          "EmbeddingResult": "04_embeddings.ipynb",
          "EasyWordEmbeddings": "04_embeddings.ipynb",
          "EasyStackedEmbeddings": "04_embeddings.ipynb",
@@ -37,6 +50,10 @@ index = {"SentenceResult": "00_result.ipynb",
          "EasyTextGenerator": "09_text_generation.ipynb",
          "QACallback": "10_question_answering.ipynb",
          "QAResult": "10_question_answering.ipynb",
+         "QAExample": "10_question_answering.ipynb",
+         "QAFeature": "10_question_answering.ipynb",
+         "ContextCache": "10_question_answering.ipynb",
+         "featurize_qa_examples": "10_question_answering.ipynb",
          "TransformersQuestionAnswering": "10_question_answering.ipynb",
          "EasyQuestionAnswering": "10_question_answering.ipynb",
          "normalize_answer": "11_inference.utils.ipynb",
@@ -72,7 +89,39 @@ index = {"SentenceResult": "00_result.ipynb",
          "encode_tags": "17_training.token_classification.ipynb",
          "TokenClassificationDatasets": "17_training.token_classification.ipynb",
          "SeqEvalMetrics": "17_training.token_classification.ipynb",
-         "TokenClassificationTuner": "17_training.token_classification.ipynb"}
+         "TokenClassificationTuner": "17_training.token_classification.ipynb",
+         "export_onnx": "18_backends.ipynb",
+         "OnnxBackend": "18_backends.ipynb",
+         "use_onnx": "18_backends.ipynb",
+         "TorchScriptBackend": "18_backends.ipynb",
+         "use_torchscript": "18_backends.ipynb",
+         "TIME_BUCKETS": "19_instrumentation.ipynb",
+         "COUNT_BUCKETS": "19_instrumentation.ipynb",
+         "Histogram": "19_instrumentation.ipynb",
+         "MetricsRegistry": "19_instrumentation.ipynb",
+         "registry": "19_instrumentation.ipynb",
+         "CallStats": "19_instrumentation.ipynb",
+         "instrumented_call": "19_instrumentation.ipynb",
+         "instrumented": "19_instrumentation.ipynb",
+         "timed_stage": "19_instrumentation.ipynb",
+         "record_count": "19_instrumentation.ipynb",
+         "record_batches": "19_instrumentation.ipynb",
+         "BENCH_WORDS": "20_bench.ipynb",
+         "TINY_MODELS": "20_bench.ipynb",
+         "build_tiny_model": "20_bench.ipynb",
+         "LENGTH_PROFILES": "20_bench.ipynb",
+         "random_texts": "20_bench.ipynb",
+         "BENCH_TASKS": "20_bench.ipynb",
+         "bench_task": "20_bench.ipynb",
+         "run_benchmark": "20_bench.ipynb",
+         "IMPORT_TARGETS": "20_bench.ipynb",
+         "bench_import": "20_bench.ipynb",
+         "compare_results": "20_bench.ipynb",
+         "adaptnlp_bench": "20_bench.ipynb",
+         "model_nbytes": "21_model_cache.ipynb",
+         "ModelCache": "21_model_cache.ipynb",
+         "shared_model_cache": "21_model_cache.ipynb",
+         "CachedModels": "21_model_cache.ipynb"}
 
 modules = ["result.py",
            "callback.py",
@@ -90,7 +139,11 @@ modules = ["result.py",
            "training/sequence_classification.py",
            "training/language_model.py",
            "training/arrow_utils.py",
-           "training/token_classification.py"]
+           "training/token_classification.py",
+           "backends.py",
+           "instrumentation.py",
+           "bench.py",
+           "model_cache.py"]
 
 doc_url = "https://novetta.github.io/adaptnlp/"
 
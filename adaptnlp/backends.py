@@ -0,0 +1,218 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/18_backends.ipynb (unless otherwise specified).
+
+__all__ = ['export_onnx', 'OnnxBackend', 'use_onnx', 'TorchScriptBackend', 'use_torchscript']
+
+# Cell
+import inspect, hashlib, os
+from typing import Union, List
+from pathlib import Path
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from fastcore.basics import store_attr, ifnone
+
+from adaptnlp import cache_root
+from .model import AdaptiveModel, is_quantized
+from .inference.sequence_classification import TransformersSequenceClassifier
+from .inference.token_classification import TransformersTokenTagger
+from .inference.question_answering import TransformersQuestionAnswering
+
+# Internal Cell
+_MODEL_INPUTS = ['input_ids', 'attention_mask', 'token_type_ids']
+_ENCODER_MODELS = (TransformersSequenceClassifier, TransformersTokenTagger, TransformersQuestionAnswering)
+
+def _check_encoder_model(model, backend):
+    "Raises if `model` isn't one of the models whose forward pass can run through `backend`"
+    if not isinstance(model, _ENCODER_MODELS):
+        raise ValueError(f"`{type(model).__name__}` can't run on {backend}, only the sequence classifier, token tagger, and question answering models can")
+    if isinstance(model, TransformersQuestionAnswering) and isinstance(model.model, model.xmodel_instances):
+        raise ValueError(f"`{type(model.model).__name__}` needs extra inputs for question answering and can't run on {backend}")
+
+def _input_names(model):
+    "The inputs of `_MODEL_INPUTS` the forward pass of `model` accepts, in order"
+    return [name for name in _MODEL_INPUTS if name in inspect.signature(model.forward).parameters]
+
+def _import_onnxruntime():
+    "Imports `onnxruntime`, which is only needed for the ONNX backend"
+    try: import onnxruntime
+    except ImportError: raise ImportError("The ONNX backend requires onnxruntime, install it with `pip install onnxruntime`")
+    return onnxruntime
+
+# Internal Cell
+class _TupleOutputWrapper(nn.Module):
+    "Passes positional inputs to `model` as keyword arguments and returns its outputs as a tuple, as `torch.onnx.export` and `torch.jit.trace` expect"
+    def __init__(self, model, input_names, output_names):
+        super().__init__()
+        store_attr()
+
+    def forward(self, *inputs):
+        outputs = self.model(**dict(zip(self.input_names, inputs)), return_dict=True)
+        return tuple(outputs[name] for name in self.output_names)
+
+# Cell
+def export_onnx(
+    model:AdaptiveModel, # A `TransformersSequenceClassifier`, `TransformersTokenTagger`, or `TransformersQuestionAnswering`
+    path:Union[str, Path], # A file to save the ONNX graph to, such as 'model.onnx'
+    opset_version:int=12 # The ONNX opset version to export with
+) -> Path: # The path of the saved graph
+    "Exports the PyTorch model of `model` to an ONNX graph with dynamic batch and sequence axes"
+    _check_encoder_model(model, 'ONNX')
+    if is_quantized(model.model): raise ValueError("Dynamically quantized models can't be exported to ONNX, export the original model instead")
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    device = next(model.model.parameters()).device
+    torch_model = model.model.cpu().eval()
+    input_names = _input_names(torch_model)
+    sample = model.tokenizer(['An example', 'Another, longer example'], padding=True, return_tensors='pt')
+    inputs = tuple(sample[name] if name in sample else torch.zeros_like(sample['input_ids']) for name in input_names)
+    with torch.no_grad():
+        output_names = list(torch_model(**dict(zip(input_names, inputs)), return_dict=True).keys())
+    # Sequence classifiers return one row of logits per text, the others one per token
+    output_axes = {0:'batch'} if isinstance(model, TransformersSequenceClassifier) else {0:'batch', 1:'sequence'}
+    dynamic_axes = {**{name:{0:'batch', 1:'sequence'} for name in input_names}, **{name:output_axes for name in output_names}}
+    torch.onnx.export(
+        _TupleOutputWrapper(torch_model, input_names, output_names),
+        inputs,
+        str(path),
+        input_names=input_names,
+        output_names=output_names,
+        dynamic_axes=dynamic_axes,
+        opset_version=opset_version,
+    )
+    model.model.to(device)
+    return path
+
+# Cell
+class OnnxBackend:
+    "Runs the forward pass of an `AdaptiveModel` through an ONNX graph with onnxruntime's CPU provider"
+    def __init__(
+        self,
+        path:Union[str, Path], # An ONNX graph saved with `export_onnx`
+        num_threads:int=None # The number of threads onnxruntime runs each batch with, defaults to all cores
+    ):
+        ort = _import_onnxruntime()
+        options = ort.SessionOptions()
+        if num_threads is not None: options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(str(path), options, providers=['CPUExecutionProvider'])
+        self.input_names = [o.name for o in self.session.get_inputs()]
+        self.output_names = [o.name for o in self.session.get_outputs()]
+
+    def __call__(
+        self,
+        *xb # The `input_ids`, `attention_mask`, and optionally `token_type_ids` of a batch
+    ) -> dict: # The outputs of the graph, such as `logits`
+        inputs = dict(zip(_MODEL_INPUTS, xb))
+        # Models called without `token_type_ids` treat every token as part of the first segment
+        feed = {name:(inputs[name] if name in inputs else torch.zeros_like(inputs['input_ids'])).cpu().numpy() for name in self.input_names}
+        outputs = self.session.run(self.output_names, feed)
+        return {name:torch.from_numpy(o) for name, o in zip(self.output_names, outputs)}
+
+# Cell
+def use_onnx(
+    model:AdaptiveModel, # A `TransformersSequenceClassifier`, `TransformersTokenTagger`, or `TransformersQuestionAnswering`
+    path:Union[str, Path], # Where the ONNX graph of `model` is, or should be exported to
+    num_threads:int=None # The number of threads onnxruntime runs each batch with, defaults to all cores
+) -> AdaptiveModel: # `model`, now predicting through onnxruntime
+    "Sets an `OnnxBackend` on `model`, exporting it to `path` first if there is no graph there yet"
+    path = Path(path)
+    if not path.exists(): export_onnx(model, path)
+    model.set_backend(OnnxBackend(path, num_threads))
+    return model
+
+# Internal Cell
+def _fingerprint(model):
+    "A short hash of the architecture, config, and weights of `model`, so traces of a changed model are never reused"
+    h = hashlib.sha1(f'{type(model).__name__}{model.config.to_json_string()}{torch.__version__}'.encode())
+    with torch.no_grad():
+        for name, value in model.state_dict().items():
+            # The weights of dynamically quantized layers are stored as a tuple of quantized tensors
+            for t in (value if isinstance(value, tuple) else (value,)):
+                if not isinstance(t, torch.Tensor): continue
+                t = t.dequantize() if t.is_quantized else t
+                h.update(f'{name}{tuple(t.shape)}{t.dtype}'.encode())
+                # numpy has no bfloat16, which float32 holds exactly
+                h.update((t.float() if t.dtype == torch.bfloat16 else t).cpu().numpy().tobytes())
+    return h.hexdigest()[:16]
+
+def _trace_dir(model):
+    "Where to cache traces of `model` by default, under `cache_root` so the directory it was loaded from is never written to"
+    name = getattr(model.config, '_name_or_path', '')
+    return cache_root/'torchscript'/name.strip('/').replace('/', '--')
+
+def _trace_inputs(input_names, seq_len, device):
+    "A batch of two sequences of `seq_len` to run the model on, with a single token type as models like RoBERTa only have one"
+    ids = torch.ones(2, seq_len, dtype=torch.long, device=device)
+    return tuple(torch.zeros_like(ids) if name == 'token_type_ids' else ids for name in input_names)
+
+# Cell
+class TorchScriptBackend:
+    "Runs the forward pass of an `AdaptiveModel` through TorchScript graphs traced for a set of sequence length buckets"
+    def __init__(
+        self,
+        model:AdaptiveModel, # A `TransformersSequenceClassifier`, `TransformersTokenTagger`, or `TransformersQuestionAnswering`
+        buckets:List[int]=[32, 64, 128, 256, 512], # The sequence lengths to trace the model for
+        cache_dir:Union[str, Path]=None # Where to cache the traces, such as next to the model. Defaults to `~/.adaptnlp/torchscript`
+    ):
+        _check_encoder_model(model, 'TorchScript')
+        self.model = model.model.eval()
+        self.buckets = sorted(buckets)
+        self.input_names = _input_names(self.model)
+        # Sequence classifiers return one row of logits per text, the others one per token
+        self.per_token = not isinstance(model, TransformersSequenceClassifier)
+        self.pad_left = model.tokenizer.padding_side == 'left'
+        self.pad_token_id = ifnone(model.tokenizer.pad_token_id, 0)
+        device = next(self.model.parameters()).device
+        sample = _trace_inputs(self.input_names, self.buckets[0], device)
+        with torch.no_grad():
+            self.output_names = list(self.model(**dict(zip(self.input_names, sample)), return_dict=True).keys())
+        buckets_name = '-'.join(map(str, self.buckets))
+        self.path = Path(ifnone(cache_dir, _trace_dir(self.model)))/f'{_fingerprint(self.model)}-{buckets_name}.pt'
+        if self.path.exists(): self.traced = torch.jit.load(str(self.path), map_location=device)
+        else: self.traced = self._trace(device)
+
+    def _trace(self, device):
+        "Traces every bucket as a method of one module, so they all share the same weights, and caches it at `self.path`"
+        wrapper = _TupleOutputWrapper(self.model, self.input_names, self.output_names)
+        inputs = {}
+        for bucket in self.buckets:
+            setattr(wrapper, f'bucket_{bucket}', wrapper.forward)
+            inputs[f'bucket_{bucket}'] = _trace_inputs(self.input_names, bucket, device)
+        with torch.no_grad(): traced = torch.jit.trace_module(wrapper, inputs, check_trace=False)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first, so other processes never load a partial trace
+        tmp = self.path.with_suffix(f'.{os.getpid()}.tmp')
+        torch.jit.save(traced, str(tmp))
+        os.replace(tmp, self.path)
+        return traced
+
+    def __call__(
+        self,
+        *xb # The `input_ids`, `attention_mask`, and optionally `token_type_ids` of a batch
+    ) -> dict: # The outputs of the model, such as `logits`
+        inputs = dict(zip(_MODEL_INPUTS, xb))
+        seq_len = inputs['input_ids'].shape[1]
+        inputs = [inputs[name] if name in inputs else torch.zeros_like(inputs['input_ids']) for name in self.input_names]
+        bucket = next((b for b in self.buckets if b >= seq_len), None)
+        # Longer sequences than the largest bucket go through the eager model
+        if bucket is None:
+            outputs = self.model(**dict(zip(self.input_names, inputs)), return_dict=True)
+            return {name:outputs[name] for name in self.output_names}
+        # Padded tokens are masked out, so they don't change the outputs of the others. They get the pad token of the tokenizer,
+        # which models like RoBERTa also leave out of the position ids
+        pad = (bucket - seq_len, 0) if self.pad_left else (0, bucket - seq_len)
+        inputs = [F.pad(o, pad, value=self.pad_token_id if name == 'input_ids' else 0) for name, o in zip(self.input_names, inputs)]
+        outputs = getattr(self.traced, f'bucket_{bucket}')(*inputs)
+        if self.per_token: outputs = [o[:, -seq_len:] if self.pad_left else o[:, :seq_len] for o in outputs]
+        return dict(zip(self.output_names, outputs))
+
+# Cell
+def use_torchscript(
+    model:AdaptiveModel, # A `TransformersSequenceClassifier`, `TransformersTokenTagger`, or `TransformersQuestionAnswering`
+    buckets:List[int]=[32, 64, 128, 256, 512], # The sequence lengths to trace the model for
+    cache_dir:Union[str, Path]=None # Where to cache the traces, such as next to the model. Defaults to `~/.adaptnlp/torchscript`
+) -> AdaptiveModel: # `model`, now predicting through TorchScript
+    "Sets a `TorchScriptBackend` on `model`, loading its traces from `cache_dir` if they were cached before"
+    model.set_backend(TorchScriptBackend(model, buckets, cache_dir))
+    return model
\ No newline at end of file
@@ -0,0 +1,345 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/20_bench.ipynb (unless otherwise specified).
+
+__all__ = ['logger', 'BENCH_WORDS', 'TINY_MODELS', 'build_tiny_model', 'LENGTH_PROFILES', 'random_texts', 'BENCH_TASKS',
+           'bench_task', 'run_benchmark', 'IMPORT_TARGETS', 'bench_import', 'compare_results', 'adaptnlp_bench']
+
+# Cell
+import json, logging, os, platform, random, subprocess, sys, tempfile, time
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import List, Union
+
+import numpy as np
+import torch
+import transformers
+
+from transformers import (
+    BertConfig,
+    BertModel,
+    BertForSequenceClassification,
+    BertForQuestionAnswering,
+    BertTokenizerFast,
+    DistilBertConfig,
+    DistilBertForTokenClassification,
+    T5Config,
+    T5ForConditionalGeneration,
+    GPT2Config,
+    GPT2LMHeadModel,
+)
+from huggingface_hub.hf_api import ModelInfo
+
+from fastcore.basics import ifnone
+from fastcore.script import call_parse, Param
+
+import adaptnlp
+from adaptnlp import __version__
+from .model_hub import HFModelResult
+from .inference.embeddings import EasyWordEmbeddings
+from .inference.sequence_classification import EasySequenceClassifier
+from .inference.token_classification import EasyTokenTagger
+from .inference.question_answering import EasyQuestionAnswering
+from .inference.summarization import EasySummarizer
+from .inference.translation import EasyTranslator
+from .inference.text_generation import EasyTextGenerator
+
+# Cell
+logger = logging.getLogger(__name__)
+
+# Cell
+BENCH_WORDS = """the a is of and to in it this that was for on are with as his they be at one have from or had by
+word but what some we can out other were all there when up use your how said an each she which do their time if will
+way about many then them write would like so these her long make thing see him two has look more day could go come did
+number sound no most people my over know water than call first who may down side been now find any new work part take
+get place made live where after back little only round man year came show every good me give our under name very through
+just form sentence great think say help low line differ turn cause much mean before move right boy old too same tell does
+set three want air well also play small end put home read hand port large spell add even land here must big high such
+follow act why ask men change went light kind off need house picture try us again animal point mother world near build
+self earth father head stand own page should country found answer school grow study still learn plant cover food sun four
+between state keep eye never last let thought city tree cross farm hard start might story saw far sea draw left late run""".split()
+
+# Internal Cell
+_SPECIAL_TOKENS = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]']
+_VOCAB_SIZE = len(_SPECIAL_TOKENS) + len(BENCH_WORDS)
+_TAGS = ['O', 'B-PER', 'I-PER', 'B-LOC', 'I-LOC']
+
+def _build_tokenizer(**kwargs) -> BertTokenizerFast:
+    "A WordPiece tokenizer that knows every word in `BENCH_WORDS` as a single token"
+    with tempfile.TemporaryDirectory() as tmp:
+        vocab = Path(tmp)/'vocab.txt'
+        vocab.write_text('\n'.join(_SPECIAL_TOKENS + BENCH_WORDS))
+        return BertTokenizerFast(str(vocab), model_max_length=512, **kwargs)
+
+def _bert_config(**kwargs):
+    return BertConfig(vocab_size=_VOCAB_SIZE, hidden_size=64, num_hidden_layers=2, num_attention_heads=2, intermediate_size=128, **kwargs)
+
+def _t5_config():
+    # T5 starts decoding from its pad token, and stops at `[SEP]`
+    return T5Config(vocab_size=_VOCAB_SIZE, d_model=64, d_kv=32, d_ff=128, num_layers=2, num_heads=2,
+                    pad_token_id=0, eos_token_id=3, decoder_start_token_id=0)
+
+# Cell
+TINY_MODELS = {
+    'sequence-classification': lambda: (BertForSequenceClassification(_bert_config(num_labels=2)), {}),
+    'token-classification': lambda: (DistilBertForTokenClassification(DistilBertConfig(
+        vocab_size=_VOCAB_SIZE, dim=64, n_layers=2, n_heads=2, hidden_dim=128,
+        id2label=dict(enumerate(_TAGS)), label2id={tag:i for i,tag in enumerate(_TAGS)})), {}),
+    'question-answering': lambda: (BertForQuestionAnswering(_bert_config()), {}),
+    'summarization': lambda: (T5ForConditionalGeneration(_t5_config()), {'eos_token':'[SEP]'}),
+    'translation': lambda: (T5ForConditionalGeneration(_t5_config()), {'eos_token':'[SEP]'}),
+    # `TransformersTextGenerator` adds a `<PAD>` token to the tokenizer
+    'text-generation': lambda: (GPT2LMHeadModel(GPT2Config(vocab_size=_VOCAB_SIZE+1, n_embd=64, n_layer=2, n_head=2, n_positions=512)), {'eos_token':'[SEP]'}),
+    'embeddings': lambda: (BertModel(_bert_config()), {}),
+}
+
+# Cell
+def build_tiny_model(
+    task:str, # One of the keys of `TINY_MODELS`
+    path:Union[str, Path], # A directory to save the model to, under a folder named after `task`
+    seed:int=42 # The seed the weights are initialized with
+) -> Path: # The directory the model and its tokenizer were saved to
+    "Builds and saves a tiny randomly initialized model for `task` along with its tokenizer, so it can be loaded like any pre-trained model"
+    if task not in TINY_MODELS: raise ValueError(f'{task} is not one of {list(TINY_MODELS)}')
+    path = Path(path)/task
+    torch.manual_seed(seed)
+    model, tokenizer_kwargs = TINY_MODELS[task]()
+    model.save_pretrained(path)
+    _build_tokenizer(**tokenizer_kwargs).save_pretrained(path)
+    return path
+
+# Cell
+LENGTH_PROFILES = {'short':(8, 16), 'medium':(32, 64), 'long':(96, 128), 'mixed':(8, 128)}
+
+# Cell
+def random_texts(
+    n:int, # The number of texts
+    lengths:str='short', # One of the keys of `LENGTH_PROFILES`, the range the number of words of each text is drawn from
+    seed:int=42 # The seed the texts are drawn with
+) -> List[str]:
+    "Draws `n` texts of random words from `BENCH_WORDS`, each of them a single token of the tiny models"
+    if lengths not in LENGTH_PROFILES: raise ValueError(f'{lengths} is not one of {list(LENGTH_PROFILES)}')
+    lo, hi = LENGTH_PROFILES[lengths]
+    rng = random.Random(seed)
+    return [' '.join(rng.choices(BENCH_WORDS, k=rng.randint(lo, hi))) for _ in range(n)]
+
+# Cell
+BENCH_TASKS = {
+    'sequence-classification': (EasySequenceClassifier, lambda easy, path, texts, bs: easy.tag_text(
+        texts, model_name_or_path=str(path), mini_batch_size=bs)),
+    'token-classification': (EasyTokenTagger, lambda easy, path, texts, bs: easy.tag_text(
+        texts, model_name_or_path=str(path), mini_batch_size=bs)),
+    'question-answering': (EasyQuestionAnswering, lambda easy, path, texts, bs: easy.predict_qa(
+        [' '.join(t.split()[:6]) + '?' for t in texts], texts, model_name_or_path=str(path), mini_batch_size=bs)),
+    'summarization': (EasySummarizer, lambda easy, path, texts, bs: easy.summarize(
+        texts, model_name_or_path=str(path), mini_batch_size=bs, num_beams=1, max_length=16)),
+    'translation': (EasyTranslator, lambda easy, path, texts, bs: easy.translate(
+        texts, model_name_or_path=str(path), mini_batch_size=bs, max_length=16)),
+    'text-generation': (EasyTextGenerator, lambda easy, path, texts, bs: easy.generate(
+        texts, model_name_or_path=str(path), mini_batch_size=bs, num_tokens_to_produce=8)),
+    # Embeddings given a string are looked up on the model hubs first
+    'embeddings': (EasyWordEmbeddings, lambda easy, path, texts, bs: easy.embed_text(
+        texts, model_name_or_path=HFModelResult(ModelInfo(modelId=str(path))))),
+}
+
+# Cell
+def bench_task(
+    task:str, # One of the keys of `BENCH_TASKS`
+    path:Union[str, Path], # The directory of a model built with `build_tiny_model` for `task`
+    batch_size:int=8, # The number of texts passed to every call, also used as the mini batch size
+    lengths:str='short', # One of the keys of `LENGTH_PROFILES`
+    n_calls:int=10, # The number of timed calls
+    warmup:int=2, # The number of untimed calls made first, the first of which loads the model
+    seed:int=42, # The seed the texts of the calls are drawn with
+    easy=None, # An instance of the Easy module of `task` to reuse, so its model is only loaded once
+) -> dict:
+    "Times `n_calls` calls of `batch_size` texts to the Easy module of `task`, returning their throughput in texts per second and latency percentiles in seconds"
+    easy_cls, run = BENCH_TASKS[task]
+    if easy is None: easy = easy_cls()
+    for i in range(warmup): run(easy, path, random_texts(batch_size, lengths, seed-i-1), batch_size)
+    latencies = []
+    for i in range(n_calls):
+        texts = random_texts(batch_size, lengths, seed+i)
+        start = time.perf_counter()
+        run(easy, path, texts, batch_size)
+        latencies.append(time.perf_counter() - start)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        'task': task,
+        'batch_size': batch_size,
+        'lengths': lengths,
+        'n_calls': n_calls,
+        'throughput': batch_size * n_calls / sum(latencies),
+        'latency_mean': float(np.mean(latencies)),
+        'latency_p50': float(p50),
+        'latency_p95': float(p95),
+        'latency_p99': float(p99),
+    }
+
+# Internal Cell
+def _environment():
+    "The versions and hardware results were measured with"
+    return {
+        'adaptnlp': __version__,
+        'torch': torch.__version__,
+        'transformers': transformers.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'torch_threads': torch.get_num_threads(),
+        'cuda': torch.cuda.get_device_name() if torch.cuda.is_available() else None,
+    }
+
+# Cell
+def run_benchmark(
+    tasks:List[str]=None, # The tasks to benchmark, defaults to all of `BENCH_TASKS`
+    batch_sizes:List[int]=None, # The batch sizes to benchmark every task with, defaults to 1, 8, and 32
+    lengths:List[str]=None, # The `LENGTH_PROFILES` to benchmark every task with, defaults to 'short' and 'long'
+    n_calls:int=10, # The number of timed calls of every combination
+    warmup:int=2, # The number of untimed calls made before them
+    seed:int=42, # The seed of the weights of the models and of the texts
+    import_runs:int=3, # The number of fresh interpreters every target of `IMPORT_TARGETS` is imported in, 0 skips them
+) -> dict: # The environment the benchmark ran in and lists of results, ready for `json.dump`
+    "Benchmarks the Easy module of every task in `tasks` over all combinations of `batch_sizes` and `lengths` with tiny models built in a temporary directory, and the import time of `IMPORT_TARGETS`"
+    tasks = tasks or list(BENCH_TASKS)
+    batch_sizes, lengths = ifnone(batch_sizes, [1, 8, 32]), ifnone(lengths, ['short', 'long'])
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for task in tasks:
+            path = build_tiny_model(task, tmp, seed=seed)
+            easy = BENCH_TASKS[task][0]()
+            for batch_size in batch_sizes:
+                for length in lengths:
+                    try:
+                        res = bench_task(task, path, batch_size, length, n_calls, warmup, seed, easy=easy)
+                    except Exception as e:
+                        # A broken task shouldn't hide the results of the others, and shows up when comparing runs
+                        logger.warning(f'Benchmarking {task} with batch size {batch_size} and {length} texts failed: {e!r}')
+                        res = {'task': task, 'batch_size': batch_size, 'lengths': length, 'error': f'{type(e).__name__}: {e}'}
+                    results.append(res)
+    imports = []
+    for target in (IMPORT_TARGETS if import_runs > 0 else []):
+        try: imports.append(bench_import(target, import_runs))
+        except Exception as e:
+            logger.warning(f'Benchmarking the import of {target} failed: {e!r}')
+            imports.append({'target': target, 'error': f'{type(e).__name__}: {e}'})
+    return {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'environment': _environment(),
+        'settings': {'n_calls': n_calls, 'warmup': warmup, 'seed': seed, 'import_runs': import_runs},
+        'results': results,
+        'imports': imports,
+    }
+
+# Cell
+IMPORT_TARGETS = [
+    'adaptnlp',
+    'adaptnlp.EasySequenceClassifier',
+    'adaptnlp.EasyTokenTagger',
+    'adaptnlp.EasyQuestionAnswering',
+    'adaptnlp.EasySummarizer',
+    'adaptnlp.EasyTranslator',
+    'adaptnlp.EasyTextGenerator',
+    'adaptnlp.EasyWordEmbeddings',
+    'adaptnlp.SequenceClassificationTuner',
+]
+
+# Internal Cell
+_HEAVY_MODULES = ['torch', 'transformers', 'flair', 'fastai', 'datasets', 'sklearn', 'pandas']
+
+_IMPORT_SCRIPT = (
+    "import json, sys, time; start = time.perf_counter(); import adaptnlp; "
+    "[getattr(adaptnlp, attr) for attr in {attrs!r}]; "
+    "print(json.dumps({{'seconds': time.perf_counter() - start, 'modules': [m for m in {modules!r} if m in sys.modules]}}))"
+)
+
+# Cell
+def bench_import(
+    target:str='adaptnlp', # `adaptnlp`, or one of its attributes such as `adaptnlp.EasyTokenTagger`
+    n_runs:int=3 # The number of fresh interpreters to time the import in
+) -> dict:
+    "Times importing `adaptnlp` and getting to `target` in `n_runs` fresh interpreters, along with the heavy dependencies that got imported"
+    script = _IMPORT_SCRIPT.format(attrs=target.split('.')[1:], modules=_HEAVY_MODULES)
+    # Import the same copy of AdaptNLP as this one, even when it isn't installed
+    path = [str(Path(adaptnlp.__file__).parents[1])] + [p for p in [os.environ.get('PYTHONPATH')] if p]
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(path)}
+    runs = []
+    for _ in range(n_runs):
+        out = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, env=env)
+        if out.returncode != 0: raise RuntimeError(f'Importing {target} failed:\n{out.stderr}')
+        # Anything printed while importing comes before the results
+        runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    seconds = [r['seconds'] for r in runs]
+    return {
+        'target': target,
+        'n_runs': n_runs,
+        'seconds_p50': float(np.median(seconds)),
+        'seconds_min': min(seconds),
+        'modules': runs[-1]['modules'],
+    }
+
+# Cell
+def compare_results(
+    baseline:dict, # The output of `run_benchmark` to compare against, such as one from the previous release
+    current:dict, # The output of `run_benchmark` to check
+    tolerance:float=0.1 # The relative drop in throughput, or rise in p95 latency and import time, tolerated before reporting a regression
+) -> List[dict]: # The regressions, empty if there are none
+    "Lists the results of `current` that got slower than, or started failing compared to, the same task, batch size, and lengths or import target in `baseline`"
+    key = lambda r: (r['task'], r['batch_size'], r['lengths'])
+    before = {key(r):r for r in baseline['results']}
+    regressions = []
+    for r in current['results']:
+        old = before.get(key(r))
+        if old is None or 'error' in old: continue
+        row = dict(zip(('task', 'batch_size', 'lengths'), key(r)))
+        if 'error' in r:
+            regressions.append({**row, 'metric':'error', 'baseline':None, 'current':r['error']})
+            continue
+        if r['throughput'] < old['throughput'] * (1 - tolerance):
+            regressions.append({**row, 'metric':'throughput', 'baseline':old['throughput'], 'current':r['throughput']})
+        if r['latency_p95'] > old['latency_p95'] * (1 + tolerance):
+            regressions.append({**row, 'metric':'latency_p95', 'baseline':old['latency_p95'], 'current':r['latency_p95']})
+    # Results from before import times were benchmarked have none
+    before = {r['target']:r for r in baseline.get('imports', [])}
+    for r in current.get('imports', []):
+        old = before.get(r['target'])
+        if old is None or 'error' in old: continue
+        if 'error' in r:
+            regressions.append({'target':r['target'], 'metric':'error', 'baseline':None, 'current':r['error']})
+        elif r['seconds_p50'] > old['seconds_p50'] * (1 + tolerance):
+            regressions.append({'target':r['target'], 'metric':'import_seconds', 'baseline':old['seconds_p50'], 'current':r['seconds_p50']})
+    return regressions
+
+# Cell
+@call_parse
+def adaptnlp_bench(
+    tasks:Param("Comma separated tasks to benchmark, defaults to all of them", str)=None,
+    batch_sizes:Param("Comma separated batch sizes", str)='1,8,32',
+    lengths:Param(f"Comma separated input lengths, out of {', '.join(LENGTH_PROFILES)}", str)='short,long',
+    n_calls:Param("The number of timed calls of every combination", int)=10,
+    warmup:Param("The number of untimed calls made before them", int)=2,
+    seed:Param("The seed of the models and texts", int)=42,
+    import_runs:Param("The number of fresh interpreters to time every import in, 0 skips them", int)=3,
+    output:Param("A file to write the results to, instead of printing them", str)=None,
+    baseline:Param("The results of an earlier run to check for regressions", str)=None,
+    tolerance:Param("The relative slowdown tolerated before reporting a regression", float)=0.1,
+):
+    "Benchmarks the Easy modules with tiny offline models and outputs the results as JSON"
+    # Progress bars print to stdout, which may be where the results go
+    with redirect_stdout(sys.stderr):
+        res = run_benchmark(
+            tasks=tasks.split(',') if tasks else None,
+            batch_sizes=[int(bs) for bs in batch_sizes.split(',')],
+            lengths=lengths.split(','),
+            n_calls=n_calls,
+            warmup=warmup,
+            seed=seed,
+            import_runs=import_runs,
+        )
+    if output is not None: Path(output).write_text(json.dumps(res, indent=2))
+    else: print(json.dumps(res, indent=2))
+    if baseline is not None:
+        regressions = compare_results(json.loads(Path(baseline).read_text()), res, tolerance)
+        for r in regressions:
+            where = r['target'] if 'target' in r else f"{r['task']} (batch size {r['batch_size']}, {r['lengths']} texts)"
+            print(f"Regression in {where}: {r['metric']} went from {r['baseline']} to {r['current']}", file=sys.stderr)
+        if regressions: sys.exit(1)
\ No newline at end of file
@@ -6,14 +6,14 @@ __all__ = ['logger', 'EmbeddingResult', 'EasyWordEmbeddings', 'EasyStackedEmbedd
 import logging, torch
 from typing import List, Dict, Union
 from fastcore.basics import listify
-from collections import defaultdict, OrderedDict
+from collections import OrderedDict
+from functools import partial
 
 from fastcore.basics import mk_class
 from fastcore.xtras import dict2obj
 from fastcore.dispatch import typedispatch
 from flair.data import Sentence
 from flair.embeddings import (
-    Embeddings,
     WordEmbeddings,
     StackedEmbeddings,
     FlairEmbeddings,
@@ -25,6 +25,8 @@ from flair.embeddings import (
 from ..model_hub import FlairModelResult, HFModelResult, HFModelHub, FlairModelHub
 
 from ..result import SentenceResult, DetailLevel
+from ..instrumentation import instrumented, timed_stage
+from ..model_cache import CachedModels
 
 # Cell
 _flair_hub = FlairModelHub()
@@ -163,8 +165,9 @@ class EasyWordEmbeddings:
     """
 
     def __init__(self):
-        self.models: Dict[Embeddings] = defaultdict(bool)
+        self.models = CachedModels('embeddings')
 
+    @instrumented()
     def embed_text(
         self,
         text: Union[List[Sentence], Sentence, List[str], str], # Text input, it can be a string or any of Flair's `Sentence` input formats
@@ -174,20 +177,24 @@ class EasyWordEmbeddings:
     ) -> List[EmbeddingResult]: # A list of either `EmbeddingResult`s or dictionaries with information
         "Produces embeddings for text"
         # Convert into sentences
-        sentences = _make_sentences(text)
+        with timed_stage('tokenize'):
+            sentences = _make_sentences(text)
 
         # Load correct Embeddings module
-        if model_name_or_path not in self.models.keys():
-            self.models[model_name_or_path] = _get_embedding_model(model_name_or_path)
-        embedding = self.models[model_name_or_path]
-        embeds = embedding.embed(sentences)
+        with timed_stage('load'):
+            name = getattr(model_name_or_path, 'name', model_name_or_path)
+            embedding = self.models.get_or_load(name, partial(_get_embedding_model, model_name_or_path))
+        with timed_stage('forward'):
+            embeds = embedding.embed(sentences)
 
         if not raw:
-            res = EmbeddingResult(listify(embeds))
-            return res.to_dict(detail_level) if detail_level is not None else res
+            with timed_stage('postprocess'):
+                res = EmbeddingResult(listify(embeds))
+                return res.to_dict(detail_level) if detail_level is not None else res
         else:
             return listify(embeds)
 
+    @instrumented()
     def embed_all(
         self,
         text: Union[List[Sentence], Sentence, List[str], str], # Text input, it can be a string or any of Flair's `Sentence` input formats
@@ -208,8 +215,9 @@ class EasyWordEmbeddings:
                 sentences = self.embed_text(
                     sentences, model_name_or_path=embedding_name, raw=True
                 )
-        res = EmbeddingResult(listify(sentences))
-        return res.to_dict(detail_level) if detail_level is not None else res
+        with timed_stage('postprocess'):
+            res = EmbeddingResult(listify(sentences))
+            return res.to_dict(detail_level) if detail_level is not None else res
 
 # Cell
 class EasyStackedEmbeddings:
@@ -228,6 +236,7 @@ class EasyStackedEmbeddings:
         assert len(self.embedding_stack) != 0
         self.stacked_embeddings = StackedEmbeddings(embeddings=self.embedding_stack)
 
+    @instrumented()
     def embed_text(
         self,
         text: Union[List[Sentence], Sentence, List[str], str], # Text input, it can be a string or any of Flair's `Sentence` input formats
@@ -235,13 +244,16 @@ class EasyStackedEmbeddings:
     ) -> List[EmbeddingResult]: # A list of either EmbeddingResult's or dictionaries with information
         "Stacked embeddings"
         # Convert into sentences
-        sentences = _make_sentences(text, as_list=True)
+        with timed_stage('tokenize'):
+            sentences = _make_sentences(text, as_list=True)
 
         # Unlike flair embeddings modules, stacked embeddings do not return a list of sentences
-        self.stacked_embeddings.embed(sentences)
+        with timed_stage('forward'):
+            self.stacked_embeddings.embed(sentences)
 
-        res = EmbeddingResult(listify(sentences))
-        return res.to_dict(detail_level) if detail_level is not None else res
+        with timed_stage('postprocess'):
+            res = EmbeddingResult(listify(sentences))
+            return res.to_dict(detail_level) if detail_level is not None else res
 
 # Cell
 class EasyDocumentEmbeddings:
@@ -298,24 +310,32 @@ class EasyDocumentEmbeddings:
             )
             print("RNN embeddings loaded")
 
+    @instrumented()
     def embed_pool(
         self,
         text: Union[List[Sentence], Sentence, List[str], str], # Text input, it can be a string or any of Flair's `Sentence` input formats
         detail_level:DetailLevel = DetailLevel.Low, # A level of detail to return. By default is None, which returns a EmbeddingResult, otherwise will return a dict
     ) -> List[EmbeddingResult]: # A list of either EmbeddingResult's or dictionaries with information
         "Generate stacked embeddings with `DocumentPoolEmbeddings`"
-        sentences = _make_sentences(text, as_list=True)
-        self.pool_embeddings.embed(sentences)
-        res = EmbeddingResult(listify(sentences))
-        return res.to_dict(detail_level) if detail_level is not None else res
+        with timed_stage('tokenize'):
+            sentences = _make_sentences(text, as_list=True)
+        with timed_stage('forward'):
+            self.pool_embeddings.embed(sentences)
+        with timed_stage('postprocess'):
+            res = EmbeddingResult(listify(sentences))
+            return res.to_dict(detail_level) if detail_level is not None else res
 
+    @instrumented()
     def embed_rnn(
         self,
         text: Union[List[Sentence], Sentence, List[str], str], # Text input, it can be a string or any of Flair's `Sentence` input formats
         detail_level:DetailLevel = DetailLevel.Low, # A level of detail to return. By default is None, which returns a EmbeddingResult, otherwise will return a dict
     ) -> List[Sentence]: # A list of either EmbeddingResult's or dictionaries with information
         "Generate stacked embeddings with `DocumentRNNEmbeddings`"
-        sentences = _make_sentences(text, as_list=True)
-        self.rnn_embeddings.embed(sentences)
-        res = EmbeddingResult(listify(sentences))
-        return res.to_dict(detail_level) if detail_level is not None else res
\ No newline at end of file
+        with timed_stage('tokenize'):
+            sentences = _make_sentences(text, as_list=True)
+        with timed_stage('forward'):
+            self.rnn_embeddings.embed(sentences)
+        with timed_stage('postprocess'):
+            res = EmbeddingResult(listify(sentences))
+            return res.to_dict(detail_level) if detail_level is not None else res
\ No newline at end of file
@@ -1,16 +1,21 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/10_question_answering.ipynb (unless otherwise specified).
 
-__all__ = ['logger', 'QACallback', 'QAResult', 'TransformersQuestionAnswering', 'EasyQuestionAnswering']
+__all__ = ['logger', 'QACallback', 'QAResult', 'QAExample', 'QAFeature', 'ContextCache', 'featurize_qa_examples',
+           'TransformersQuestionAnswering', 'EasyQuestionAnswering']
 
 # Cell
 import logging
+import re
+from threading import Lock
 from torch import tensor
-from typing import Tuple, List, Union, Dict
-from collections import OrderedDict, defaultdict
+from typing import Tuple, List, Union, Dict, Iterable, Iterator
+from collections import OrderedDict
+from functools import partial
 from tqdm import tqdm
 
+import numpy as np
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import TensorDataset
 from transformers import (
     AutoTokenizer,
     AutoModelForQuestionAnswering,
@@ -21,6 +26,7 @@ from transformers import (
     RobertaForQuestionAnswering,
     PreTrainedModel,
     PreTrainedTokenizer,
+    PreTrainedTokenizerFast,
     SquadExample,
     squad_convert_examples_to_features
 )
@@ -28,14 +34,17 @@ from transformers import (
 from transformers.modeling_outputs import QuestionAnsweringModelOutput
 from transformers.data.processors.squad import SquadResult
 
-from ..model import AdaptiveModel, DataLoader
+from ..model import AdaptiveModel, DataLoader, load_pretrained_model, run_sharded, run_pipelined
 from ..model_hub import HFModelResult
+from ..instrumentation import instrumented, timed_stage, record_batches
+from ..model_cache import CachedModels
 from .utils import (
     compute_predictions_log_probs,
     compute_predictions_logits,
+    _context_windows,
 )
 
-from fastcore.basics import risinstance, nested_attr, Self, patch, listify
+from fastcore.basics import risinstance, nested_attr, Self, patch, listify, chunked, ifnone
 
 from fastai.callback.core import Callback
 from fastai.torch_core import apply, to_detach
@@ -49,14 +58,21 @@ class QACallback(Callback):
     order = -2
     _qa_models = [XLMForQuestionAnswering, RobertaForQuestionAnswering, DistilBertForQuestionAnswering]
 
-    def __init__(self, xmodel_instances, features):
+    def __init__(
+        self,
+        xmodel_instances, # Models that predict the top start and end indexes themselves
+        features, # The features the batches are made of
+        trim_padding:bool=False, # Whether to drop the logits of the right padding of each feature, so how features are batched doesn't matter
+    ):
         self.xmodel_instances = xmodel_instances
         self.features = features
+        self.trim_padding = trim_padding
 
     def before_batch(self):
         "Adjusts `token_type_ids` if model is in `_qa_models`"
         if risinstance(self._qa_models, self.learn.model): del self.learn.inputs["token_type_ids"]
         if len(self.xb) > 3: self.example_indices = self.xb[3]
+        self.attention_mask = self.xb[1]
 
         if isinstance(self.learn.model, self.xmodel_instances):
             self.learn.inputs.update({'cls_index': self.xb[4], 'p_mask': self.xb[5]})
@@ -71,7 +87,8 @@ class QACallback(Callback):
                     }
                 )
     def after_pred(self):
-        "Generate SquadResults"
+        "Generate a `SquadResult` for every feature in the batch"
+        results = []
         for i, example_index in enumerate(self.example_indices):
             eval_feature = self.features[example_index.item()]
             unique_id = int(eval_feature.unique_id)
@@ -86,17 +103,21 @@ class QACallback(Callback):
                 end_top_index = output[3]
                 cls_logits = output[4]
 
-                self.learn.pred = SquadResult(
+                results.append(SquadResult(
                     unique_id,
                     start_logits,
                     end_logits,
                     start_top_index=start_top_index,
                     end_top_index=end_top_index,
                     cls_logits=cls_logits
-                )
+                ))
             else:
                 start_logits, end_logits = output
-                self.learn.pred = SquadResult(unique_id, start_logits, end_logits)
+                if self.trim_padding:
+                    n = int(self.attention_mask[i].sum())
+                    start_logits, end_logits = start_logits[:n], end_logits[:n]
+                results.append(SquadResult(unique_id, start_logits, end_logits))
+        self.learn.pred = results
 
 # Cell
 from ..result import DetailLevel
@@ -187,6 +208,240 @@ class QAResult:
 
         return o
 
+# Cell
+class QAExample:
+    """A question and the context to answer it from
+
+    Unlike a `SquadExample`, the context is not split into words when it is created, which takes a long time for long contexts
+
+    * **qas_id** - The id of the question
+    * **question_text** - The question
+    * **context_text** - The context to answer it from
+    """
+    def __init__(self, qas_id: str, question_text: str, context_text: str):
+        self.qas_id = qas_id
+        self.question_text = question_text
+        self.context_text = context_text
+
+    def __repr__(self): return f'QAExample(qas_id={self.qas_id!r}, question_text={self.question_text!r})'
+
+class QAFeature:
+    """A window of the context of a `QAExample` that fits into the model along with its question
+
+    Positions are the indexes of the tokens in the window's `input_ids`, and only the ones of context tokens are in the maps
+
+    * **example_index** - The index of the example the window was cut from
+    * **unique_id** - A unique id for the window
+    * **tokens** - The input ids of the window
+    * **token_to_orig_map** - The index of the whitespace separated word of the context each position falls in
+    * **token_is_max_context** - Whether this window has the most context around each position of all the windows
+    * **offsets** - The span of characters in the context of each position
+    """
+    def __init__(
+        self,
+        example_index: int,
+        unique_id: int,
+        tokens: List[int],
+        token_to_orig_map: Dict[int, int],
+        token_is_max_context: Dict[int, bool],
+        offsets: Dict[int, Tuple[int, int]],
+    ):
+        self.example_index = example_index
+        self.unique_id = unique_id
+        self.tokens = tokens
+        self.token_to_orig_map = token_to_orig_map
+        self.token_is_max_context = token_is_max_context
+        self.offsets = offsets
+
+# Internal Cell
+# Whitespace as `SquadExample` splits contexts into words
+_squad_words = re.compile('[^ \t\r\n\u202f]+')
+
+# Cell
+class ContextCache:
+    """
+    A thread-safe cache of tokenized contexts, bounded by the number of tokens they hold.
+
+    Contexts are kept in the order they were last used, and the least recently used are evicted first
+    """
+    def __init__(
+        self,
+        max_tokens: int = 1_000_000, # The tokens the cached contexts may hold, unbounded if `None`
+    ):
+        self.max_tokens = max_tokens
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.n_tokens = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self): return len(self._entries)
+    def __contains__(self, key): return key in self._entries
+
+    def get(
+        self,
+        key, # The key of a context
+    ):
+        "Gets the tokenized context of `key` and marks it as used, counting a hit or a miss"
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(
+        self,
+        key, # The key of the context
+        context:'_TokenizedContext', # The tokenized context
+    ):
+        "Caches `context` under `key` as the most recently used, evicting others until it fits in `max_tokens`"
+        with self._lock:
+            if key in self._entries: self.n_tokens -= len(self._entries.pop(key).ids)
+            self._entries[key] = context
+            self.n_tokens += len(context.ids)
+            while self.max_tokens is not None and self.n_tokens > self.max_tokens and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.n_tokens -= len(evicted.ids)
+                self.evictions += 1
+
+    def clear(self):
+        "Removes every context, and resets the counters"
+        with self._lock:
+            self._entries.clear()
+            self.n_tokens = self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> dict:
+        "The number of hits, misses, and evictions and the hit rate, along with the contexts that are cached and their tokens"
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.,
+                'contexts': len(self._entries),
+                'tokens': self.n_tokens,
+                'max_tokens': self.max_tokens,
+            }
+
+# Internal Cell
+class _TokenizedContext:
+    "The tokens of a context without special tokens, with their character offsets and the whitespace separated word they fall in"
+    def __init__(self, context: str, ids: List[int], offsets: List[Tuple[int, int]]):
+        self.ids = np.array(ids, dtype=np.int64)
+        self.offsets = np.array(offsets, dtype=np.int64).reshape(-1, 2)
+        word_starts = np.array([m.start() for m in _squad_words.finditer(context)], dtype=np.int64)
+        self.words = np.searchsorted(word_starts, self.offsets[:, 0], side='right') - 1
+
+def _tokenize_contexts(
+    tokenizer: PreTrainedTokenizerFast,
+    contexts: List[str],
+    cache: ContextCache = None,
+) -> List[_TokenizedContext]:
+    "Tokenizes the distinct `contexts` that aren't in `cache` in one batch, and caches them"
+    key = lambda context: (type(tokenizer).__name__, tokenizer.name_or_path, context)
+    tokenized = {c: cache.get(key(c)) if cache is not None else None for c in dict.fromkeys(contexts)}
+    missing = [c for c, t in tokenized.items() if t is None]
+    if missing:
+        encoding = tokenizer(missing, add_special_tokens=False, return_offsets_mapping=True)
+        for context, ids, offsets in zip(missing, encoding['input_ids'], encoding['offset_mapping']):
+            tokenized[context] = _TokenizedContext(context, ids, offsets)
+            if cache is not None: cache.put(key(context), tokenized[context])
+    return [tokenized[c] for c in contexts]
+
+def _pair_template(
+    tokenizer: PreTrainedTokenizerFast
+) -> Tuple[tuple, tuple, tuple]:
+    "The ids and token types of the special tokens `tokenizer` puts before, between, and after a question and context, with the token type of the text following each"
+    probe = tokenizer('a', 'b', return_token_type_ids=True)
+    ids, types, sequences = probe['input_ids'], probe['token_type_ids'], probe.sequence_ids(0)
+    q = [p for p, s in enumerate(sequences) if s == 0]
+    c = [p for p, s in enumerate(sequences) if s == 1]
+    part = lambda a, b, text: (ids[a:b], types[a:b], types[text] if text is not None else 0)
+    return part(0, q[0], q[0]), part(q[-1] + 1, c[0], c[0]), part(c[-1] + 1, len(ids), None)
+
+# Cell
+def featurize_qa_examples(
+    tokenizer: PreTrainedTokenizerFast,
+    examples: List[QAExample],
+    max_seq_length: int = 512,
+    doc_stride: int = 128,
+    max_query_length: int = 64,
+    cache: 'ContextCache' = None,
+) -> Tuple[List[QAFeature], TensorDataset]:
+    """Splits `examples` into windows that fit into the model, like `squad_convert_examples_to_features` but with a fast tokenizer
+
+    All the questions and contexts are tokenized in batches, and windows are cut from the offset mappings of the tokens,
+    so answers can be cut straight out of the contexts by their characters. Each distinct context is only tokenized once,
+    and not at all if it is in `cache`
+
+    * **tokenizer** - A fast tokenizer
+    * **examples** - The questions and contexts to split
+    * **max_seq_length** - Maximum number of tokens of a window, including its question and special tokens
+    * **doc_stride** - Number of tokens between the starts of two windows of the same context
+    * **max_query_length** - Maximum number of tokens of a question
+    * **cache** - A `ContextCache` to keep the tokenized contexts in
+
+    **return** - A `QAFeature` for every window, and a dataset of their `input_ids`, `attention_mask`, `token_type_ids` and feature index
+    """
+    questions = tokenizer(
+        [e.question_text for e in examples],
+        add_special_tokens=False,
+        truncation=True,
+        max_length=max_query_length,
+    )['input_ids']
+    contexts = _tokenize_contexts(tokenizer, [e.context_text for e in examples], cache)
+    before, between, after = _pair_template(tokenizer)
+    n_special = len(before[0]) + len(between[0]) + len(after[0])
+    pad_left = tokenizer.padding_side == 'left'
+
+    features, input_ids, token_type_ids, lengths, windows = [], [], [], [], {}
+    for example_index, (question, context) in enumerate(zip(questions, contexts)):
+        # An empty context has no windows, like with `squad_convert_examples_to_features`
+        if not len(context.ids): continue
+        context_length = max_seq_length - len(question) - n_special
+        if context_length <= 0:
+            raise ValueError(f'`max_seq_length` {max_seq_length} leaves no room for the context of questions of {len(question)} tokens')
+        # Questions of the same length split the same context into the same windows
+        if (id(context), context_length) not in windows:
+            windows[id(context), context_length] = _context_windows(len(context.ids), context_length, doc_stride)
+        spans, best = windows[id(context), context_length]
+
+        prefix = len(before[0]) + len(question) + len(between[0])
+        for k, (start, length) in enumerate(spans):
+            ids = np.concatenate([before[0], question, between[0], context.ids[start:start + length], after[0]])
+            types = np.concatenate([before[1], [before[2]] * len(question), between[1], [between[2]] * length, after[1]])
+            first = prefix + (max_seq_length - len(ids) if pad_left else 0)
+            positions = range(first, first + length)
+            features.append(QAFeature(
+                example_index=example_index,
+                unique_id=1000000000 + len(features),
+                tokens=None,
+                token_to_orig_map=dict(zip(positions, context.words[start:start + length].tolist())),
+                token_is_max_context=dict(zip(positions, (best[start:start + length] == k).tolist())),
+                offsets=dict(zip(positions, map(tuple, context.offsets[start:start + length].tolist()))),
+            ))
+            input_ids.append(ids)
+            token_type_ids.append(types)
+            lengths.append(len(ids))
+
+    n = len(features)
+    all_input_ids = np.full((n, max_seq_length), ifnone(tokenizer.pad_token_id, 0), dtype=np.int64)
+    all_attention_mask = np.zeros((n, max_seq_length), dtype=np.int64)
+    all_token_type_ids = np.full((n, max_seq_length), tokenizer.pad_token_type_id, dtype=np.int64)
+    for row, (ids, types, length) in enumerate(zip(input_ids, token_type_ids, lengths)):
+        cols = slice(max_seq_length - length, None) if pad_left else slice(0, length)
+        all_input_ids[row, cols], all_token_type_ids[row, cols], all_attention_mask[row, cols] = ids, types, 1
+    for feature, ids in zip(features, all_input_ids.tolist()): feature.tokens = ids
+    dataset = TensorDataset(
+        torch.from_numpy(all_input_ids),
+        torch.from_numpy(all_attention_mask),
+        torch.from_numpy(all_token_type_ids),
+        torch.arange(n, dtype=torch.long),
+    )
+    return features, dataset
+
 # Cell
 class TransformersQuestionAnswering(AdaptiveModel):
     """Adaptive Model for Transformers Question Answering Model
@@ -206,17 +461,28 @@ class TransformersQuestionAnswering(AdaptiveModel):
         # Sets internal model
         self.set_model(model)
         self.xmodel_instances = (XLNetForQuestionAnswering, XLMForQuestionAnswering)
+        # Many questions are asked about the same contexts, which are only tokenized once
+        self.context_cache = ContextCache()
 
     @classmethod
-    def load(cls, model_name_or_path: str) -> AdaptiveModel:
+    def load(
+        cls,
+        model_name_or_path: str,
+        quantize: str = None,
+        quantize_sample: List[str] = None,
+    ) -> AdaptiveModel:
         """Class method for loading and constructing this model
 
         * **model_name_or_path** - A key string of one of Transformer's pre-trained Question Answering (SQUAD) models
+        * **quantize** - Set to 'dynamic-int8' to quantize the model's Linear layers for CPU inference, see `AdaptiveModel.quantize`
+        * **quantize_sample** - Held-out texts to report the quantized model's agreement with the original on
         """
-        # QA tokenizers not compatible with fast tokenizers yet
-        tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, use_fast=False)
-        model = AutoModelForQuestionAnswering.from_pretrained(model_name_or_path)
+        model = load_pretrained_model(AutoModelForQuestionAnswering, model_name_or_path)
+        # XLNet and XLM need the `cls_index` and `p_mask` of `squad_convert_examples_to_features`, which takes slow tokenizers
+        use_fast = not isinstance(model, (XLNetForQuestionAnswering, XLMForQuestionAnswering))
+        tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, use_fast=use_fast)
         qa_model = cls(tokenizer, model)
+        if quantize is not None: qa_model.quantize(quantize, quantize_sample)
         return qa_model
 
     def predict(
@@ -256,25 +522,121 @@ class TransformersQuestionAnswering(AdaptiveModel):
             query = [query]
             context = [context]
         assert len(query) == len(context)
-        examples = self._mini_squad_processor(query=query, context=context)
-        features, dataset = squad_convert_examples_to_features(
-            examples,
-            self.tokenizer,
+        featurize = partial(
+            self._featurize_chunk,
+            mini_batch_size=mini_batch_size,
             max_seq_length=max_seq_length,
             doc_stride=doc_stride,
             max_query_length=max_query_length,
-            is_training=False,
-            return_dataset='pt',
-            threads=1,
         )
-        all_results = []
+        with timed_stage('tokenize'):
+            if self._featurizes_fast: examples = [QAExample(str(i), q, c) for i, (q, c) in enumerate(zip(query, context))]
+            else: examples = self._mini_squad_processor(query=query, context=context)
+        # Writing predictions to files needs all of them at once, so examples are only split into chunks without it
+        chunks = list(chunked(examples, len(examples) if kwargs else mini_batch_size * self.pipeline_batches))
+        if self._featurizes_fast: stages = (featurize,)
+        else:
+            # `squad_convert_examples_to_features` forks a pool of processes, which is not safe from a background thread,
+            # so every chunk is featurized up front and only the model and post-processing of different chunks overlap
+            chunks, stages = [featurize(chunk) for chunk in chunks], ()
+        stages += (
+            self._forward_chunk,
+            partial(
+                self._postprocess_chunk,
+                n_best_size=n_best_size,
+                max_answer_length=max_answer_length,
+                do_lower_case=do_lower_case,
+                version_2_with_negative=version_2_with_negative,
+                verbose_logging=verbose_logging,
+                null_score_diff_threshold=null_score_diff_threshold,
+                **kwargs,
+            ),
+        )
+        answers, n_best = OrderedDict(), OrderedDict()
+        for chunk_answers, chunk_n_best in run_pipelined(chunks, *stages):
+            answers.update(chunk_answers)
+            n_best.update(chunk_n_best)
 
-        dl = DataLoader(dataset, batch_size=mini_batch_size)
+        return examples, answers, n_best
 
-        cb = QACallback(self.xmodel_instances, features)
+    @timed_stage('tokenize')
+    def _featurize_chunk(
+        self,
+        examples: List[Union[QAExample, SquadExample]],
+        mini_batch_size: int = 32,
+        max_seq_length: int = 512,
+        doc_stride: int = 128,
+        max_query_length: int = 64,
+    ) -> Tuple[List[Union[QAExample, SquadExample]], list, DataLoader]:
+        "Splits a chunk of `examples` into features and batches them for `predict`"
+        if self._featurizes_fast:
+            features, dataset = featurize_qa_examples(
+                self.tokenizer,
+                examples,
+                max_seq_length=max_seq_length,
+                doc_stride=doc_stride,
+                max_query_length=max_query_length,
+                cache=self.context_cache,
+            )
+        else:
+            features, dataset = squad_convert_examples_to_features(
+                examples,
+                self.tokenizer,
+                max_seq_length=max_seq_length,
+                doc_stride=doc_stride,
+                max_query_length=max_query_length,
+                is_training=False,
+                return_dataset='pt',
+                threads=1,
+            )
+        batches = self._length_batches(dataset, mini_batch_size)
+        record_batches([b[1] for b in batches])
+        return examples, features, DataLoader(batches, batch_size=None)
 
+    def _length_batches(
+        self,
+        dataset: TensorDataset, # Features padded to `max_seq_length`, with their attention mask second
+        mini_batch_size: int = 32, # Mini batch size
+    ) -> List[Tuple[torch.Tensor, ...]]:
+        """Batches the features of `dataset` longest first, and trims the padding each batch doesn't need
+
+        Results are matched back to their features by the feature index in every batch, so the order doesn't matter.
+        Tokenizers that pad on the left keep every batch at full length, since the positions the model predicts
+        have to line up with those of the features
+        """
+        lengths = dataset.tensors[1].sum(1).tolist()
+        order = sorted(range(len(lengths)), key=lambda k: lengths[k], reverse=True)
+        batches = []
+        for batch in chunked(order, mini_batch_size):
+            batch = torch.tensor(batch)
+            n = max(lengths[k] for k in batch.tolist()) if self.tokenizer.padding_side == 'right' else None
+            batches.append(tuple(t[batch, :n] if t.dim() > 1 else t[batch] for t in dataset.tensors))
+        return batches
+
+    @timed_stage('forward')
+    def _forward_chunk(
+        self, chunk: Tuple[List[SquadExample], list, DataLoader]
+    ) -> Tuple[List[SquadExample], list, list]:
+        "Runs the model on the features of a chunk, overlapped with `_postprocess_chunk` by `predict`"
+        examples, features, dl = chunk
+        cb = QACallback(self.xmodel_instances, features, trim_padding=self.tokenizer.padding_side == 'right')
         all_results, _ = super().get_preds(dl=dl, cbs=[cb])
+        return examples, features, [result for batch in all_results for result in batch]
 
+    @timed_stage('postprocess')
+    def _postprocess_chunk(
+        self,
+        chunk: Tuple[List[SquadExample], list, list],
+        n_best_size: int = 5,
+        max_answer_length: int = 10,
+        do_lower_case: bool = False,
+        version_2_with_negative: bool = False,
+        verbose_logging: bool = False,
+        null_score_diff_threshold: float = 0.0,
+        **kwargs,
+    ) -> Tuple[OrderedDict, OrderedDict]:
+        "Picks the answers of a chunk from the model's predictions for `predict`"
+        examples, features, all_results = chunk
         if isinstance(self.model, self.xmodel_instances):
             start_n_top = (
                 self.model.config.start_n_top
@@ -287,7 +649,7 @@ class TransformersQuestionAnswering(AdaptiveModel):
                 else self.model.module.config.end_n_top
             )
 
-            answers, n_best = compute_predictions_log_probs(
+            return compute_predictions_log_probs(
                 examples,
                 features,
                 all_results,
@@ -301,22 +663,49 @@ class TransformersQuestionAnswering(AdaptiveModel):
                 **kwargs,
             )
 
-        else:
-            answers, n_best = compute_predictions_logits(
-                examples,
-                features,
-                all_results,
-                n_best_size,
-                max_answer_length,
-                do_lower_case,
-                verbose_logging,
-                version_2_with_negative,
-                null_score_diff_threshold,
-                self.tokenizer,
-                **kwargs,
-            )
+        return compute_predictions_logits(
+            examples,
+            features,
+            all_results,
+            n_best_size,
+            max_answer_length,
+            do_lower_case,
+            verbose_logging,
+            version_2_with_negative,
+            null_score_diff_threshold,
+            self.tokenizer,
+            **kwargs,
+        )
 
-        return examples, answers, n_best
+    def predict_iter(
+        self,
+        query: Union[Iterable[str], str],
+        context: Union[Iterable[str], str],
+        mini_batch_size: int = 32,
+        **kwargs,
+    ) -> Iterator[Tuple[List[SquadExample], OrderedDict, OrderedDict]]:
+        """Lazily run `predict` over pairs of `query` and `context` one mini batch at a time, yielding the
+        `(examples, answers, n_best)` of each batch as soon as it is ready
+
+        * **query** - String or iterable of strings that specify the ordered questions corresponding to `context`
+        * **context** - String or iterable of strings that specify the ordered contexts corresponding to `query`
+        * **mini_batch_size** - Number of query and context pairs pulled and predicted on at a time
+        * **&ast;&ast;kwargs** - Keyword arguments passed to `predict`
+
+        The keys of `answers` and `n_best` restart at "0" for every batch, use the yielded `examples` to map them
+        back to their question and context
+        """
+        if isinstance(query, str):
+            query = [query]
+            context = [context]
+        for batch in chunked(zip(query, context), mini_batch_size):
+            batch_query, batch_context = map(list, zip(*batch))
+            yield self.predict(batch_query, batch_context, mini_batch_size=mini_batch_size, **kwargs)
+
+    @property
+    def _featurizes_fast(self) -> bool:
+        "Whether questions and contexts are split into features by `featurize_qa_examples` rather than `squad_convert_examples_to_features`"
+        return self.tokenizer.is_fast and not isinstance(self.model, self.xmodel_instances)
 
     def _mini_squad_processor(
         self, query: List[str], context: List[str]
@@ -361,8 +750,9 @@ class EasyQuestionAnswering:
     """
 
     def __init__(self):
-        self.models: Dict[AdaptiveModel] = defaultdict(bool)
+        self.models = CachedModels('question_answering')
 
+    @instrumented()
     def predict_qa(
         self,
         query: Union[List[str], str],
@@ -386,21 +776,18 @@ class EasyQuestionAnswering:
         **return** - Either a dictionary of results or a QAResult
         """
         name = getattr(model_name_or_path, 'name', model_name_or_path)
-        try:
-            if not self.models[name]:
-                self.models[name] = TransformersQuestionAnswering.load(
-                    name
+        with timed_stage('load'):
+            try:
+                model = self.models.get_or_load(name, partial(TransformersQuestionAnswering.load, name))
+            except OSError:
+                logger.info(
+                    f'{name} not a valid Transformers pre-trained QA model...check path or huggingface.co/models'
                 )
-        except OSError:
-            logger.info(
-                f'{name} not a valid Transformers pre-trained QA model...check path or huggingface.co/models'
-            )
-            raise ValueError(
-                f'{name} is not a valid path or model name from huggingface.co/models'
-            )
-            return OrderedDict(), [OrderedDict()]
+                raise ValueError(
+                    f'{name} is not a valid path or model name from huggingface.co/models'
+                )
+                return OrderedDict(), [OrderedDict()]
 
-        model = self.models[name]
 
         examples, top_answer, top_n_answers = model.predict(
             query=query,
@@ -410,6 +797,55 @@ class EasyQuestionAnswering:
             **kwargs,
         )
 
+        with timed_stage('postprocess'):
+            result = QAResult(examples, top_answer, top_n_answers, n_best_size)
+            return result.to_dict(detail_level) if detail_level is not None else result
+
+    def predict_qa_sharded(
+        self,
+        query: List[str],
+        context: List[str],
+        n_best_size: int = 5,
+        mini_batch_size: int = 32,
+        model_name_or_path: Union[str, HFModelResult] = 'bert-large-uncased-whole-word-masking-finetuned-squad',
+        detail_level = DetailLevel.Low,
+        num_workers: int = 4,
+        threads_per_worker: int = None,
+        **kwargs,
+    ) -> Union[QAResult, dict]:
+        """Predicts answers like `predict_qa`, sharded across a pool of worker processes that each load the model once
+
+        * **query** - List of strings that specify the ordered questions corresponding to `context`
+        * **context** - List of strings that specify the ordered contexts corresponding to `query`
+        * **n_best_size** - The top n answers returned
+        * **mini_batch_size** - Mini batch size for inference
+        * **model_name_or_path** - Path to QA model or name of QA model at huggingface.co/models
+        * **detail_level** - String or DetailLevel of what amount of information should be returned. If `None` will return `QAResult`
+        * **num_workers** - The number of worker processes
+        * **threads_per_worker** - The number of PyTorch threads in each worker. Defaults to splitting the cores evenly between the workers
+        * **kwargs**(Optional) - Keyword arguments for `AdaptiveModel`s like `TransformersQuestionAnswering`
+
+        **return** - Either a dictionary of results or a QAResult
+        """
+        if isinstance(query, str):
+            query = [query]
+            context = [context]
+        assert len(query) == len(context)
+        shards = list(zip(*[chunked(o, n_chunks=min(len(query), num_workers*4)) for o in (query, context)]))
+        results = run_sharded(
+            EasyQuestionAnswering, 'predict_qa', shards, num_workers, threads_per_worker,
+            n_best_size=n_best_size, mini_batch_size=mini_batch_size, model_name_or_path=model_name_or_path, detail_level=None, **kwargs
+        )
+        # Every shard numbers its questions from "0", so offset them by the questions of the shards before it
+        examples, top_answer, top_n_answers = [], OrderedDict(), OrderedDict()
+        for res in results:
+            offset = len(examples)
+            for example in res._examples:
+                example.qas_id = str(int(example.qas_id) + offset)
+                examples.append(example)
+            top_answer.update((str(int(k) + offset), v) for k,v in res._top_predictions.items())
+            top_n_answers.update((str(int(k) + offset), v) for k,v in res._all_nbest_json.items())
+
         result = QAResult(examples, top_answer, top_n_answers, n_best_size)
 
         return result.to_dict(detail_level) if detail_level is not None else result
\ No newline at end of file
@@ -5,13 +5,14 @@ __all__ = ['logger', 'SequenceResult', 'TransformersSequenceClassifier', 'FlairS
 
 # Cell
 import logging
-from typing import List, Dict, Union, Tuple, Callable
-from collections import defaultdict, OrderedDict
+from typing import List, Union, Tuple, Callable
+from collections import OrderedDict
 from pathlib import Path
+from functools import partial
 
 import torch
 from torch import nn
-from torch.utils.data import TensorDataset, DataLoader
+from torch.utils.data import DataLoader
 import datasets
 from datasets import ClassLabel
 from sklearn.metrics import accuracy_score, precision_recall_fscore_support
@@ -22,6 +23,7 @@ from transformers import (
     AutoModelForSequenceClassification,
     PreTrainedTokenizer,
     PreTrainedModel,
+    BatchEncoding,
     BertPreTrainedModel,
     DistilBertPreTrainedModel,
     XLMPreTrainedModel,
@@ -34,10 +36,12 @@ from transformers import (
     Trainer,
 )
 
-from ..model import AdaptiveModel
+from ..model import AdaptiveModel, token_budget_batches, PadCollate, load_pretrained_model, run_sharded, run_pipelined
 from ..model_hub import HFModelResult, FlairModelResult
+from ..instrumentation import instrumented, timed_stage, record_batches
+from ..model_cache import CachedModels
 
-from fastcore.basics import risinstance
+from fastcore.basics import risinstance, chunked
 from fastcore.xtras import Path
 from ..result import DetailLevel, SentenceResult
 
@@ -46,6 +50,20 @@ from torch import tensor
 # Cell
 logger = logging.getLogger(__name__)
 
+# Internal Cell
+def _labelled_sentences(
+    texts:List[str], # The classified texts
+    probs:torch.Tensor, # The probability of every class for every text
+    classes:List[str], # The name of every class, in the order of the columns of `probs`
+) -> List[Sentence]:
+    "A `Sentence` of each text labelled with the probability of every class"
+    sentences = []
+    for text, pred in zip(texts, probs.tolist()):
+        sentence = Sentence(text)
+        for cls, score in zip(classes, pred): sentence.add_label(typename='sc', value=cls, score=score)
+        sentences.append(sentence)
+    return sentences
+
 # Cell
 class SequenceResult(SentenceResult):
     "A result class designed for Sequence Classification models"
@@ -57,13 +75,47 @@ class SequenceResult(SentenceResult):
         super().__init__(sentences)
         self.classes = sentences[0].get_label_names()
         self.class_names = class_names
+        self._texts, self._probs = None, None
+
+    @classmethod
+    def from_probabilities(
+        cls,
+        texts:List[str], # The classified texts
+        probs:torch.Tensor, # The probability of every class for every text, with a row per text
+        classes:List[str], # The name of every class, in the order of the columns of `probs`
+        class_names:list = None # A potential list of class names
+    ):
+        "Creates a `SequenceResult` backed directly by `probs`, without creating a `Sentence` for every text"
+        res = cls.__new__(cls)
+        res._sentences, res._texts, res._probs = None, texts, probs
+        res.classes, res.class_names = classes, class_names
+        return res
+
+    @property
+    def sentences(self) -> List[Sentence]:
+        "A labelled `Sentence` of each text, only created when first asked for by a result made `from_probabilities`"
+        if self._sentences is None: self._sentences = _labelled_sentences(self._texts, self._probs, self.classes)
+        return self._sentences
+
+    @property
+    def inputs(self) -> List[str]:
+        "The original text inputs"
+        if self._texts is not None: return self._texts
+        return super().inputs
+
+    @property
+    def tokenized_inputs(self) -> List[str]:
+        "The original tokenized inputs"
+        return [s.to_tokenized_string() for s in self.sentences]
 
     @property
     def probabilities(self) -> List[List[tensor]]:
         """
         The probabilities returned for each classification
         """
-        return torch.stack([tensor(list(map(lambda x: x.score, i.get_labels()))) for i in self._sentences], dim=0)
+        if self._probs is None:
+            self._probs = torch.stack([tensor(list(map(lambda x: x.score, i.get_labels()))) for i in self._sentences], dim=0)
+        return self._probs
 
     @property
     def predictions(self) -> List[str]:
@@ -71,7 +123,9 @@ class SequenceResult(SentenceResult):
         A list of the best classification for each input
         """
         if self.class_names is not None:
-            return [self.class_names[p.argmax()] for p in self.probabilities]
+            return [self.class_names[i] for i in self.probabilities.argmax(dim=1).tolist()]
+        if self._texts is not None:
+            return [self.classes[i] for i in self.probabilities.argmax(dim=1).tolist()]
         return [max(s.labels, key=lambda x: x.score).value for s in self._sentences]
 
     def to_dict(
@@ -93,7 +147,7 @@ class SequenceResult(SentenceResult):
 
         if detail_level == 'high':
             # Add original `Sentences`
-            o['sentences'] = self._sentences
+            o['sentences'] = self.sentences
         return o
 
 # Cell
@@ -120,27 +174,30 @@ class TransformersSequenceClassifier(AdaptiveModel):
     @classmethod
     def load(
         cls,
-        model_name_or_path: Union[HFModelResult, str] # A key string of one of Transformer's pre-trained Sequence Classifier Model or a `HFModelResult`
+        model_name_or_path: Union[HFModelResult, str], # A key string of one of Transformer's pre-trained Sequence Classifier Model or a `HFModelResult`
+        quantize: str = None, # Set to 'dynamic-int8' to quantize the model's Linear layers for CPU inference, see `AdaptiveModel.quantize`
+        quantize_sample: List[str] = None, # Held-out texts to report the quantized model's agreement with the original on
     ) -> AdaptiveModel:
         "Class method for loading and constructing this classifier"
         if isinstance(model_name_or_path, HFModelResult): model_name_or_path = model_name_or_path.name
         tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, use_fast=True)
-        model = AutoModelForSequenceClassification.from_pretrained(model_name_or_path)
+        model = load_pretrained_model(AutoModelForSequenceClassification, model_name_or_path)
         classifier = cls(tokenizer, model)
+        if quantize is not None: classifier.quantize(quantize, quantize_sample)
         return classifier
 
     def predict(
         self,
         text: Union[List[Sentence], Sentence, List[str], str], # Sentences to run inference on
         mini_batch_size: int = 32, # Mini batch size
+        max_tokens_per_batch: int = None, # Maximum number of tokens in a batch including padding. If set, is used instead of `mini_batch_size`
+        return_result: bool = False, # Whether to return a `SequenceResult` of all the probabilities rather than a labelled `Sentence` for every text
         **kwargs, # Optional arguments for the Transformers classifier
-    ) -> List[Sentence]: # Returns a list of `Sentence` predictions
+    ) -> Union[List[Sentence], SequenceResult]: # Returns a list of `Sentence` predictions, or a `SequenceResult` if `return_result`
         "Predict method for running inference using the pre-trained sequence classifier model"
-        id2label = self.model.config.id2label
         sentences = text
-        results: List[Sentence] = []
 
-        if not sentences: return sentences
+        if not sentences: return self._empty_result() if return_result else sentences
 
         if risinstance([DataPoint, str], sentences):
             sentences = [sentences]
@@ -149,83 +206,118 @@ class TransformersSequenceClassifier(AdaptiveModel):
         if isinstance(sentences[0], Sentence):
             sentences = [sentence for sentence in sentences if len(sentence) > 0]
         if len(sentences) == 0:
-            return sentences
+            return self._empty_result() if return_result else sentences
 
-        # reverse sort all sequences by their length
-        rev_order_len_index = sorted(
-            range(len(sentences)), key=lambda k: len(sentences[k]), reverse=True
+        # Turn all Sentence objects into strings
+        if isinstance(sentences[0], Sentence):
+            str_sentences = [sentence.to_original_text() for sentence in sentences]
+        else:
+            str_sentences = sentences
+
+        # The next chunk is tokenized and the last one decoded while the model runs on the current one
+        chunks = list(chunked(str_sentences, mini_batch_size * self.pipeline_batches))
+        stages = (
+            partial(self._tokenize_chunk, mini_batch_size=mini_batch_size, max_tokens_per_batch=max_tokens_per_batch),
+            self._forward_chunk,
+            partial(self._decode_chunk, as_sentences=not return_result),
         )
-        original_order_index = sorted(
-            range(len(rev_order_len_index)), key=lambda k: rev_order_len_index[k]
+        outputs = list(run_pipelined(chunks, *stages))
+        if not return_result: return [sentence for chunk in outputs for sentence in chunk]
+        return SequenceResult.from_probabilities(
+            [t for texts,_ in outputs for t in texts], torch.cat([probs for _,probs in outputs]), self._classes
         )
 
-        reordered_sentences: List[Union[DataPoint, str]] = [
-            sentences[index] for index in rev_order_len_index
-        ]
-
-        # Turn all Sentence objects into strings
-        if isinstance(reordered_sentences[0], Sentence):
-            str_reordered_sentences = [
-                sentence.to_original_text() for sentence in sentences
-            ]
-        else:
-            str_reordered_sentences = reordered_sentences
+    @timed_stage('tokenize')
+    def _tokenize_chunk(
+        self,
+        texts: List[str], # A chunk of texts
+        mini_batch_size: int = 32, # Mini batch size
+        max_tokens_per_batch: int = None, # Maximum number of tokens in a batch including padding
+    ) -> Tuple[List[str], List[int], DataLoader]: # The texts, the order they are batched in, and their padded batches
+        "Tokenizes `texts` and pads them into batches, the first stage of `predict`"
+        tokenized_text = self._tokenize(texts)
 
-        dataset = self._tokenize(str_reordered_sentences)
-        dl = DataLoader(dataset, batch_size=mini_batch_size)
-        predictions: List[Tuple[str, float]] = []
+        # reverse sort all sequences by their tokenized length
+        lengths = [len(input_ids) for input_ids in tokenized_text['input_ids']]
+        rev_order_len_index = sorted(
+            range(len(lengths)), key=lambda k: lengths[k], reverse=True
+        )
 
+        # Batches follow the sorted order, so each one is only padded to its own longest member
+        if max_tokens_per_batch is not None:
+            batches = token_budget_batches(rev_order_len_index, lengths, max_tokens_per_batch)
+        else:
+            batches = list(chunked(rev_order_len_index, mini_batch_size))
+        collate = PadCollate(self.tokenizer, self._input_keys)
+        padded = [collate([{k:tokenized_text[k][i] for k in self._input_keys} for i in batch]) for batch in batches]
+        record_batches([b[self._input_keys.index('attention_mask')] for b in padded])
+        return texts, [i for batch in batches for i in batch], DataLoader(padded, batch_size=None)
+
+    @timed_stage('forward')
+    def _forward_chunk(
+        self,
+        chunk: Tuple[List[str], List[int], DataLoader] # The output of `_tokenize_chunk`
+    ) -> Tuple[List[str], List[int], torch.Tensor]: # The texts, the order they were batched in, and their probabilities
+        "Runs the model on the batches of a chunk, the second stage of `predict`"
+        texts, order, dl = chunk
         outputs, _ = super().get_preds(dl=dl)
         logits = torch.cat([o['logits'] for o in outputs])
-        predictions = torch.softmax(logits, dim=1).tolist()
+        return texts, order, torch.softmax(logits, dim=1)
 
-        for text, pred in zip(str_reordered_sentences, predictions):
-            # Initialize and assign labels to each class in each datapoint prediction
-            text_sent = Sentence(text)
-            for k, v in id2label.items():
-                text_sent.add_label(typename='sc', value=v, score=pred[k])
-            results.append(text_sent)
+    @timed_stage('postprocess')
+    def _decode_chunk(
+        self,
+        chunk: Tuple[List[str], List[int], torch.Tensor], # The output of `_forward_chunk`
+        as_sentences: bool = True, # Whether to label a `Sentence` of each text, or only return the texts and probabilities
+    ) -> Union[List[Sentence], Tuple[List[str], torch.Tensor]]: # A `Sentence` prediction for each text, or the texts and probabilities, in their original order
+        "Puts the predictions of a chunk back in the order of its texts, labelling a `Sentence` of each, the last stage of `predict`"
+        texts, order, probs = chunk
+        ordered = torch.empty_like(probs)
+        ordered[torch.tensor(order, dtype=torch.long)] = probs
+        if not as_sentences: return texts, ordered
+        return _labelled_sentences(texts, ordered, self._classes)
 
-        # Order results back into original order
-        results = [results[index] for index in original_order_index]
+    @property
+    def _classes(self) -> List[str]:
+        "The name of every class, in the order of the model's outputs"
+        id2label = self.model.config.id2label
+        return [id2label[k] for k in sorted(id2label)]
 
-        return results
+    def _empty_result(self) -> SequenceResult:
+        "A `SequenceResult` without any texts"
+        classes = self._classes
+        return SequenceResult.from_probabilities([], torch.empty(0, len(classes)), classes)
+
+    @property
+    def _input_keys(self) -> List[str]:
+        "The tokenized values the model takes as inputs, in order"
+        # Bart, XLM, DistilBERT, RoBERTa, and XLM-RoBERTa don't use token_type_ids
+        if isinstance(
+            self.model,
+            (
+                BertForSequenceClassification,
+                XLNetForSequenceClassification,
+                AlbertForSequenceClassification,
+            ),
+        ):
+            return ['input_ids', 'attention_mask', 'token_type_ids']
+        return ['input_ids', 'attention_mask']
 
     def _tokenize(
         self, sentences: Union[List[Sentence], Sentence, List[str], str]
-    ) -> TensorDataset:
-        """ Batch tokenizes text and produces a `TensorDataset` with them """
+    ) -> BatchEncoding:
+        """ Batch tokenizes text without padding, which is done per batch by `PadCollate` """
 
         # TODO: __call__ from tokenizer base class in the transformers library could automate/handle this
         tokenized_text = self.tokenizer.batch_encode_plus(
             sentences,
-            return_tensors='pt',
             max_length=None,
             add_special_tokens=True,
-            padding=True,
+            padding=False,
             truncation=True
         )
 
-        # Bart, XLM, DistilBERT, RoBERTa, and XLM-RoBERTa don't use token_type_ids
-        if isinstance(
-            self.model,
-            (
-                BertForSequenceClassification,
-                XLNetForSequenceClassification,
-                AlbertForSequenceClassification,
-            ),
-        ):
-            dataset = TensorDataset(
-                tokenized_text['input_ids'],
-                tokenized_text['attention_mask'],
-                tokenized_text['token_type_ids'],
-            )
-        else:
-            dataset = TensorDataset(
-                tokenized_text['input_ids'], tokenized_text['attention_mask']
-            )
-
-        return dataset
+        return tokenized_text
 
 # Cell
 class FlairSequenceClassifier(AdaptiveModel):
@@ -260,11 +352,12 @@ class FlairSequenceClassifier(AdaptiveModel):
         if isinstance(text[0], str):
             text = [Sentence(s) for s in text]
 
-        self.classifier.predict(
-            sentences=text,
-            mini_batch_size=mini_batch_size,
-            **kwargs,
-        )
+        with timed_stage('forward'):
+            self.classifier.predict(
+                sentences=text,
+                mini_batch_size=mini_batch_size,
+                **kwargs,
+            )
 
         return text
 
@@ -276,10 +369,44 @@ class EasySequenceClassifier:
     "Easy module for sequence classifiers"
 
     def __init__(self):
-        self.sequence_classifiers: Dict[AdaptiveModel] = defaultdict(bool)
+        self.sequence_classifiers = CachedModels('sequence_classification')
         self.hf_hub = HFModelHub()
         self.flair_hub = FlairModelHub()
 
+    def _load(
+        self,
+        model_name_or_path: Union[str, FlairModelResult, HFModelResult] # The model name key or model path
+    ) -> AdaptiveModel: # The loaded classifier, or `None` if no model was found
+        "Loads a Flair or Transformers classifier from `model_name_or_path`, searching the model hubs for names that aren't a path"
+        name = getattr(model_name_or_path, 'name', model_name_or_path)
+        if risinstance([FlairModelResult, HFModelResult], model_name_or_path):
+            try:
+                return FlairSequenceClassifier.load(name)
+            except:
+                return TransformersSequenceClassifier.load(name)
+
+        elif risinstance([str, Path], model_name_or_path) and (Path(model_name_or_path).exists() and Path(model_name_or_path).is_dir()):
+            # Load in previously existing model
+            try:
+                return FlairSequenceClassifier.load(name)
+            except:
+                return TransformersSequenceClassifier.load(name)
+
+        else:
+            # Flair
+            res = self.flair_hub.search_model_by_name(name, user_uploaded=True)
+            if len(res) < 1:
+                # No models found
+                res = self.hf_hub.search_model_by_name(model_name_or_path, user_uploaded=True)
+                if len(res) < 1:
+                    logger.info("Not a valid `model_name_or_path` param")
+                    return None
+                else:
+                    return TransformersSequenceClassifier.load(res[0].name.replace('flairNLP', 'flair'))
+            else:
+                return FlairSequenceClassifier.load(res[0].name.replace('flairNLP/', '')) # Returning the first should always be non-fast
+
+    @instrumented()
     def tag_text(
         self,
         text: Union[List[Sentence], Sentence, List[str], str], # String, list of strings, `Sentence`, or list of `Sentence`s to be classified
@@ -290,54 +417,51 @@ class EasySequenceClassifier:
         **kwargs, # Keyword Arguments for Flair's `TextClassifier.predict()` method params
     ) -> List[Sentence]: # A list of Flair's `Sentence`'s
         "Tags a text sequence with labels the sequence classification models have been trained on"
-        # Load Text Classifier Model and Pytorch Module into tagger dict
-        name = getattr(model_name_or_path, 'name', model_name_or_path)
-        if not self.sequence_classifiers[name]:
-            """
-            self.sequence_classifiers[name] = TextClassifier.load(
-                model_name_or_path
-            )
-            """
-            if risinstance([FlairModelResult, HFModelResult], model_name_or_path):
-                try:
-                    self.sequence_classifiers[name] = FlairSequenceClassifier.load(name)
-                except:
-                    self.sequence_classifiers[name] = TransformersSequenceClassifier.load(name)
-
-            elif risinstance([str, Path], model_name_or_path) and (Path(model_name_or_path).exists() and Path(model_name_or_path).is_dir()):
-                # Load in previously existing model
-                try:
-                    self.sequence_classifiers[name] = FlairSequenceClassifier.load(name)
-                except:
-                    self.sequence_classifiers[name] = TransformersSequenceClassifier.load(name)
-
-            else:
-                # Flair
-                res = self.flair_hub.search_model_by_name(name, user_uploaded=True)
-                if len(res) < 1:
-                    # No models found
-                    res = self.hf_hub.search_model_by_name(model_name_or_path, user_uploaded=True)
-                    if len(res) < 1:
-                        logger.info("Not a valid `model_name_or_path` param")
-                        return [Sentence('')]
-                    else:
-                        name = res[0].name.replace('flairNLP', 'flair')
-                        self.sequence_classifiers[res[0].name] = TransformersSequenceClassifier.load(name)
-                else:
-                    name = res[0].name.replace('flairNLP/', '')
-                    self.sequence_classifiers[name] = FlairSequenceClassifier.load(name) # Returning the first should always be non-fast
-
-        classifier = self.sequence_classifiers[name]
+        with timed_stage('load'):
+            # Load Text Classifier Model and Pytorch Module into the shared model cache
+            name = getattr(model_name_or_path, 'name', model_name_or_path)
+            classifier = self.sequence_classifiers.get_or_load(name, partial(self._load, model_name_or_path))
+            if classifier is None: return [Sentence('')]
+        # Transformers classifiers can return their probabilities directly, skipping a `Sentence` per text
+        as_result = detail_level is not None and isinstance(classifier, TransformersSequenceClassifier)
+        if as_result: kwargs['return_result'] = True
         out = classifier.predict(
             text=text,
             mini_batch_size=mini_batch_size,
             **kwargs,
         )
         if detail_level is None: return out
+        with timed_stage('postprocess'):
+            if as_result:
+                out.class_names = class_names
+                res = out
+            else: res = SequenceResult(out, class_names)
+            return res.to_dict(detail_level)
+
+    def tag_text_sharded(
+        self,
+        text: Union[List[Sentence], List[str]], # A list of strings or `Sentence`s to be classified
+        model_name_or_path: Union[str, FlairModelResult, HFModelResult] = 'en-sentiment', # The model name key or model path
+        mini_batch_size: int = 32, # The mini batch size for running inference
+        detail_level:DetailLevel = DetailLevel.Low, # A level of detail to return
+        class_names:list = None, # A list of labels
+        num_workers: int = 4, # The number of worker processes
+        threads_per_worker: int = None, # The number of PyTorch threads in each worker. Defaults to splitting the cores evenly between the workers
+        **kwargs, # Keyword Arguments for Flair's `TextClassifier.predict()` method params
+    ) -> List[Sentence]: # A list of Flair's `Sentence`'s
+        "Tags text like `tag_text`, sharded across a pool of worker processes that each load the model once"
+        if isinstance(text, (Sentence, str)): text = [text]
+        if len(text) == 0: return text
+        shards = [(shard,) for shard in chunked(text, n_chunks=min(len(text), num_workers*4))]
+        out = run_sharded(
+            EasySequenceClassifier, 'tag_text', shards, num_workers, threads_per_worker,
+            model_name_or_path=model_name_or_path, mini_batch_size=mini_batch_size, detail_level=None, **kwargs
+        )
+        out = [sentence for shard in out for sentence in shard]
+        if detail_level is None: return out
         res = SequenceResult(out, class_names)
         return res.to_dict(detail_level)
 
-
     def tag_all(
         self,
         text: Union[List[Sentence], Sentence, List[str], str], # Text input, it can be a string or any of Flair's `Sentence` input formats
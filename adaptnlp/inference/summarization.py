@@ -4,8 +4,8 @@ __all__ = ['logger', 'TransformersSummarizer', 'EasySummarizer']
 
 # Cell
 import logging
-from typing import List, Dict, Union
-from collections import defaultdict
+from typing import List, Union
+from functools import partial
 
 import torch
 from torch.utils.data import TensorDataset, DataLoader
@@ -20,10 +20,12 @@ from transformers import (
 )
 
 from ..callback import GeneratorCallback
-from ..model import AdaptiveModel
+from ..model import AdaptiveModel, load_pretrained_model, run_pipelined
 from ..model_hub import HFModelResult, FlairModelResult
+from ..instrumentation import instrumented, timed_stage, record_batches
+from ..model_cache import CachedModels
 
-from fastcore.basics import store_attr
+from fastcore.basics import store_attr, chunked
 from fastcore.meta import delegates
 
 from fastai.callback.core import Callback, CancelBatchException
@@ -53,12 +55,15 @@ class TransformersSummarizer(AdaptiveModel):
     @classmethod
     def load(
         cls,
-        model_name_or_path: str # A key string of one of Transformer's pre-trained Summarizer Model
+        model_name_or_path: str, # A key string of one of Transformer's pre-trained Summarizer Model
+        quantize: str = None, # Set to 'dynamic-int8' to quantize the model's Linear layers for CPU inference, see `AdaptiveModel.quantize`
+        quantize_sample: List[str] = None, # Held-out texts to report the quantized model's agreement with the original on
     ) -> AdaptiveModel:
         "Class method for loading and constructing this classifier"
         tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
-        model = AutoModelForSeq2SeqLM.from_pretrained(model_name_or_path)
+        model = load_pretrained_model(AutoModelForSeq2SeqLM, model_name_or_path)
         summarizer = cls(tokenizer, model)
+        if quantize is not None: summarizer.quantize(quantize, quantize_sample)
         return summarizer
 
     def predict(
@@ -81,32 +86,57 @@ class TransformersSummarizer(AdaptiveModel):
         if isinstance(self.model, T5ForConditionalGeneration):
             text = [f'summarize: {t}' for t in text]
 
-        dataset = self._tokenize(text)
-        dl = DataLoader(dataset, batch_size=mini_batch_size)
-
-        summaries = []
-
-        logger.info(f'Running summarizer on {len(dataset)} text sequences')
+        logger.info(f'Running summarizer on {len(text)} text sequences')
         logger.info(f'Batch size = {mini_batch_size}')
 
         cb = GeneratorCallback(num_beams, min_length, max_length, early_stopping, **kwargs)
 
-        preds,_ = super().get_preds(dl=dl, cbs=[cb])
+        # The next chunk is tokenized and the last one decoded while the model generates the current one
+        chunks = list(chunked(text, mini_batch_size * self.pipeline_batches))
+        stages = (
+            partial(self._tokenize_chunk, mini_batch_size=mini_batch_size),
+            partial(self._forward_chunk, cbs=[cb]),
+            self._decode_chunk,
+        )
+        summaries = [summary for chunk in run_pipelined(chunks, *stages) for summary in chunk]
 
-        preds = apply(lambda x: x.squeeze(0), preds)
+        return {'summaries':summaries}
 
-        for o in preds:
-            summaries.append(
-                [
-                    self.tokenizer.decode(
-                        o,
-                        skip_special_tokens=True,
-                        clean_up_tokenization_spaces=False,
-                    )
-                ].pop()
+    @timed_stage('tokenize')
+    def _tokenize_chunk(
+        self,
+        texts: List[str], # A chunk of texts
+        mini_batch_size: int = 32, # Mini batch size
+    ) -> DataLoader:
+        "Tokenizes `texts` into mini batches, the first stage of `predict`"
+        dataset = self._tokenize(texts)
+        record_batches(dataset.tensors[1].split(mini_batch_size))
+        return DataLoader(dataset, batch_size=mini_batch_size)
+
+    @timed_stage('forward')
+    def _forward_chunk(
+        self,
+        dl: DataLoader, # The output of `_tokenize_chunk`
+        cbs: list = [], # The `GeneratorCallback` to generate with
+    ) -> list: # The generated token ids
+        "Generates the summaries of a chunk, the second stage of `predict`"
+        preds,_ = super().get_preds(dl=dl, cbs=cbs)
+        return apply(lambda x: x.squeeze(0), preds)
+
+    @timed_stage('postprocess')
+    def _decode_chunk(
+        self,
+        preds: list # The output of `_forward_chunk`
+    ) -> List[str]: # The decoded summaries
+        "Decodes the generated token ids of a chunk, the last stage of `predict`"
+        return [
+            self.tokenizer.decode(
+                o,
+                skip_special_tokens=True,
+                clean_up_tokenization_spaces=False,
             )
-
-        return {'summaries':summaries}
+            for o in preds
+        ]
 
     def _tokenize(self, text: Union[List[str], str]) -> TensorDataset:
         "Batch tokenizes text and produces a `TensorDataset` with text"
@@ -140,8 +170,9 @@ class TransformersSummarizer(AdaptiveModel):
 class EasySummarizer:
     "Summarization Module"
     def __init__(self):
-        self.summarizers: Dict[AdaptiveModel] = defaultdict(bool)
+        self.summarizers = CachedModels('summarization')
 
+    @instrumented()
     def summarize(
         self,
         text: Union[List[str], str], # Sentences to run inference on
@@ -155,12 +186,8 @@ class EasySummarizer:
     ) -> List[str]: # A list of predicted summaries
         "Predict method for running inference using the pre-trained sequence classifier model"
         name = getattr(model_name_or_path, 'name', model_name_or_path)
-        if not self.summarizers[name]:
-            self.summarizers[name] = TransformersSummarizer.load(
-                name
-            )
-
-        summarizer = self.summarizers[name]
+        with timed_stage('load'):
+            summarizer = self.summarizers.get_or_load(name, partial(TransformersSummarizer.load, name))
         return summarizer.predict(
             text=text,
             mini_batch_size=mini_batch_size,
@@ -5,7 +5,7 @@ __all__ = ['logger', 'TransformersTextGenerator', 'EasyTextGenerator']
 # Cell
 import logging
 from typing import List, Dict, Union
-from collections import defaultdict
+from functools import partial
 
 import torch
 from torch.utils.data import TensorDataset
@@ -19,11 +19,15 @@ from transformers import (
 
 from fastprogress.fastprogress import progress_bar
 
-from ..model import AdaptiveModel, DataLoader
+from ..model import AdaptiveModel, DataLoader, load_pretrained_model, run_pipelined
 from ..model_hub import HFModelResult
+from ..instrumentation import instrumented, timed_stage, record_batches
+from ..model_cache import CachedModels
 
 from fastai.torch_core import apply, default_device, to_device
 
+from fastcore.basics import chunked
+
 # Cell
 logger = logging.getLogger(__name__)
 
@@ -50,12 +54,15 @@ class TransformersTextGenerator(AdaptiveModel):
     @classmethod
     def load(
         cls,
-        model_name_or_path: str # A key string of one of Transformer's pre-trained Language Model
+        model_name_or_path: str, # A key string of one of Transformer's pre-trained Language Model
+        quantize: str = None, # Set to 'dynamic-int8' to quantize the model's Linear layers for CPU inference, see `AdaptiveModel.quantize`
+        quantize_sample: List[str] = None, # Held-out texts to report the quantized model's agreement with the original on
     ) -> AdaptiveModel:
         "Class method for loading and constructing this Model"
         tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, pad_token="<PAD>")
-        model = AutoModelForCausalLM.from_pretrained(model_name_or_path)
+        model = load_pretrained_model(AutoModelForCausalLM, model_name_or_path)
         generator = cls(tokenizer, model)
+        if quantize is not None: generator.quantize(quantize, quantize_sample)
         return generator
 
     def predict(
@@ -65,19 +72,48 @@ class TransformersTextGenerator(AdaptiveModel):
         num_tokens_to_produce: int = 50, # Number of tokens you want to generate
     ) -> List[str]: # A list of predicted sentences
         "Predict method for running inference using the pre-trained sequence classifier model.  Keyword arguments for parameters of the method `Transformers.PreTrainedModel.generate()` can be used as well."
-        with torch.no_grad():
-
-            # Make all inputs lists
-            if isinstance(text, str):
-                text = [text]
+        # Make all inputs lists
+        if isinstance(text, str):
+            text = [text]
+
+        logger.info(f'Running text generator on {len(text)} text sequences')
+        logger.info(f'Batch size = {mini_batch_size}')
+
+        # The next chunk is tokenized and the last one decoded while the model generates the current one
+        chunks = list(chunked(text, mini_batch_size * self.pipeline_batches))
+        stages = (
+            partial(self._tokenize_chunk, mini_batch_size=mini_batch_size),
+            partial(self._forward_chunk, num_tokens_to_produce=num_tokens_to_produce),
+            self._decode_chunk,
+        )
+        results = []
+        for generated_text in progress_bar(run_pipelined(chunks, *stages), total=len(chunks)):
+            results += generated_text
 
-            dataset = self._tokenize(text)
-            dataloader = DataLoader(dataset, batch_size=mini_batch_size)
-            results = []
+        return {"generated_text":results}
 
-            logger.info(f'Running text generator on {len(dataset)} text sequences')
-            logger.info(f'Batch size = {mini_batch_size}')
-            for batch in progress_bar(dataloader):
+    @timed_stage('tokenize')
+    def _tokenize_chunk(
+        self,
+        texts: List[str], # A chunk of texts
+        mini_batch_size: int = 32, # Mini batch size
+    ) -> DataLoader:
+        "Tokenizes `texts` into mini batches, the first stage of `predict`"
+        dataset = self._tokenize(texts)
+        record_batches(dataset.tensors[1].split(mini_batch_size))
+        return DataLoader(dataset, batch_size=mini_batch_size)
+
+    @timed_stage('forward')
+    def _forward_chunk(
+        self,
+        dataloader: DataLoader, # The output of `_tokenize_chunk`
+        num_tokens_to_produce: int = 50, # Number of tokens you want to generate
+    ) -> List[torch.Tensor]: # The prompt and generated token ids of every mini batch
+        "Generates text for the mini batches of a chunk, the second stage of `predict`"
+        outputs = []
+        # `torch.no_grad` only applies to the thread it is entered in, which is not the one calling `predict`
+        with torch.no_grad():
+            for batch in dataloader:
                 self.model.eval()
                 batch = apply(to_device, batch)
 
@@ -93,14 +129,24 @@ class TransformersTextGenerator(AdaptiveModel):
                         'attention_masks': batch[1],
                     }
                 # model.generate() does not have batch inference implemented yet
-                generated_text = self._batch_generate(
+                outputs.append(self._batch_generate_ids(
                     inputs=inputs,
                     seq_len=batch[0].shape[1],
                     num_tokens_to_produce=num_tokens_to_produce,
-                )
-                results += generated_text
+                ))
+        return outputs
 
-        return {"generated_text":results}
+    @timed_stage('postprocess')
+    def _decode_chunk(
+        self,
+        outputs: List[torch.Tensor] # The output of `_forward_chunk`
+    ) -> List[str]: # The generated texts
+        "Decodes the generated token ids of a chunk, the last stage of `predict`"
+        return [
+            self.tokenizer.decode(output, skip_special_tokens=True)
+            for input_ids in outputs
+            for output in input_ids
+        ]
 
     def _tokenize(self, text: Union[List[str], str]) -> TensorDataset:
         """ Batch tokenizes text and produces a `TensorDataset` with text """
@@ -122,6 +168,15 @@ class TransformersTextGenerator(AdaptiveModel):
         self, inputs: Dict, seq_len: int, num_tokens_to_produce: int
     ) -> List[str]:
         """Generates text data with varying text sizes"""
+        return [
+            self.tokenizer.decode(output, skip_special_tokens=True)
+            for output in self._batch_generate_ids(inputs, seq_len, num_tokens_to_produce)
+        ]
+
+    def _batch_generate_ids(
+        self, inputs: Dict, seq_len: int, num_tokens_to_produce: int
+    ) -> torch.Tensor:
+        """Generates the token ids of text data with varying text sizes, including the prompt"""
         input_ids = inputs["input_ids"]
         attn_mask = inputs["attention_masks"]
 
@@ -179,18 +234,16 @@ class TransformersTextGenerator(AdaptiveModel):
                 [position_ids, (position_ids[:, -1] + 1).unsqueeze(-1)], dim=1
             )
 
-        return [
-            self.tokenizer.decode(output, skip_special_tokens=True)
-            for output in input_ids
-        ]
+        return input_ids
 
 # Cell
 class EasyTextGenerator:
     "Text Generation Module"
 
     def __init__(self):
-        self.generators: Dict[AdaptiveModel] = defaultdict(bool)
+        self.generators = CachedModels('text_generation')
 
+    @instrumented()
     def generate(
         self,
         text: Union[List[str], str], # List of sentences to run inference on
@@ -200,12 +253,8 @@ class EasyTextGenerator:
     ) -> List[str]: # A list of predicted sentences
         "Predict method for running inference using the pre-trained sequence classifier model. Keyword arguments for parameters of the method `Transformers.PreTrainedModel.generate()` can be used as well."
         name = getattr(model_name_or_path, 'name', model_name_or_path)
-        if not self.generators[name]:
-            self.generators[name] = TransformersTextGenerator.load(
-                name
-            )
-
-        generator = self.generators[name]
+        with timed_stage('load'):
+            generator = self.generators.get_or_load(name, partial(TransformersTextGenerator.load, name))
         return generator.predict(
             text=text,
             mini_batch_size=mini_batch_size,
@@ -3,16 +3,18 @@
 __all__ = ['logger', 'TokenClassificationResult', 'TransformersTokenTagger', 'FlairTokenTagger', 'EasyTokenTagger']
 
 # Cell
-import logging
-from typing import List, Dict, Union
-from collections import defaultdict, OrderedDict
+import inspect, logging
+from typing import List, Dict, Union, Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from functools import partial
 
 import numpy as np
 
 import torch
-from torch.utils.data import TensorDataset
 
-from flair.data import Sentence
+from flair.data import Sentence, Token
 from flair.models import SequenceTagger
 from flair.tokenization import SegtokSentenceSplitter
 
@@ -21,19 +23,20 @@ from transformers import (
     AutoModelForTokenClassification,
     PreTrainedTokenizer,
     PreTrainedModel,
-    BertForSequenceClassification,
-    XLNetForSequenceClassification,
-    AlbertForSequenceClassification,
+    BatchEncoding,
 )
 
 from ..result import DetailLevel
 
-from ..model import AdaptiveModel, DataLoader
+from ..model import AdaptiveModel, DataLoader, PadCollate, load_pretrained_model, run_sharded, run_pipelined
 from ..model_hub import HFModelResult, FlairModelResult, FlairModelHub, HFModelHub
+from ..instrumentation import instrumented, timed_stage, record_batches
+from ..model_cache import CachedModels
+from .utils import _context_windows
 
-from fastai.torch_core import to_detach, apply, to_device
+from fastai.torch_core import to_detach
 
-from fastcore.basics import Self, risinstance, filter_ex, listify
+from fastcore.basics import risinstance, listify, chunked
 from fastcore.xtras import Path
 
 # Cell
@@ -92,13 +95,16 @@ class TransformersTokenTagger(AdaptiveModel):
     @classmethod
     def load(
         cls,
-        model_name_or_path: str # A key string of one of Transformer's pre-trained Token Tagger Model or a `HFModelResult`
+        model_name_or_path: str, # A key string of one of Transformer's pre-trained Token Tagger Model or a `HFModelResult`
+        quantize: str = None, # Set to 'dynamic-int8' to quantize the model's Linear layers for CPU inference, see `AdaptiveModel.quantize`
+        quantize_sample: List[str] = None, # Held-out texts to report the quantized model's agreement with the original on
     ) -> AdaptiveModel:
         "Class method for loading and constructing this tagger"
         if isinstance(model_name_or_path, HFModelResult): model_name_or_path = model_name_or_path.name
         tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
-        model = AutoModelForTokenClassification.from_pretrained(model_name_or_path)
+        model = load_pretrained_model(AutoModelForTokenClassification, model_name_or_path)
         tagger = cls(tokenizer, model)
+        if quantize is not None: tagger.quantize(quantize, quantize_sample)
         return tagger
 
     def predict(
@@ -107,166 +113,238 @@ class TransformersTokenTagger(AdaptiveModel):
         mini_batch_size: int = 32, # Mini batch size
         grouped_entities: bool = True, # Return whole entity span strings
         detail_level:DetailLevel = DetailLevel.Low, # A level of detail to return
+        doc_stride: int = None, # If set, texts longer than the model takes are tagged in overlapping windows this many tokens apart instead of being truncated
         **kwargs, # Optional arguments for the Transformers tagger
     ) -> List[List[Dict]]: # Returns a list of lists of tagged entities
-        "Predict method for running inference using the pre-trained token tagger model"
+        """Predict method for running inference using the pre-trained token tagger model
+
+        With `doc_stride`, every token is tagged from the window with the most context on both sides of it,
+        and entities also get the `start` and `end` of their characters in the text
+        """
         if isinstance(text, str):
             text = [text]
-        results: List[Dict] = []
-
-        dataset = self._tokenize(text)
-        dl = DataLoader(dataset, batch_size=mini_batch_size)
-
-        logger.info(f'Running prediction on {len(dataset)} text sequences')
+        logger.info(f'Running prediction on {len(text)} text sequences')
         logger.info(f'Batch size = {mini_batch_size}')
 
-        outputs,_ = super().get_preds(dl=dl)
-
-        inputs = apply(to_device, [b for b in dl], device='cpu')
-        inputs = torch.cat(*inputs)
-        inputs = apply(Self.numpy(), inputs)
-
-        outputs = torch.cat([o['logits'] for o in outputs])
-        outputs = apply(to_detach, outputs, cpu=True)
-        outputs = apply(Self.numpy(), outputs)
-
-        # Iterate through batch for tagged token predictions
-        for idx, pred in enumerate(outputs):
-            entities = pred
-            input_ids = inputs[idx]
-            tagged_entities = self._generate_tagged_entities(
-                entities=entities,
-                input_ids=input_ids,
-                grouped_entities=grouped_entities
+        # The next chunk is tokenized and the last one decoded while the model runs on the current one
+        if doc_stride is None:
+            chunks = list(chunked(text, mini_batch_size * self.pipeline_batches))
+            stages = (
+                partial(self._tokenize_chunk, mini_batch_size=mini_batch_size),
+                self._forward_chunk,
+                partial(self._decode_chunk, grouped_entities=grouped_entities),
+            )
+        else:
+            # A long document can make many windows, so fewer of them are held at once
+            chunks = list(chunked(text, self.pipeline_batches))
+            stages = (
+                partial(self._window_chunk, mini_batch_size=mini_batch_size, doc_stride=doc_stride),
+                self._forward_chunk,
+                partial(self._decode_windows, grouped_entities=grouped_entities),
             )
-            results += tagged_entities
+        inputs, results = [], []
+        for chunk_inputs, chunk_results in run_pipelined(chunks, *stages):
+            inputs += chunk_inputs
+            results += chunk_results
 
         results = TokenClassificationResult(text, inputs, results)
 
         return results.to_dict(detail_level) if detail_level is not None else detail_level
 
+    @timed_stage('tokenize')
+    def _tokenize_chunk(
+        self,
+        texts: List[str], # A chunk of texts
+        mini_batch_size: int = 32, # Mini batch size
+    ) -> Tuple[List[int], DataLoader]: # The order the texts are batched in, and their padded batches
+        "Tokenizes `texts` and pads them into batches, the first stage of `predict`"
+        tokenized_text = self._tokenize(texts)
+        return self._pad_batches(
+            [{k:tokenized_text[k][i] for k in self._input_keys} for i in range(len(texts))], mini_batch_size
+        )
+
+    @timed_stage('tokenize')
+    def _window_chunk(
+        self,
+        texts: List[str], # A chunk of texts
+        mini_batch_size: int = 32, # Mini batch size
+        doc_stride: int = 128, # Number of tokens between the starts of two windows of the same text
+    ) -> Tuple[Tuple[list, List[int]], DataLoader]: # The tokens and windows of every text with the order the windows are batched in, and their padded batches
+        "Tokenizes `texts` and splits them into overlapping windows the model takes, padded into batches, the first stage of `predict` for long documents"
+        if not self.tokenizer.is_fast: raise ValueError('Tagging long documents needs a fast tokenizer, for the characters of every token')
+        encoding = self.tokenizer(texts, add_special_tokens=False, return_offsets_mapping=True)
+        max_length = min(self.tokenizer.model_max_length, getattr(self.model.config, 'max_position_embeddings', self.tokenizer.model_max_length))
+        window_length = max_length - self.tokenizer.num_special_tokens_to_add()
+        docs, windows = [], []
+        for ids, offsets in zip(encoding['input_ids'], encoding['offset_mapping']):
+            spans, best = _context_windows(len(ids), window_length, doc_stride) if ids else ([(0, 0)], np.zeros(0, dtype=int))
+            docs.append((ids, offsets, spans, best))
+            for start, length in spans:
+                content = ids[start:start + length]
+                window = {
+                    'input_ids': self.tokenizer.build_inputs_with_special_tokens(content),
+                    'token_type_ids': self.tokenizer.create_token_type_ids_from_sequences(content),
+                }
+                window['attention_mask'] = [1] * len(window['input_ids'])
+                windows.append({k:window[k] for k in self._input_keys})
+        order, dl = self._pad_batches(windows, mini_batch_size)
+        return (docs, order), dl
+
+    def _pad_batches(
+        self,
+        items: List[dict], # The tokenized values of every text, without padding
+        mini_batch_size: int = 32, # Mini batch size
+    ) -> Tuple[List[int], DataLoader]: # The order the items are batched in, and their padded batches
+        "Pads `items` into batches, each only as long as its own longest member"
+        # Batches follow the items from longest to shortest
+        lengths = [len(item['input_ids']) for item in items]
+        order = sorted(range(len(lengths)), key=lambda k: lengths[k], reverse=True)
+        collate = PadCollate(self.tokenizer, self._input_keys)
+        padded = [collate([items[i] for i in batch]) for batch in chunked(order, mini_batch_size)]
+        record_batches([b[1] for b in padded])
+        return order, DataLoader(padded, batch_size=None)
+
+    @timed_stage('forward')
+    def _forward_chunk(
+        self,
+        chunk: Tuple[list, DataLoader] # The output of `_tokenize_chunk` or `_window_chunk`
+    ) -> Tuple[list, List[Tuple[np.ndarray, np.ndarray, np.ndarray]]]: # What was batched in which order, and the input ids, attention mask, and logits of every batch
+        "Runs the model on the batches of a chunk, the second stage of `predict`"
+        order, dl = chunk
+        outputs,_ = super().get_preds(dl=dl)
+        return order, [
+            (batch[0].numpy(), batch[1].numpy(), to_detach(output['logits'], cpu=True).numpy())
+            for batch, output in zip(dl.dataset, outputs)
+        ]
+
+    @timed_stage('postprocess')
+    def _decode_chunk(
+        self,
+        chunk: Tuple[List[int], List[Tuple[np.ndarray, np.ndarray, np.ndarray]]], # The output of `_forward_chunk`
+        grouped_entities: bool = True, # Return whole entity span strings
+    ) -> Tuple[List[np.ndarray], List[List[Dict]]]: # The input ids and tagged entities of every text, in their original order
+        "Tags the entities of every text of a chunk and puts them back in the order of the texts, the last stage of `predict`"
+        order, batches = chunk
+        inputs, results = [None] * len(order), [None] * len(order)
+        indexes = iter(order)
+        for input_ids, attention_mask, logits in batches:
+            entities = self._decode_entities(logits, input_ids, grouped_entities=grouped_entities, attention_mask=attention_mask)
+            for ids, mask, tagged in zip(input_ids, attention_mask.astype(bool), entities):
+                i = next(indexes)
+                inputs[i], results[i] = ids[mask], tagged
+        return inputs, results
+
+    @timed_stage('postprocess')
+    def _decode_windows(
+        self,
+        chunk: Tuple[Tuple[list, List[int]], List[Tuple[np.ndarray, np.ndarray, np.ndarray]]], # The output of `_forward_chunk` for `_window_chunk`
+        grouped_entities: bool = True, # Return whole entity span strings
+    ) -> Tuple[List[np.ndarray], List[List[Dict]]]: # The input ids and tagged entities of every text, in their original order
+        "Tags the entities of every text of a chunk from the windows with the most context around each token, the last stage of `predict` for long documents"
+        (docs, order), batches = chunk
+        windows, indexes = [None] * len(order), iter(order)
+        for _, attention_mask, logits in batches:
+            for mask, window in zip(attention_mask.astype(bool), logits): windows[next(indexes)] = window[mask]
+        n_prefix = self.tokenizer.build_inputs_with_special_tokens([-1]).index(-1)
+
+        inputs, results, first = [], [], 0
+        for ids, offsets, spans, best in docs:
+            doc_windows = windows[first:first + len(spans)]
+            first += len(spans)
+            # The logits of every token, from its best window
+            starts, lengths = np.array(spans).T
+            content = np.concatenate([w[n_prefix:n_prefix + n] for w, n in zip(doc_windows, lengths)])
+            positions = (np.cumsum(lengths) - lengths)[best] + np.arange(len(ids)) - starts[best]
+            doc_ids = np.array(self.tokenizer.build_inputs_with_special_tokens(ids))
+            n_suffix = len(doc_ids) - n_prefix - len(ids)
+            # The special tokens around the text are tagged from the first and last windows
+            logits = np.concatenate([doc_windows[0][:n_prefix], content[positions], doc_windows[-1][len(doc_windows[-1]) - n_suffix:]])
+            # The special tokens are empty, at the start and end of the text, so entities that include them still span their text
+            offsets = np.array(offsets, dtype=int).reshape(-1, 2)
+            text_start, text_end = (offsets[0, 0], offsets[-1, 1]) if len(offsets) else (0, 0)
+            offsets = np.concatenate([np.full((n_prefix, 2), text_start), offsets, np.full((n_suffix, 2), text_end)])
+            inputs.append(doc_ids)
+            results += self._decode_entities(logits[None], doc_ids[None], grouped_entities=grouped_entities, offsets=offsets[None])
+        return inputs, results
+
+    @property
+    def _input_keys(self) -> List[str]:
+        "The tokenized values the model takes as inputs, in order"
+        # Batches are passed positionally, so `token_type_ids` are only passed to models taking them right after the attention mask,
+        # which DistilBERT and XLNet don't, and only if the tokenizer makes them, which the RoBERTa one doesn't
+        params = list(inspect.signature(self.model.forward).parameters)
+        if params[2:3] == ['token_type_ids'] and 'token_type_ids' in self.tokenizer.model_input_names:
+            return ['input_ids', 'attention_mask', 'token_type_ids']
+        return ['input_ids', 'attention_mask']
+
     def _tokenize(
         self, sentences: Union[List[Sentence], Sentence, List[str], str]
-    ) -> TensorDataset:
-        "Batch tokenizes text and produces a `TensorDataset` with them"
-
-        tokenized_text = self.tokenizer.batch_encode_plus(
+    ) -> BatchEncoding:
+        "Batch tokenizes text without padding, which is done per batch by `PadCollate`, truncating texts longer than the model takes"
+        return self.tokenizer.batch_encode_plus(
             sentences,
-            return_tensors="pt",
             max_length=None,
+            add_special_tokens=True,
+            padding=False,
+            truncation=True,
         )
 
-        # Bart, XLM, DistilBERT, RoBERTa, and XLM-RoBERTa don't use token_type_ids
-        if isinstance(
-            self.model,
-            (
-                BertForSequenceClassification,
-                XLNetForSequenceClassification,
-                AlbertForSequenceClassification,
-            ),
-        ):
-            dataset = TensorDataset(
-                tokenized_text["input_ids"],
-                tokenized_text["attention_mask"],
-                tokenized_text["token_type_ids"],
-            )
-        else:
-            dataset = TensorDataset(
-                tokenized_text["input_ids"], tokenized_text["attention_mask"]
-            )
-
-        return dataset
-
-    # `_group_entites` and `_generate_tagged_entities` modified from pipeline code snippet from Transformers
-    def _group_entities(
-        self, entities: List[dict], idx_start: int, idx_end: int
-    ) -> Dict:
-        """Returns grouped entities"""
-        # Get the last entity in the entity group
-        entity = entities[-1]["entity"]
-        scores = np.mean([entity["score"] for entity in entities])
-        tokens = [entity["word"] for entity in entities]
-
-        entity_group = {
-            "entity": entity,
-            "score": np.mean(scores),
-            "word": self.tokenizer.convert_tokens_to_string(tokens),
-            "offsets": (idx_start, idx_end),
-        }
-        return entity_group
-
-    def _generate_tagged_entities(
-        self, entities: np.ndarray, input_ids: np.ndarray, grouped_entities: bool = True
-    ) -> List[Dict]:
-        """Generate full list of entities given tagged token predictions and input_ids"""
-
-        score = np.exp(entities) / np.exp(entities).sum(-1, keepdims=True)
-        labels_idx = score.argmax(axis=-1)
-
-        answers = []
-        entities = []
-        entity_groups = []
-        entity_group_disagg = []
-        # Filter to labels not in `self.ignore_labels`
-        filtered_labels_idx = [
-            (idx, label_idx)
-            for idx, label_idx in enumerate(labels_idx)
-            if self.model.config.id2label[label_idx] not in ["O"]
-        ]
-
-        for idx, label_idx in filtered_labels_idx:
-            # print(tokenizer.convert_ids_to_tokens(int(input_ids[idx])))
-            entity = {
-                "word": self.tokenizer.convert_ids_to_tokens(int(input_ids[idx])),
-                "score": score[idx][label_idx].item(),
-                "entity": self.model.config.id2label[label_idx],
-                "index": idx,
+    # Decodes like the `ner` pipeline of Transformers, grouping adjacent tokens with the same label
+    def _decode_entities(
+        self,
+        logits: np.ndarray, # The logits of every token of a batch of texts
+        input_ids: np.ndarray, # The input ids of the texts
+        grouped_entities: bool = True, # Return whole entity span strings
+        attention_mask: np.ndarray = None, # Which tokens of the texts aren't padding, if they are padded
+        offsets: np.ndarray = None, # The character offsets of the tokens in the texts, to give entities their `start` and `end`
+    ) -> List[List[Dict]]: # The tagged entities of every text
+        "Tags the entities of a batch of texts at once, from one softmax over all of their tokens"
+        scores = np.exp(logits)
+        scores /= scores.sum(-1, keepdims=True)
+        labels = scores.argmax(-1)
+        id2label = self.model.config.id2label
+        names = np.array([id2label[i] for i in range(logits.shape[-1])], dtype=object)
+        # Every token that isn't outside of an entity, text by text
+        tagged = names[labels] != 'O'
+        if attention_mask is not None: tagged &= attention_mask.astype(bool)
+        rows, cols = np.nonzero(tagged)
+        if not len(rows): return [[] for _ in logits]
+        labels = labels[rows, cols]
+        entity_scores = scores[rows, cols, labels]
+        words = self.tokenizer.convert_ids_to_tokens(input_ids[rows, cols].tolist())
+        chars = offsets[rows, cols].tolist() if offsets is not None else None
+        # Tokens are indexed from the first one that isn't padding
+        if attention_mask is not None: cols = cols - attention_mask.argmax(-1)[rows]
+        bounds = np.searchsorted(rows, np.arange(len(logits) + 1))
+
+        if not grouped_entities:
+            entities = [
+                {'word': word, 'score': score, 'entity': names[label], 'index': index}
+                for word, score, label, index in zip(words, entity_scores.tolist(), labels.tolist(), cols.tolist())
+            ]
+            if chars is not None:
+                for entity, (start, end) in zip(entities, chars): entity.update(start=start, end=end)
+            return [entities[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+
+        # A group starts at the first entity of a text, and wherever the label changes or a token is skipped
+        starts = np.ones(len(rows), dtype=bool)
+        starts[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1] + 1) | (labels[1:] != labels[:-1])
+        firsts, lasts = np.flatnonzero(starts), np.flatnonzero(np.r_[starts[1:], True])
+        sizes = lasts - firsts + 1
+        group_scores = np.add.reduceat(entity_scores.astype(np.float64), firsts) / sizes
+        groups = [
+            {
+                'entity': names[labels[last]],
+                'score': score,
+                'word': self.tokenizer.convert_tokens_to_string(words[first:last + 1]),
+                'offsets': (end - size, end),
             }
-            last_idx, _ = filtered_labels_idx[-1]
-            if grouped_entities:
-                if not entity_group_disagg:
-                    entity_group_disagg += [entity]
-                    if idx == last_idx:
-                        entity_groups += [
-                            self._group_entities(
-                                entity_group_disagg, idx - len(entity_group_disagg), idx
-                            )
-                        ]
-                    continue
-
-                # If the current entity is similar and adjacent to the previous entity, append it to the disaggregated entity group
-                if (
-                    entity["entity"] == entity_group_disagg[-1]["entity"]
-                    and entity["index"] == entity_group_disagg[-1]["index"] + 1
-                ):
-                    entity_group_disagg += [entity]
-                    # Group the entities at the last entity
-                    if idx == last_idx:
-                        entity_groups += [
-                            self._group_entities(
-                                entity_group_disagg, idx - len(entity_group_disagg), idx
-                            )
-                        ]
-                # If the current entity is different from the previous entity, aggregate the disaggregated entity group
-                else:
-                    entity_groups += [
-                        self._group_entities(
-                            entity_group_disagg,
-                            entity_group_disagg[-1]["index"] - len(entity_group_disagg),
-                            entity_group_disagg[-1]["index"],
-                        )
-                    ]
-                    entity_group_disagg = [entity]
-
-            entities += [entity]
-
-        # Append
-        if grouped_entities:
-            answers += [entity_groups]
-        else:
-            answers += [entities]
-
-        return answers
+            for first, last, size, score, end in zip(firsts, lasts, sizes.tolist(), group_scores, cols[lasts].tolist())
+        ]
+        if chars is not None:
+            for group, first, last in zip(groups, firsts, lasts): group.update(start=chars[first][0], end=chars[last][1])
+        group_bounds = np.searchsorted(firsts, bounds)
+        return [groups[a:b] for a, b in zip(group_bounds[:-1], group_bounds[1:])]
 
 # Cell
 class FlairTokenTagger(AdaptiveModel):
@@ -289,52 +367,45 @@ class FlairTokenTagger(AdaptiveModel):
         return tagger
 
     def _split_articles(self, tagged_articles):
-        "Takes merged NER results and splits them back out into their original articles"
+        "Takes the tagged sentences of every article and joins each article's back together with their entities"
         all_payloads = []
         for article in tagged_articles:
-            payload = [sentence.to_dict(tag_type=self.tagger.tag_type) for sentence in article]
-            curr_pos = 0
-            new_payload = {}
-            new_payload['entities'] = []
-            new_payload['labels'] = []
-            text = ''
-            for i, pay in enumerate(payload):
-                entities = pay['entities']
-                for e in entities:
-                    labels = e['labels']
-                    d = labels[0].to_dict()
+            entities, parts, curr_length = [], [], 0
+            for sentence in article:
+                pay = sentence.to_dict(tag_type=self.tagger.tag_type)
+                for e in pay['entities']:
+                    d = e['labels'][0].to_dict()
                     e['value'] = d['value']
                     e['confidence'] = d['confidence']
-
-                if i > 0:
-                    for e in entities:
-                        # Get back the original positions
-                        e['start_pos'] += curr_length
-                        e['end_pos'] += curr_length
-
-                text += pay['text'] + ' '
-                curr_length = len(text)
-                new_payload['entities'] += entities
-            new_payload['text'] = text
-            all_payloads.append(new_payload)
+                    # Get back the positions in the joined article
+                    e['start_pos'] += curr_length
+                    e['end_pos'] += curr_length
+                entities += pay['entities']
+                parts.append(pay['text'] + ' ')
+                curr_length += len(parts[-1])
+            all_payloads.append({'entities': entities, 'labels': [], 'text': ''.join(parts)})
         return all_payloads
 
     def decode_articles(
         self,
         original_text: Union[List[str], str], # Original text inference was run on
-        sentences: List[Sentence] # Sentences inference was run on
+        sentences: List[Sentence] # Sentences inference was run on, in the order of the text
     ) -> List[dict]:
         "Decodes `text` back into articles and extracts entities"
         if not isinstance(original_text, list):
             original_text = [original_text]
-        for i,sentence in enumerate(original_text):
-            if isinstance(sentence, Sentence):
-                text[i] = sentence.to_original_text()
+        original_text = [t.to_original_text() if isinstance(t, Sentence) else t for t in original_text]
+        # Each sentence is looked for after the last one, in the same article or the next ones, so repeated sentences stay in their own articles
         tagged_articles = [[] for _ in range(len(original_text))]
+        article, pos = 0, 0
         for sentence in sentences:
-            for i, article in enumerate(original_text):
-                if sentence.to_original_text() in article:
+            text = sentence.to_original_text()
+            for i in range(article, len(original_text)):
+                start = original_text[i].find(text, pos if i == article else 0)
+                if start != -1:
+                    article, pos = i, start + len(text)
                     tagged_articles[i].append(sentence)
+                    break
         return self._split_articles(tagged_articles)
 
     def predict(
@@ -347,25 +418,88 @@ class FlairTokenTagger(AdaptiveModel):
         "Predict method for running inference using the pre-trained token tagger model"
         if not isinstance(text, list):
             text = [text]
-        for i,sentence in enumerate(text):
-            if isinstance(sentence, Sentence):
-                text[i] = sentence.to_original_text()
-        tagged_articles = [[] for _ in range(len(text))]
-        t = '\n'.join(text)
-        sentences = self.splitter.split(t)
-        self.tagger.predict(sentences, mini_batch_size=mini_batch_size, **kwargs)
+        with timed_stage('tokenize'):
+            tagged_articles = self._split_sentences(text)
+        return self._tag_articles(tagged_articles, mini_batch_size=mini_batch_size, raw=raw, **kwargs)
+
+    def _split_sentences(
+        self,
+        text: List[Union[Sentence, str]], # The articles to split
+    ) -> List[List[Sentence]]: # The sentences of every article
+        "Splits every article into sentences on its own, so every sentence belongs to exactly one of them"
+        text = [t.to_original_text() if isinstance(t, Sentence) else t for t in text]
+        return [self.splitter.split(t) if t.strip() else [] for t in text]
+
+    def _tag_articles(
+        self,
+        tagged_articles: List[List[Sentence]], # The sentences of every article, from `_split_sentences`
+        mini_batch_size: int = 32, # Mini batch size
+        raw:bool = False, # Whether to return a list of raw Sentences
+        **kwargs, # Optional arguments for the Flair tagger
+    ) -> Union[List[dict], List[Sentence]]: # The entities of every article, or the raw sentences
+        "Tags the sentences of all articles at once"
+        sentences = [sentence for article in tagged_articles for sentence in article]
+        with timed_stage('forward'):
+            self.tagger.predict(sentences, mini_batch_size=mini_batch_size, **kwargs)
 
         if not raw:
-            return self.decode_articles(text, sentences)
+            with timed_stage('postprocess'):
+                return self._split_articles(tagged_articles)
         return sentences
 
+# Internal Cell
+def _copy_sentence(
+    sentence: Sentence # A tokenized sentence
+) -> Sentence: # The same tokens, without any predictions or embeddings
+    "Copies the tokens of `sentence`, which is much faster than splitting and tokenizing its text again"
+    copy = Sentence()
+    copy.start_pos, copy.end_pos = sentence.start_pos, sentence.end_pos
+    for token in sentence:
+        new = Token(token.text, token.idx, token.head_id, token.whitespace_after, token.start_pos)
+        new.sentence = copy
+        copy.tokens.append(new)
+    return copy
+
 # Cell
 class EasyTokenTagger:
     "Token level classification models"
 
     def __init__(self):
-        self.token_taggers: Dict[AdaptiveModel] = defaultdict(bool)
+        self.token_taggers = CachedModels('token_classification')
 
+    def _load(
+        self,
+        model_name_or_path: Union[str, FlairModelResult, HFModelResult] # The hosted model name key or model path
+    ) -> AdaptiveModel: # The loaded tagger, or `None` if no model was found
+        "Loads a Flair or Transformers tagger from `model_name_or_path`, searching the model hubs for names that aren't a path"
+        name = getattr(model_name_or_path, 'name', model_name_or_path)
+        if risinstance([FlairModelResult, HFModelResult], model_name_or_path):
+            try:
+                return FlairTokenTagger.load(name)
+            except:
+                return TransformersTokenTagger.load(name)
+        elif risinstance([str, Path], model_name_or_path) and (Path(model_name_or_path).exists() and Path(model_name_or_path).is_dir()):
+            # Load in previously existing model
+            try:
+                return FlairTokenTagger.load(name)
+            except:
+                return TransformersTokenTagger.load(name)
+        else:
+            _flair_hub = FlairModelHub()
+            _hf_hub = HFModelHub()
+            res = _flair_hub.search_model_by_name(name, user_uploaded=True)
+            if len(res) < 1:
+                # No models found
+                res = _hf_hub.search_model_by_name(name, user_uploaded=True)
+                if len(res) < 1:
+                    logger.info("Not a valid `model_name_or_path` param")
+                    return None
+                else:
+                    return TransformersTokenTagger.load(res[0].name)
+            else:
+                return FlairTokenTagger.load(res[0].name.replace('flairNLP/', '')) # Returning the first should always be the non-fast option
+
+    @instrumented()
     def tag_text(
         self,
         text: Union[List[Sentence], Sentence, List[str], str], # Text input, it can be a string or any of Flair's `Sentence` input formats
@@ -375,49 +509,16 @@ class EasyTokenTagger:
         **kwargs, # Keyword arguments for Flair's `SequenceTagger.predict()` method
     ) -> List[Sentence]: # A list of Flair's `Sentence`'s
         "Tags tokens with labels the token classification models have been trained on"
-        # Load Sequence Tagger Model and Pytorch Module into tagger dict
-        name = getattr(model_name_or_path, 'name', model_name_or_path)
-        if not self.token_taggers[name]:
-            """
-            self.token_taggers[model_name_or_path] = SequenceTagger.load(
-                model_name_or_path
-            )
-            """
-            if risinstance([FlairModelResult, HFModelResult], model_name_or_path):
-                try:
-                    self.token_taggers[name] = FlairTokenTagger.load(name)
-                except:
-                    self.token_taggers[name] = TransformersTokenTagger.load(name)
-            elif risinstance([str, Path], model_name_or_path) and (Path(model_name_or_path).exists() and Path(model_name_or_path).is_dir()):
-                # Load in previously existing model
-                try:
-                    self.token_taggers[name] = FlairTokenTagger.load(name)
-                except:
-                    self.token_taggers[name] = TransformersTokenTagger.load(name)
-            else:
-                _flair_hub = FlairModelHub()
-                _hf_hub = HFModelHub()
-                res = _flair_hub.search_model_by_name(name, user_uploaded=True)
-                if len(res) < 1:
-                    # No models found
-                    res = _hf_hub.search_model_by_name(name, user_uploaded=True)
-                    if len(res) < 1:
-                        logger.info("Not a valid `model_name_or_path` param")
-                        return [Sentence('')]
-                    else:
-                        res[0].name.replace('flairNLP', 'flair')
-                        self.token_taggers[res[0].name] = TransformersTokenTagger.load(res[0].name)
-                        name = res[0].name
-
-                else:
-                    name = res[0].name.replace('flairNLP/', '')
-                    self.token_taggers[name] = FlairTokenTagger.load(name) # Returning the first should always be the non-fast option
-
-        tagger = self.token_taggers[name]
+        with timed_stage('load'):
+            # Load Sequence Tagger Model and Pytorch Module into the shared model cache
+            name = getattr(model_name_or_path, 'name', model_name_or_path)
+            tagger = self.token_taggers.get_or_load(name, partial(self._load, model_name_or_path))
+            if tagger is None: return [Sentence('')]
         if isinstance(tagger, TransformersTokenTagger):
             return tagger.predict(
                 text=text,
                 mini_batch_size=mini_batch_size,
+                detail_level=detail_level,
                 **kwargs
             )
         else:
@@ -428,6 +529,34 @@ class EasyTokenTagger:
                 **kwargs,
             )
 
+    def tag_text_sharded(
+        self,
+        text: Union[List[Sentence], List[str]], # A list of strings or `Sentence`s to be tagged
+        model_name_or_path: Union[str, FlairModelResult, HFModelResult] = "ner-ontonotes", # The hosted model name key or model path
+        mini_batch_size: int = 32, # The mini batch size for running inference
+        detail_level:DetailLevel = DetailLevel.Low, # The level of detail to return on a TransformerTagger
+        num_workers: int = 4, # The number of worker processes
+        threads_per_worker: int = None, # The number of PyTorch threads in each worker. Defaults to splitting the cores evenly between the workers
+        **kwargs, # Keyword arguments for Flair's `SequenceTagger.predict()` method
+    ) -> Union[List[Sentence], dict]: # The same output as `tag_text`
+        "Tags tokens like `tag_text`, sharded across a pool of worker processes that each load the model once"
+        if isinstance(text, (Sentence, str)): text = [text]
+        if len(text) == 0: return text
+        shards = [(shard,) for shard in chunked(text, n_chunks=min(len(text), num_workers*4))]
+        out = run_sharded(
+            EasyTokenTagger, 'tag_text', shards, num_workers, threads_per_worker,
+            model_name_or_path=model_name_or_path, mini_batch_size=mini_batch_size, detail_level=DetailLevel.High, **kwargs
+        )
+        # Flair taggers return a list of `Sentence`s
+        if not isinstance(out[0], dict): return [sentence for shard in out for sentence in shard]
+        # Transformers taggers return every detail, so the shards can be joined into one result
+        res = TokenClassificationResult(
+            [o for shard in out for o in shard['inputs']],
+            [o for shard in out for o in shard['tokenized_inputs']],
+            [o for shard in out for o in shard['tags']],
+        )
+        return res.to_dict(detail_level)
+
     def tag_all(
         self,
         text: Union[List[Sentence], Sentence, List[str], str], # Text input, it can be a string or any of Flair's `Sentence` input formats
@@ -435,66 +564,45 @@ class EasyTokenTagger:
         detail_level:DetailLevel = DetailLevel.Low, # The level of detail for a TransformersTagger to return
         **kwargs, # Keyword arguments for Flair's `SequenceTagger.predict()` method
     ) -> List[dict]: # A dictionary of Token Tagging results
-        "Tags tokens with all labels from all token classification models"
+        """Tags tokens with all labels from all token classification models
+
+        The text is split into sentences once for every Flair tagger, and the taggers run at the same time in a pool of threads.
+        Entities found by several taggers are merged into one, with the `labels`, `value`, and `confidence` of each
+        """
         if len(self.token_taggers) == 0:
             print("No token classification models loaded...")
             return Sentence()
         if not isinstance(text, list):
             text = [text]
-        results = []
-        all_models = [o for o in list(self.token_taggers.keys()) if self.token_taggers[o]]
-        for tagger_name in all_models:
-            results.append(
-                self.tag_text(
-                    text,
-                    model_name_or_path=tagger_name,
-                    mini_batch_size=mini_batch_size,
-                    **kwargs,
-                )
-            )
-        tag_results = [{'entities':[], 'labels':[], 'text':None} for _ in range(len(results[0]))]
-        for tag in results:
-            for i, inp in enumerate(tag):
-                if not tag_results[i]['text']:
-                    tag_results[i]['text'] = inp['text']
-                if 'entities' in inp:
-                    if len(inp['entities']) > 0:
-                        tag_results[i]['entities'] += inp['entities']
-                if 'labels' in inp:
-                    if len(inp['labels']) > 0:
-                        tag_results[i]['labels'] += inp['labels']
+        taggers = [self.token_taggers[o] for o in list(self.token_taggers.keys()) if self.token_taggers[o]]
+        flair_taggers = [t for t in taggers if isinstance(t, FlairTokenTagger)]
+        if len(flair_taggers) < len(taggers):
+            logger.warning('`tag_all` only merges the entities of Flair taggers, the Transformers taggers are skipped')
+        if not flair_taggers: return [[] for _ in text]
+
+        with timed_stage('tokenize'):
+            tagged_articles = flair_taggers[0]._split_sentences(text)
+            # Flair keeps the predictions and embeddings of a tagger on the tokens, so every other tagger gets its own copy
+            copies = [tagged_articles] + [
+                [[_copy_sentence(s) for s in article] for article in tagged_articles] for _ in flair_taggers[1:]
+            ]
+        # Each thread runs in a copy of the caller's context, so taggers count towards its `instrumented_call`
+        with ThreadPoolExecutor(len(flair_taggers)) as pool:
+            futures = [
+                pool.submit(copy_context().run, tagger._tag_articles, articles, mini_batch_size=mini_batch_size, **kwargs)
+                for tagger, articles in zip(flair_taggers, copies)
+            ]
+            results = [f.result() for f in futures]
 
         all_results = []
-        for result in tag_results:
-            res = []
-            for entity in result['entities']:
-                unique_entities = []
-                new_entity = {
-                    'text':entity['text'],
-                    'start_pos':entity['start_pos'],
-                    'end_pos':entity['end_pos']}
-
-                if new_entity not in unique_entities:
-                    unique_entities.append(new_entity)
-                if len(unique_entities) > 0:
-                    merged = []
-                    for entity in unique_entities:
-                        instances = filter_ex(
-                                result['entities'],
-                                lambda x: (
-                                    x['text'] == entity['text'] and \
-                                    x['start_pos'] == entity['start_pos'] and \
-                                    x['end_pos'] == entity['end_pos']
-                                )
-                            )
-                        attrs = ('labels','value','confidence')
-                        for attr in attrs:
-                            entity[attr] = []
-                        for instance in instances:
-                            for attr in attrs:
-                                if attr in instance.keys():
-                                    entity[attr] += listify(instance[attr])
-                    merged = sorted(unique_entities, key=lambda x: x['start_pos'])
-                    res += merged
-            all_results.append(res)
+        for payloads in zip(*results):
+            entities = {}
+            for payload in payloads:
+                for entity in payload['entities']:
+                    key = (entity['text'], entity['start_pos'], entity['end_pos'])
+                    if key not in entities:
+                        entities[key] = {'text':key[0], 'start_pos':key[1], 'end_pos':key[2], 'labels':[], 'value':[], 'confidence':[]}
+                    for attr in ('labels','value','confidence'):
+                        if attr in entity: entities[key][attr] += listify(entity[attr])
+            all_results.append(sorted(entities.values(), key=lambda x: x['start_pos']))
         return all_results
\ No newline at end of file
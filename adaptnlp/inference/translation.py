@@ -4,8 +4,9 @@ __all__ = ['logger', 'TranslationResult', 'TransformersTranslator', 'EasyTransla
 
 # Cell
 import logging
-from typing import List, Dict, Union
-from collections import defaultdict, OrderedDict
+from typing import List, Union
+from collections import OrderedDict
+from functools import partial
 
 import torch
 from torch.utils.data import TensorDataset, DataLoader
@@ -18,13 +19,15 @@ from transformers import (
     T5ForConditionalGeneration,
 )
 
-from ..model import AdaptiveModel
+from ..model import AdaptiveModel, load_pretrained_model, run_pipelined
 from ..callback import GeneratorCallback
 
 from fastai.torch_core import apply, to_device
 
-from fastcore.basics import Self
+from fastcore.basics import Self, chunked
 from ..model_hub import HFModelResult, FlairModelResult, HFModelHub, FlairModelHub
+from ..instrumentation import instrumented, timed_stage, record_batches
+from ..model_cache import CachedModels
 from ..result import DetailLevel
 
 # Cell
@@ -86,12 +89,15 @@ class TransformersTranslator(AdaptiveModel):
     @classmethod
     def load(
         cls,
-        model_name_or_path: str # A key string of one of Transformer's pre-trained translator Model
+        model_name_or_path: str, # A key string of one of Transformer's pre-trained translator Model
+        quantize: str = None, # Set to 'dynamic-int8' to quantize the model's Linear layers for CPU inference, see `AdaptiveModel.quantize`
+        quantize_sample: List[str] = None, # Held-out texts to report the quantized model's agreement with the original on
     ) -> AdaptiveModel:
         "Class method for loading and constructing this classifier"
         tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
-        model = AutoModelForSeq2SeqLM.from_pretrained(model_name_or_path)
+        model = load_pretrained_model(AutoModelForSeq2SeqLM, model_name_or_path)
         translator = cls(tokenizer, model)
+        if quantize is not None: translator.quantize(quantize, quantize_sample)
         return translator
 
     def predict(
@@ -116,29 +122,19 @@ class TransformersTranslator(AdaptiveModel):
         if isinstance(self.model, T5ForConditionalGeneration):
             text = [f'{t5_prefix}: {t}' for t in text]
 
-        dataset = self._tokenize(text)
-        dl = DataLoader(dataset, batch_size=mini_batch_size)
-        translations = []
-
-        logger.info(f'Running translator on {len(dataset)} text sequences')
+        logger.info(f'Running translator on {len(text)} text sequences')
         logger.info(f'Batch size = {mini_batch_size}')
 
         cb = GeneratorCallback(num_beams, min_length, max_length, early_stopping, **kwargs)
 
-        preds,_ = super().get_preds(dl=dl, cbs=[cb])
-
-        preds = apply(Self.squeeze(0), preds)
-
-        for o in preds:
-            translations.append(
-                [
-                    self.tokenizer.decode(
-                        o,
-                        skip_special_tokens=True,
-                        clean_up_tokenization_spaces=False,
-                    )
-                ].pop()
-            )
+        # The next chunk is tokenized and the last one decoded while the model generates the current one
+        chunks = list(chunked(text, mini_batch_size * self.pipeline_batches))
+        stages = (
+            partial(self._tokenize_chunk, mini_batch_size=mini_batch_size),
+            partial(self._forward_chunk, cbs=[cb]),
+            self._decode_chunk,
+        )
+        translations = [translation for chunk in run_pipelined(chunks, *stages) for translation in chunk]
 
         languages = t5_prefix.strip('translate ').split(' to ')
 
@@ -146,6 +142,42 @@ class TransformersTranslator(AdaptiveModel):
 
         return res if detail_level is None else res.to_dict(detail_level)
 
+    @timed_stage('tokenize')
+    def _tokenize_chunk(
+        self,
+        texts: List[str], # A chunk of texts
+        mini_batch_size: int = 32, # Mini batch size
+    ) -> DataLoader:
+        "Tokenizes `texts` into mini batches, the first stage of `predict`"
+        dataset = self._tokenize(texts)
+        record_batches(dataset.tensors[1].split(mini_batch_size))
+        return DataLoader(dataset, batch_size=mini_batch_size)
+
+    @timed_stage('forward')
+    def _forward_chunk(
+        self,
+        dl: DataLoader, # The output of `_tokenize_chunk`
+        cbs: list = [], # The `GeneratorCallback` to generate with
+    ) -> list: # The generated token ids
+        "Generates the translations of a chunk, the second stage of `predict`"
+        preds,_ = super().get_preds(dl=dl, cbs=cbs)
+        return apply(Self.squeeze(0), preds)
+
+    @timed_stage('postprocess')
+    def _decode_chunk(
+        self,
+        preds: list # The output of `_forward_chunk`
+    ) -> List[str]: # The decoded translations
+        "Decodes the generated token ids of a chunk, the last stage of `predict`"
+        return [
+            self.tokenizer.decode(
+                o,
+                skip_special_tokens=True,
+                clean_up_tokenization_spaces=False,
+            )
+            for o in preds
+        ]
+
     def _tokenize(self, text: Union[List[str], str]) -> TensorDataset:
         """ Batch tokenizes text and produces a `TensorDataset` with text """
 
@@ -169,8 +201,9 @@ class EasyTranslator:
     "Translation Module"
 
     def __init__(self):
-        self.translators: Dict[AdaptiveModel] = defaultdict(bool)
+        self.translators = CachedModels('translation')
 
+    @instrumented()
     def translate(
         self,
         text: Union[List[str], str], # Sentences to run inference on
@@ -186,12 +219,8 @@ class EasyTranslator:
     ) -> List[str]:
         "Predict method for running inference using the pre-trained sequence classifier model. Keyword arguments for parameters of the method `Transformers.PreTrainedModel.generate()` can be used as well."
         name = getattr(model_name_or_path, 'name', model_name_or_path)
-        if not self.translators[name]:
-            self.translators[name] = TransformersTranslator.load(
-                name
-            )
-
-        translator = self.translators[name]
+        with timed_stage('load'):
+            translator = self.translators.get_or_load(name, partial(TransformersTranslator.load, name))
         return translator.predict(
             text=text,
             t5_prefix=t5_prefix,
@@ -24,7 +24,9 @@ import logging
 import math
 import re
 import string
+from typing import List, Tuple
 
+import numpy as np
 from transformers.models.bert import BasicTokenizer
 
 # Cell
@@ -436,14 +438,15 @@ def get_final_text(pred_text, orig_text, do_lower_case, verbose_logging=False):
 # Internal Cell
 def _get_best_indexes(logits, n_best_size):
     """Get the n-best logits from a list."""
-    index_and_score = sorted(enumerate(logits), key=lambda x: x[1], reverse=True)
-
-    best_indexes = []
-    for i in range(len(index_and_score)):
-        if i >= n_best_size:
-            break
-        best_indexes.append(index_and_score[i][0])
-    return best_indexes
+    logits = np.asarray(logits)
+    if n_best_size <= 0 or len(logits) == 0: return []
+    if n_best_size >= len(logits): return np.argsort(-logits, kind='stable').tolist()
+    # Only the `n_best_size` largest logits get sorted. Like a stable sort, ties keep the lowest indexes first
+    kth = np.partition(logits, len(logits) - n_best_size)[len(logits) - n_best_size]
+    above = np.flatnonzero(logits > kth)
+    ties = np.flatnonzero(logits == kth)[:n_best_size - len(above)]
+    best = np.concatenate([above, ties])
+    return best[np.argsort(-logits[best], kind='stable')].tolist()
 
 # Internal Cell
 def _compute_softmax(scores):
@@ -493,28 +496,25 @@ def compute_predictions_logits(
     for result in all_results:
         unique_id_to_result[result.unique_id] = result
 
-    _PrelimPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-        "PrelimPrediction",
-        ["feature_index", "start_index", "end_index", "start_logit", "end_logit"],
-    )
-
     all_predictions = collections.OrderedDict()
     all_nbest_json = collections.OrderedDict()
     scores_diff_json = collections.OrderedDict()
 
     for (example_index, example) in enumerate(all_examples):
         features = example_index_to_features[example_index]
+        feature_results = [unique_id_to_result[feature.unique_id] for feature in features]
 
-        prelim_predictions = []
+        # The candidate spans of every feature, as flat arrays in the order they were found
+        cand_features, cand_starts, cand_ends, cand_scores = [], [], [], []
         # keep track of the minimum score of null start+end of position 0
         score_null = 1000000  # large and positive
         min_null_feature_index = 0  # the paragraph slice with min null score
         null_start_logit = 0  # the start logit at the slice with min null score
         null_end_logit = 0  # the end logit at the slice with min null score
-        for (feature_index, feature) in enumerate(features):
-            result = unique_id_to_result[feature.unique_id]
-            start_indexes = _get_best_indexes(result.start_logits, n_best_size)
-            end_indexes = _get_best_indexes(result.end_logits, n_best_size)
+        for (feature_index, (feature, result)) in enumerate(zip(features, feature_results)):
+            start_logits, end_logits = np.asarray(result.start_logits), np.asarray(result.end_logits)
+            start_indexes = np.array(_get_best_indexes(start_logits, n_best_size), dtype=np.int64)
+            end_indexes = np.array(_get_best_indexes(end_logits, n_best_size), dtype=np.int64)
             # if we could have irrelevant answers, get the min score of irrelevant
             if version_2_with_negative:
                 feature_null_score = result.start_logits[0] + result.end_logits[0]
@@ -523,50 +523,40 @@ def compute_predictions_logits(
                     min_null_feature_index = feature_index
                     null_start_logit = result.start_logits[0]
                     null_end_logit = result.end_logits[0]
-            for start_index in start_indexes:
-                for end_index in end_indexes:
-                    # We could hypothetically create invalid predictions, e.g., predict
-                    # that the start of the span is in the question. We throw out all
-                    # invalid predictions.
-                    if start_index >= len(feature.tokens):
-                        continue
-                    if end_index >= len(feature.tokens):
-                        continue
-                    if start_index not in feature.token_to_orig_map:
-                        continue
-                    if end_index not in feature.token_to_orig_map:
-                        continue
-                    if not feature.token_is_max_context.get(start_index, False):
-                        continue
-                    if end_index < start_index:
-                        continue
-                    length = end_index - start_index + 1
-                    if length > max_answer_length:
-                        continue
-                    prelim_predictions.append(
-                        _PrelimPrediction(
-                            feature_index=feature_index,
-                            start_index=start_index,
-                            end_index=end_index,
-                            start_logit=result.start_logits[start_index],
-                            end_logit=result.end_logits[end_index],
-                        )
-                    )
+            # We could hypothetically create invalid predictions, e.g., predict
+            # that the start of the span is in the question. We throw out all
+            # invalid predictions, checking every start and end index once and
+            # every pair of them as a matrix
+            n_tokens = len(feature.tokens)
+            valid_starts = np.array([
+                i < n_tokens and i in feature.token_to_orig_map and bool(feature.token_is_max_context.get(i, False))
+                for i in start_indexes.tolist()
+            ], dtype=bool)
+            valid_ends = np.array([
+                i < n_tokens and i in feature.token_to_orig_map for i in end_indexes.tolist()
+            ], dtype=bool)
+            lengths = end_indexes[None, :] - start_indexes[:, None] + 1
+            valid = valid_starts[:, None] & valid_ends[None, :] & (lengths >= 1) & (lengths <= max_answer_length)
+            # Row-major order, so candidates come in the same order as looping over starts then ends
+            starts, ends = np.nonzero(valid)
+            starts, ends = start_indexes[starts], end_indexes[ends]
+            cand_features.append(np.full(len(starts), feature_index, dtype=np.int64))
+            cand_starts.append(starts)
+            cand_ends.append(ends)
+            # Summed in the dtype of the logits, so the scores are the same as adding them one by one
+            cand_scores.append((start_logits[starts] + end_logits[ends]).astype(np.float64))
+        null_candidate = None
         if version_2_with_negative:
-            prelim_predictions.append(
-                _PrelimPrediction(
-                    feature_index=min_null_feature_index,
-                    start_index=0,
-                    end_index=0,
-                    start_logit=null_start_logit,
-                    end_logit=null_end_logit,
-                )
-            )
-        prelim_predictions = sorted(
-            prelim_predictions,
-            key=lambda x: (x.start_logit + x.end_logit),
-            reverse=True,
-        )
+            null_candidate = sum(len(s) for s in cand_starts)
+            cand_features.append(np.array([min_null_feature_index], dtype=np.int64))
+            cand_starts.append(np.zeros(1, dtype=np.int64))
+            cand_ends.append(np.zeros(1, dtype=np.int64))
+            cand_scores.append(np.array([null_start_logit + null_end_logit], dtype=np.float64))
+        if cand_scores:
+            cand_features, cand_starts, cand_ends = [np.concatenate(o).tolist() for o in (cand_features, cand_starts, cand_ends)]
+            # A stable sort on the negated scores keeps candidates with equal scores in the order they were found
+            order = np.argsort(-np.concatenate(cand_scores), kind='stable').tolist()
+        else: order = []
 
         _NbestPrediction = collections.namedtuple(  # pylint: disable=invalid-name
             "NbestPrediction",
@@ -575,32 +565,44 @@ def compute_predictions_logits(
 
         seen_predictions = {}
         nbest = []
-        for pred in prelim_predictions:
+        for candidate in order:
             if len(nbest) >= n_best_size:
                 break
-            feature = features[pred.feature_index]
-            if pred.start_index > 0:  # this is a non-null prediction
-                tok_tokens = feature.tokens[pred.start_index : (pred.end_index + 1)]
-                orig_doc_start = feature.token_to_orig_map[pred.start_index]
-                orig_doc_end = feature.token_to_orig_map[pred.end_index]
-                orig_tokens = example.doc_tokens[orig_doc_start : (orig_doc_end + 1)]
-
-                tok_text = tokenizer.convert_tokens_to_string(tok_tokens)
-
-                # tok_text = " ".join(tok_tokens)
-                #
-                # # De-tokenize WordPieces that have been split off.
-                # tok_text = tok_text.replace(" ##", "")
-                # tok_text = tok_text.replace("##", "")
-
-                # Clean whitespace
-                tok_text = tok_text.strip()
-                tok_text = " ".join(tok_text.split())
-                orig_text = " ".join(orig_tokens)
-
-                final_text = get_final_text(
-                    tok_text, orig_text, do_lower_case, verbose_logging
-                )
+            feature_index = cand_features[candidate]
+            start_index, end_index = cand_starts[candidate], cand_ends[candidate]
+            if candidate == null_candidate:
+                start_logit, end_logit = null_start_logit, null_end_logit
+            else:
+                result = feature_results[feature_index]
+                start_logit, end_logit = result.start_logits[start_index], result.end_logits[end_index]
+            feature = features[feature_index]
+            if start_index > 0:  # this is a non-null prediction
+                orig_doc_start = feature.token_to_orig_map[start_index]
+                orig_doc_end = feature.token_to_orig_map[end_index]
+                offsets = getattr(feature, 'offsets', None)
+                if offsets is not None:
+                    # Features cut with the offsets of a fast tokenizer map straight back to the characters of the context
+                    final_text = example.context_text[offsets[start_index][0] : offsets[end_index][1]]
+                else:
+                    tok_tokens = feature.tokens[start_index : (end_index + 1)]
+                    orig_tokens = example.doc_tokens[orig_doc_start : (orig_doc_end + 1)]
+
+                    tok_text = tokenizer.convert_tokens_to_string(tok_tokens)
+
+                    # tok_text = " ".join(tok_tokens)
+                    #
+                    # # De-tokenize WordPieces that have been split off.
+                    # tok_text = tok_text.replace(" ##", "")
+                    # tok_text = tok_text.replace("##", "")
+
+                    # Clean whitespace
+                    tok_text = tok_text.strip()
+                    tok_text = " ".join(tok_text.split())
+                    orig_text = " ".join(orig_tokens)
+
+                    final_text = get_final_text(
+                        tok_text, orig_text, do_lower_case, verbose_logging
+                    )
                 if final_text in seen_predictions:
                     continue
 
@@ -612,8 +614,8 @@ def compute_predictions_logits(
             nbest.append(
                 _NbestPrediction(
                     text=final_text,
-                    start_logit=pred.start_logit,
-                    end_logit=pred.end_logit,
+                    start_logit=start_logit,
+                    end_logit=end_logit,
                     start_index=orig_doc_start,
                     end_index=orig_doc_end,
                 )
@@ -910,4 +912,25 @@ def compute_predictions_log_probs(
         with open(output_null_log_odds_file, "w") as writer:
             writer.write(json.dumps(scores_diff_json, indent=4) + "\n")
 
-    return all_predictions, all_nbest_json
\ No newline at end of file
+    return all_predictions, all_nbest_json
+
+# Internal Cell
+def _context_windows(
+    n_tokens: int, # The number of tokens of the context
+    context_length: int, # The number of context tokens that fit in a window
+    doc_stride: int, # Number of tokens between the starts of two windows
+) -> Tuple[List[Tuple[int, int]], np.ndarray]:
+    "The start and length of every window of a context, and the window with the most context on both sides of each token"
+    # Windows start every `doc_stride` tokens, until one reaches the end of the context
+    starts = [0]
+    while starts[-1] + context_length < n_tokens: starts.append(starts[-1] + min(doc_stride, context_length))
+    spans = [(start, min(context_length, n_tokens - start)) for start in starts]
+    # Every token of every window, scored like `_check_is_max_context`
+    window = np.concatenate([np.full(length, k) for k, (start, length) in enumerate(spans)])
+    doc = np.concatenate([np.arange(start, start + length) for start, length in spans])
+    start, length = np.array(spans)[window].T
+    score = np.minimum(doc - start, start + length - 1 - doc) + 0.01 * length
+    # The first of the best scored windows of each token
+    order = np.lexsort((window, -score, doc))
+    firsts = np.flatnonzero(np.r_[True, doc[order][1:] != doc[order][:-1]])
+    return spans, window[order][firsts]
\ No newline at end of file
@@ -0,0 +1,257 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/19_instrumentation.ipynb (unless otherwise specified).
+
+__all__ = ['TIME_BUCKETS', 'COUNT_BUCKETS', 'Histogram', 'MetricsRegistry', 'registry', 'CallStats',
+           'instrumented_call', 'instrumented', 'timed_stage', 'record_count', 'record_batches']
+
+# Cell
+import inspect, math, time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import defaultdict, OrderedDict
+from functools import wraps
+from threading import Lock
+from typing import List, Dict, Iterable
+
+# Cell
+TIME_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60.)
+COUNT_BUCKETS = tuple(float(2**i) for i in range(21))
+
+# Cell
+class Histogram:
+    "Counts observed values into buckets, like a Prometheus histogram, along with their count, sum, minimum, and maximum"
+    def __init__(
+        self,
+        buckets:Iterable[float]=TIME_BUCKETS # The upper bounds of the buckets, values above the last one fall into an unbounded bucket
+    ):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count, self.sum, self.min, self.max = 0, 0., math.inf, -math.inf
+        self._lock = Lock()
+
+    def observe(
+        self,
+        value:float # A value to count
+    ):
+        "Counts `value` into its bucket"
+        with self._lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.min, self.max = min(self.min, value), max(self.max, value)
+
+    def quantile(
+        self,
+        q:float # A quantile between 0 and 1
+    ) -> float: # An estimate of the `q` quantile of the observed values, or `nan` if there are none
+        "Estimates the `q` quantile of the observed values by interpolating within the bucket it falls into"
+        if self.count == 0: return math.nan
+        rank, seen = q * self.count, 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lo = max(self.buckets[i-1] if i > 0 else self.min, self.min)
+                hi = min(self.buckets[i] if i < len(self.buckets) else self.max, self.max)
+                return lo + (hi - lo) * (rank - seen) / n
+            seen += n
+        return self.max
+
+    def to_dict(self) -> OrderedDict:
+        "The summary statistics of the observed values and the cumulative count of each bucket"
+        return OrderedDict(
+            count=self.count,
+            sum=self.sum,
+            min=self.min if self.count else math.nan,
+            max=self.max if self.count else math.nan,
+            mean=self.sum / self.count if self.count else math.nan,
+            p50=self.quantile(.5),
+            p90=self.quantile(.9),
+            p99=self.quantile(.99),
+            buckets=OrderedDict(zip([*self.buckets, math.inf], _cumsum(self.counts))),
+        )
+
+# Internal Cell
+def _cumsum(counts):
+    "Running totals of `counts`"
+    total, out = 0, []
+    for n in counts:
+        total += n
+        out.append(total)
+    return out
+
+# Cell
+class MetricsRegistry:
+    """
+    A registry of named histograms, each split into one histogram per set of labels.
+
+    Names ending in `_seconds` count into `TIME_BUCKETS` by default, all others into `COUNT_BUCKETS`
+    """
+    def __init__(self):
+        self._histograms = OrderedDict()
+        self._lock = Lock()
+        self.enabled = True
+
+    def histogram(
+        self,
+        name:str, # The name of the metric
+        buckets:Iterable[float]=None, # The buckets of a new histogram
+        **labels # The labels of the histogram, such as `task='tag_text'`
+    ) -> Histogram: # The histogram of `name` with `labels`, created if needed
+        "Gets the histogram of `name` with `labels`"
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self._histograms:
+                if buckets is None: buckets = TIME_BUCKETS if name.endswith('_seconds') else COUNT_BUCKETS
+                self._histograms[key] = Histogram(buckets)
+            return self._histograms[key]
+
+    def observe(
+        self,
+        name:str, # The name of the metric
+        value:float, # A value to count
+        **labels # The labels of the histogram, such as `task='tag_text'`
+    ):
+        "Counts `value` into the histogram of `name` with `labels`, unless the registry is disabled"
+        if self.enabled: self.histogram(name, **labels).observe(value)
+
+    def reset(self):
+        "Removes every histogram"
+        with self._lock: self._histograms.clear()
+
+    def dump(self) -> Dict[str, List[dict]]: # The labels and `Histogram.to_dict` of every histogram, by name
+        "The contents of every histogram, such as for logging or saving as JSON"
+        out = OrderedDict()
+        with self._lock: items = list(self._histograms.items())
+        for (name, labels), h in items:
+            out.setdefault(name, []).append(OrderedDict(labels=dict(labels), **h.to_dict()))
+        return out
+
+    def to_prometheus(self) -> str:
+        "The histograms in the Prometheus text exposition format, to be served to a scraper"
+        lines, typed = [], set()
+        with self._lock: items = list(self._histograms.items())
+        for (name, labels), h in sorted(items, key=lambda o: o[0]):
+            if name not in typed:
+                lines.append(f'# TYPE {name} histogram')
+                typed.add(name)
+            for le, n in h.to_dict()['buckets'].items():
+                lines.append(f'{name}_bucket{_labels_str(labels + (("le", _format_value(le)),))} {n}')
+            lines.append(f'{name}_sum{_labels_str(labels)} {_format_value(h.sum)}')
+            lines.append(f'{name}_count{_labels_str(labels)} {h.count}')
+        return '\n'.join(lines) + '\n'
+
+# Internal Cell
+def _format_value(value):
+    "Formats `value` as Prometheus does"
+    if value == math.inf: return '+Inf'
+    return repr(float(value))
+
+def _labels_str(labels):
+    "Formats `labels` as the label set of a Prometheus sample"
+    if not labels: return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k,v in labels) + '}'
+
+# Cell
+registry = MetricsRegistry()
+
+# Cell
+class CallStats:
+    "The time spent in each stage of an instrumented call and its counts, safe to add to from several threads"
+    def __init__(
+        self,
+        task:str # The name of the call, such as 'tag_text'
+    ):
+        self.task = task
+        self.seconds, self.counts = defaultdict(float), defaultdict(int)
+        self._lock = Lock()
+
+    def add_time(self, stage:str, seconds:float):
+        "Adds `seconds` to the time spent in `stage`"
+        with self._lock: self.seconds[stage] += seconds
+
+    def add_count(self, name:str, n:int):
+        "Adds `n` to the count of `name`"
+        with self._lock: self.counts[name] += n
+
+# Internal Cell
+_current_call = ContextVar('_current_call', default=None)
+
+def _n_inputs(inputs):
+    "The number of texts in `inputs`, which is either a list of them or a single one"
+    return len(inputs) if isinstance(inputs, (list, tuple)) else 1
+
+# Cell
+@contextmanager
+def instrumented_call(
+    task:str, # The name of the call, such as 'tag_text'
+    inputs=None, # The texts of the call, to count as its inputs
+    registry:MetricsRegistry=registry # The registry to record the call in
+):
+    """
+    Records the wall time of everything run inside it as a call of `task`, along with its stages and counts.
+
+    Calls nested inside another instrumented call are part of the outer one
+    """
+    if _current_call.get() is not None or not registry.enabled:
+        yield _current_call.get()
+        return
+    stats = CallStats(task)
+    if inputs is not None: stats.add_count('inputs', _n_inputs(inputs))
+    token, start = _current_call.set(stats), time.perf_counter()
+    try: yield stats
+    finally:
+        _current_call.reset(token)
+        registry.observe('adaptnlp_call_seconds', time.perf_counter() - start, task=task)
+        for stage, seconds in stats.seconds.items():
+            registry.observe('adaptnlp_stage_seconds', seconds, task=task, stage=stage)
+        for name, n in stats.counts.items():
+            registry.observe(f'adaptnlp_{name}', n, task=task)
+
+# Cell
+def instrumented(
+    task:str=None # The name of the calls. Defaults to the qualified name of the method, such as 'EasySequenceClassifier.tag_text'
+):
+    "Decorates a method so every call to it is an `instrumented_call` of `task`, counting the texts of its first argument as its inputs"
+    def _inner(f):
+        name = task or f.__qualname__
+        first_arg = list(inspect.signature(f).parameters)[1]
+        @wraps(f)
+        def _call(self, *args, **kwargs):
+            inputs = args[0] if args else kwargs.get(first_arg)
+            with instrumented_call(name, inputs): return f(self, *args, **kwargs)
+        return _call
+    return _inner
+
+# Cell
+@contextmanager
+def timed_stage(
+    stage:str # The name of the stage, such as 'tokenize'
+):
+    "Adds the wall time of everything run inside it to `stage` of the current instrumented call, if there is one. Also works as a decorator"
+    stats = _current_call.get()
+    if stats is None:
+        yield
+        return
+    start = time.perf_counter()
+    try: yield
+    finally: stats.add_time(stage, time.perf_counter() - start)
+
+# Cell
+def record_count(
+    name:str, # The name of the count, such as 'batches'
+    n:int # The amount to add
+):
+    "Adds `n` to the count of `name` of the current instrumented call, if there is one"
+    stats = _current_call.get()
+    if stats is not None: stats.add_count(name, n)
+
+def record_batches(
+    attention_masks:Iterable # The attention mask of every batch
+):
+    "Counts the batches of the current instrumented call, and the tokens in them with and without padding"
+    stats = _current_call.get()
+    if stats is None: return
+    for mask in attention_masks:
+        stats.add_count('batches', 1)
+        stats.add_count('real_tokens', int(mask.sum()))
+        stats.add_count('padded_tokens', mask.numel())
\ No newline at end of file
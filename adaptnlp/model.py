@@ -1,11 +1,22 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/03_model.ipynb (unless otherwise specified).
 
-__all__ = ['CudaCallback', 'AdaptiveModel']
+__all__ = ['InferenceEngine', 'token_budget_batches', 'PadCollate', 'logger', 'QUANTIZED_WEIGHTS_NAME',
+           'quantize_dynamic_int8', 'is_quantized', 'quantization_report', 'load_quantized', 'load_pretrained_model',
+           'run_sharded', 'close_shard_pools', 'run_pipelined', 'CudaCallback', 'AdaptiveModel']
 
 # Cell
-from typing import Union, List
+import logging, os, atexit
+from typing import Union, List, Iterable, Iterator
 from pathlib import Path
 from abc import ABC, abstractmethod
+from operator import attrgetter
+from threading import Lock, Thread, Event
+from queue import Queue, Empty, Full
+from itertools import repeat
+from contextvars import copy_context
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from flair.data import Sentence
 
@@ -13,19 +24,23 @@ import torch
 from torch import nn
 from torch.utils.data import TensorDataset, DataLoader
 
-from fastcore.basics import noop, store_attr, patch, first, ifnone
+from fastcore.basics import noop, store_attr, patch, first, ifnone, listify, mk_class, chunked
 from fastcore.meta import delegates
 
-from fastai.callback.core import Callback, GatherPredsCallback
+from fastai.callback.core import Callback, GatherPredsCallback, CancelBatchException
 from fastai.callback.progress import ProgressCallback
 
 from fastai.learner import Learner
 from fastai.data.core import DataLoaders
 
-from fastai.torch_core import to_device, default_device
+from fastai.torch_core import to_device, to_detach, default_device
+
+from transformers import PreTrainedTokenizer, AutoConfig
 
 from .callback import GatherInputsCallback, SetInputsCallback
 
+#nbdev_comment _all_ = ['InferenceEngine']
+
 # Cell
 @patch
 def one_batch(
@@ -44,6 +59,245 @@ def after_validate(
     "Patched functionality that does nothing"
     pass
 
+# Cell
+def token_budget_batches(
+    order:List[int], # Indices of the items in the order they should be batched, usually sorted longest first
+    lengths:List[int], # The number of tokens in every item
+    max_tokens:int, # The maximum number of tokens in a batch, including padding
+    max_batch_size:int=None # An optional maximum number of items in a batch
+) -> List[List[int]]: # The indices of the items in each batch
+    "Greedily groups `order` into batches whose size times their longest member stays within `max_tokens`"
+    batches, batch, batch_len = [], [], 0
+    for idx in order:
+        new_len = max(batch_len, lengths[idx])
+        if batch and (new_len * (len(batch)+1) > max_tokens or len(batch) == max_batch_size):
+            batches.append(batch)
+            batch, new_len = [], lengths[idx]
+        batch.append(idx)
+        batch_len = new_len
+    if batch: batches.append(batch)
+    return batches
+
+# Cell
+class PadCollate:
+    "Collates tokenized items into a tuple of tensors padded only to the longest item in the batch"
+    def __init__(
+        self,
+        tokenizer:PreTrainedTokenizer, # The tokenizer the items were encoded with
+        keys:List[str]=['input_ids', 'attention_mask'] # Which encoded values to return, in order
+    ): store_attr()
+
+    def __call__(
+        self,
+        items:List[dict] # Tokenized items, such as a slice of `BatchEncoding` values
+    ) -> tuple: # A tuple of padded tensors for each key
+        batch = self.tokenizer.pad([{k:item[k] for k in self.keys} for item in items], return_tensors='pt')
+        return tuple(batch[k] for k in self.keys)
+
+# Cell
+logger = logging.getLogger(__name__)
+
+# Cell
+QUANTIZED_WEIGHTS_NAME = 'pytorch_model_dynamic_int8.bin'
+
+_QUANTIZATION_SAMPLE = [
+    "This didn't work at all",
+    "The movie was long, but I would happily watch all of it again.",
+    "What is the capital city of France?",
+    "George Washington went to Washington to meet the president of Microsoft.",
+    "The stock market fell sharply on Monday after the central bank raised interest rates.",
+    "Please send me the report by the end of the week.",
+    "She has lived in Berlin for ten years and still loves the city.",
+    "The new phone has a great camera, but the battery drains too quickly.",
+]
+
+# Cell
+def quantize_dynamic_int8(
+    model:nn.Module # A PyTorch model
+) -> nn.Module: # A copy of `model` whose `nn.Linear` layers run in int8 on the CPU
+    "Dynamically quantizes the `nn.Linear` layers of `model` to int8"
+    return torch.quantization.quantize_dynamic(model.cpu().eval(), {nn.Linear}, dtype=torch.qint8)
+
+# Cell
+def is_quantized(
+    model:nn.Module # A PyTorch model
+) -> bool:
+    "Whether `model` has any dynamically quantized `nn.Linear` layers"
+    return any(isinstance(m, torch.nn.quantized.dynamic.Linear) for m in model.modules())
+
+# Cell
+def quantization_report(
+    model:nn.Module, # The original model
+    quantized:nn.Module, # `model` after quantization
+    tokenizer:PreTrainedTokenizer, # The tokenizer of `model`
+    sample:List[str] # Held-out texts to compare the predictions of both models on
+) -> dict: # The number of `samples`, the prediction `agreement`, `max_accuracy_delta`, and `max_logit_delta`
+    """
+    Compares the top predictions of `quantized` against `model` on `sample`.
+
+    `agreement` is the fraction of predictions (per text, per token, or per answer span boundary, depending on the head)
+    that are the same for both models, so the accuracy of `quantized` can differ from `model` by at most `max_accuracy_delta`
+    """
+    matches, deltas = [], []
+    with torch.no_grad():
+        for text in sample:
+            enc = tokenizer(text, truncation=True, return_tensors='pt')
+            inputs = {'input_ids':enc['input_ids'], 'attention_mask':enc['attention_mask']}
+            # Score the next token predictions of the decoder on the text itself
+            if getattr(model.config, 'is_encoder_decoder', False): inputs['decoder_input_ids'] = enc['input_ids']
+            out, q_out = model(**inputs), quantized(**inputs)
+            for key in ('logits', 'start_logits', 'end_logits'):
+                if out.get(key) is None: continue
+                matches.append((out[key].argmax(-1) == q_out[key].argmax(-1)).flatten().float())
+                deltas.append((out[key] - q_out[key]).abs().max().item())
+    agreement = torch.cat(matches).mean().item()
+    return {'samples':len(sample), 'agreement':agreement, 'max_accuracy_delta':1-agreement, 'max_logit_delta':max(deltas)}
+
+# Cell
+def load_quantized(
+    auto_cls, # A transformers `AutoModel` class, such as `AutoModelForSequenceClassification`
+    path:Union[str, Path] # A directory saved with `AdaptiveModel.save_quantized`
+) -> nn.Module: # The quantized model
+    "Rebuilds a quantized model from the config and int8 weights in `path`, without quantizing any weights again"
+    model = quantize_dynamic_int8(auto_cls.from_config(AutoConfig.from_pretrained(path)))
+    model.load_state_dict(torch.load(Path(path)/QUANTIZED_WEIGHTS_NAME, map_location='cpu'))
+    return model.eval()
+
+# Cell
+def load_pretrained_model(
+    auto_cls, # A transformers `AutoModel` class, such as `AutoModelForSequenceClassification`
+    model_name_or_path:Union[str, Path] # A model key on the HuggingFace Hub, or a local directory
+) -> nn.Module:
+    "Loads `model_name_or_path` with `auto_cls`, or with `load_quantized` if it was saved with `AdaptiveModel.save_quantized`"
+    if (Path(model_name_or_path)/QUANTIZED_WEIGHTS_NAME).exists():
+        return load_quantized(auto_cls, model_name_or_path)
+    return auto_cls.from_pretrained(model_name_or_path)
+
+# Internal Cell
+_shard_worker = {}
+
+def _init_shard_worker(easy_cls, num_threads):
+    "Limits the threads of a worker process and creates the one Easy module it keeps its loaded models in"
+    torch.set_num_threads(num_threads)
+    _shard_worker['easy'] = easy_cls()
+
+def _run_shard(method, args, kwargs):
+    "Runs `method` of the worker's Easy module on one shard"
+    return getattr(_shard_worker['easy'], method)(*args, **kwargs)
+
+_shard_pools, _shard_pools_lock = {}, Lock()
+
+def _shard_pool(easy_cls, num_workers, threads_per_worker):
+    "The pool of workers running `easy_cls` with these settings, started on first use and kept for later calls"
+    key = (easy_cls, num_workers, threads_per_worker)
+    with _shard_pools_lock:
+        if key not in _shard_pools:
+            _shard_pools[key] = ProcessPoolExecutor(num_workers, mp_context=get_context('spawn'), initializer=_init_shard_worker,
+                                                    initargs=(easy_cls, threads_per_worker))
+        return _shard_pools[key]
+
+# Cell
+def run_sharded(
+    easy_cls, # An Easy module class, such as `EasySequenceClassifier`, created once in every worker
+    method:str, # The name of the method of `easy_cls` to run on every shard
+    shards:List[tuple], # The positional arguments of `method` for every shard
+    num_workers:int=4, # The number of worker processes
+    threads_per_worker:int=None, # The number of PyTorch threads in each worker. Defaults to splitting the cores evenly between the workers
+    **kwargs # Keyword arguments passed to `method` for every shard
+) -> list: # The output of `method` for every shard, in the order of `shards`
+    """
+    Runs `method` of `easy_cls` on every shard in a pool of `num_workers` processes.
+
+    Every worker creates its own `easy_cls`, so each model is loaded once per worker and reused for all the shards it runs.
+    The pool is kept for later calls with the same `easy_cls` and worker settings, so those models stay loaded until
+    `close_shard_pools` or the end of the process. Workers are spawned rather than forked, so scripts calling this need
+    an `if __name__ == '__main__':` guard
+    """
+    num_workers = max(num_workers, 1)
+    threads_per_worker = ifnone(threads_per_worker, max(os.cpu_count() // num_workers, 1))
+    key = (easy_cls, num_workers, threads_per_worker)
+    pool = _shard_pool(*key)
+    try: return list(pool.map(_run_shard, repeat(method), shards, repeat(kwargs)))
+    except BrokenProcessPool:
+        # A worker died and the pool can't be used anymore, so the next call starts a new one
+        with _shard_pools_lock:
+            if _shard_pools.get(key) is pool: del _shard_pools[key]
+        raise
+
+# Cell
+def close_shard_pools():
+    "Shuts down the worker processes kept by `run_sharded`, along with the models loaded in them"
+    with _shard_pools_lock:
+        pools = list(_shard_pools.values())
+        _shard_pools.clear()
+    for pool in pools: pool.shutdown()
+
+atexit.register(close_shard_pools)
+
+# Internal Cell
+_PIPELINE_END = object()
+
+class _PipelineError:
+    "Carries an exception raised in a stage of `run_pipelined` downstream to the caller"
+    def __init__(self, exc): self.exc = exc
+
+def _put(q, item, stop):
+    "Puts `item` on `q`, giving up if the pipeline is stopped while waiting for room"
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except Full: pass
+    return False
+
+def _drain(q, stop):
+    "Yields the items of `q` until the end of the pipeline, re-raising the exception of any failed stage"
+    while not stop.is_set():
+        try: item = q.get(timeout=0.1)
+        except Empty: continue
+        if item is _PIPELINE_END: return
+        if isinstance(item, _PipelineError): raise item.exc
+        yield item
+
+def _run_stage(stage, inputs, out, stop):
+    "Puts `stage` of every item of `inputs` on `out`, followed by the end of the pipeline or the exception it failed with"
+    try:
+        for item in inputs:
+            if not _put(out, stage(item), stop): return
+        _put(out, _PIPELINE_END, stop)
+    except BaseException as e: _put(out, _PipelineError(e), stop)
+
+# Cell
+def run_pipelined(
+    items:Iterable, # The inputs of the first stage, such as chunks of texts
+    *stages, # Functions run on each item in order, each taking the output of the one before it
+    maxsize:int=2 # The number of outputs each stage may get ahead of the next one by
+) -> Iterator: # A generator yielding the output of the last stage for every item, in the order of `items`
+    """
+    Runs every item of `items` through `stages`, overlapping the stages of different items.
+
+    Every stage but the last runs in its own background thread, the last one runs in the calling thread. An exception
+    raised in any stage stops the pipeline and is re-raised to the caller. A list of fewer than two items runs without
+    any threads
+    """
+    if len(stages) < 2 or (isinstance(items, list) and len(items) < 2):
+        for item in items:
+            for stage in stages: item = stage(item)
+            yield item
+        return
+    stop, inputs, threads = Event(), iter(items), []
+    for stage in stages[:-1]:
+        out = Queue(maxsize)
+        # Each thread runs in a copy of the caller's context, so stages count towards its `instrumented_call`
+        threads.append(Thread(target=copy_context().run, args=(_run_stage, stage, inputs, out, stop), daemon=True))
+        inputs = _drain(out, stop)
+    for t in threads: t.start()
+    try:
+        for item in inputs: yield stages[-1](item)
+    finally:
+        stop.set()
+        for t in threads: t.join()
+
 # Cell
 class CudaCallback(Callback):
     "Move data to CUDA device"
@@ -76,13 +330,12 @@ class _BaseLearner:
       - `lr_find`, `fit_one_cycle`, `fit_flat_cos`, `fit_sgdr`, `fit` (not implemented)
       - `metrics`, `opt_func`, `splitter`, `wd`, `moms` (not implemented)
     """
-    __cbs = [SetInputsCallback(), GatherInputsCallback()]
-
     def __init__(self, device='cuda' if torch.cuda.is_available() else 'cpu') -> None:
         """
         Generates blank `Learner` and stores it away privately.
         """
-        self.__cbs.append(CudaCallback(device))
+        # Callbacks hold a reference to their `Learner`, so each `_BaseLearner` needs its own
+        self.__cbs = [SetInputsCallback(), GatherInputsCallback(), CudaCallback(device)]
         self.__learner = Learner(self._generate_dls(), _NoopModel(), loss_func=noop, cbs=self.__cbs)
         self.__default_dls, self.__default_model = True, True
 
@@ -118,7 +371,7 @@ class _BaseLearner:
     def set_device(self, device:str='cpu'):
         if device != 'cpu' and device != 'cuda':
             raise ValueError("Device must either be `cpu` or `cuda`")
-        self.__learn.__cbs[-1].device = device
+        self.__cbs[-1].device = device
 
     def set_as_dict(self, as_dict:bool=False):
         """
@@ -135,9 +388,81 @@ class _BaseLearner:
         """
         self.__learner.model = model
 
+# Internal Cell
+class _FastLearner:
+    """
+    Lean stand-in for `_BaseLearner` that can only run inference.
+
+    Runs the batch-level events (`before_batch`, `after_pred`, `after_cancel_batch`, and `after_batch`)
+    of the default and passed `Callbacks` in a plain `torch.no_grad` loop, skipping the `Learner`
+    overhead of the progress, recorder, and training callbacks. Returns the same outputs as `_BaseLearner.get_preds`.
+
+    If `forward` is passed, the batches are run through it instead of `model`, which is still what the `Callbacks` see as `learn.model`
+    """
+    training = False
+
+    def __init__(self, model, as_dict:bool=False, device=None, forward=None):
+        self.model = model
+        self.forward = ifnone(forward, model)
+        self.__cuda = CudaCallback(device)
+        self.__cbs = [SetInputsCallback(as_dict), GatherInputsCallback(), self.__cuda]
+
+    def _call(self, cbs, event_name):
+        for cb in cbs: cb(event_name)
+
+    def get_preds(self, dl=None, cbs=[]):
+        """
+        Get raw predictions based on `dl` with `cbs`.
+
+        For basic inference, `cbs` should include any `Callbacks` needed to do general inference
+        """
+        if dl is None: raise ValueError("`dl` should not be `None`")
+        cbs = sorted(self.__cbs + listify(cbs), key=attrgetter('order'))
+        for cb in cbs: cb.learn = self
+        preds, targets = [], []
+        # Only `before_batch` runs per batch, so the model is moved once here, as `CudaCallback.before_fit` does for the `Learner`
+        self.model.to(self.__cuda.device)
+        self.model.eval()
+        with torch.no_grad():
+            for b in dl:
+                # Every item in the batch is an input, same as `GatherInputsCallback.before_validate`
+                self.xb, self.yb = tuple(b), tuple()
+                try:
+                    self._call(cbs, 'before_batch')
+                    self.pred = self.forward(*self.xb)
+                    self._call(cbs, 'after_pred')
+                except CancelBatchException: self._call(cbs, 'after_cancel_batch')
+                finally: self._call(cbs, 'after_batch')
+                if hasattr(self, 'pred'):
+                    preds.append(to_detach(self.pred))
+                    targets.append(self.yb)
+        return preds, targets
+
+# Cell
+mk_class('InferenceEngine', **{o:o.lower() for o in 'Learner,Fast'.split(',')},
+         doc="All possible engines an `AdaptiveModel` can run inference with, with typo-proofing")
+
 # Cell
 class AdaptiveModel(ABC):
-    _learn = _BaseLearner()
+    """
+    Base class for all inference models.
+
+    Each instance owns its own `_BaseLearner`, so different models never share state. Calls to `get_preds` on the
+    same model from multiple threads are serialized for the `Learner` engine, while the `Fast` engine keeps its
+    state per call and runs them concurrently
+    """
+    engine = InferenceEngine.Learner
+    backend = None
+    # `predict` tokenizes, runs, and decodes this many mini batches at a time with `run_pipelined`
+    pipeline_batches = 8
+    quantization_report = None
+    _as_dict = False
+    _device = None
+
+    def __init__(self):
+        self._learn = _BaseLearner()
+        self._learn_lock = Lock()
+
     def set_model(
         self,
         model # A PyTorch model
@@ -145,6 +470,8 @@ class AdaptiveModel(ABC):
         "Sets model in `_learn`"
         self._learn.set_model(model)
         self.model = model
+        # Quantized `nn.Linear` layers only run on the CPU
+        if is_quantized(model): self.set_device('cpu')
 
     def set_as_dict(
         self,
@@ -152,6 +479,7 @@ class AdaptiveModel(ABC):
     ):
         "Sets `as_dict` in `_learn`"
         self._learn.set_as_dict(as_dict)
+        self._as_dict = as_dict
 
     def set_device(
         self,
@@ -159,7 +487,29 @@ class AdaptiveModel(ABC):
     ):
         "Sets the device for `CudaCallback` in `__learn`"
         self._learn.set_device(device)
+        self._device = device
+
+    def set_engine(
+        self,
+        engine:InferenceEngine=InferenceEngine.Learner # An `InferenceEngine` to run `get_preds` with, such as 'learner' or 'fast'
+    ):
+        "Sets the engine `get_preds` runs inference with for this model"
+        if engine not in (InferenceEngine.Learner, InferenceEngine.Fast):
+            raise ValueError(f"`{engine}` is not a valid engine. Choose one from `InferenceEngine`")
+        self.engine = engine
+
+    def set_backend(
+        self,
+        backend=None # A callable run on each batch instead of the PyTorch model, such as an `OnnxBackend`. `None` goes back to the PyTorch model
+    ):
+        """
+        Sets a backend for `get_preds` to run the forward pass of the model with.
 
+        A backend takes the same inputs as the model and returns a dictionary of its outputs. Backends only run with the `Fast` engine,
+        so setting one also switches to it
+        """
+        self.backend = backend
+        if backend is not None: self.set_engine(InferenceEngine.Fast)
 
     def get_preds(
         self,
@@ -171,7 +521,11 @@ class AdaptiveModel(ABC):
 
         For basic inference, `cbs` should include any `Callbacks` needed to do general inference
         """
-        return self._learn.get_preds(dl=dl, cbs=cbs)
+        if self.engine == InferenceEngine.Fast:
+            return _FastLearner(self.model, self._as_dict, self._device, self.backend).get_preds(dl=dl, cbs=cbs)
+        # A `Learner` stores the current batch on itself, so only one thread may use it at a time
+        with self._learn_lock:
+            return self._learn.get_preds(dl=dl, cbs=cbs)
 
     @abstractmethod
     def load(
@@ -189,4 +543,52 @@ class AdaptiveModel(ABC):
         **kwargs,
     ) -> List[Sentence]: # A list of predicted sentences
         "Run inference on the model"
-        raise NotImplementedError("Please Implement this method")
\ No newline at end of file
+        raise NotImplementedError("Please Implement this method")
+
+    def predict_iter(
+        self,
+        text: Iterable[Union[Sentence, str]], # An iterable of texts to predict on, such as a generator reading a file
+        mini_batch_size: int = 32, # The number of texts pulled from `text` and predicted on at a time
+        **kwargs, # Keyword arguments passed to `predict`
+    ) -> Iterator: # A generator yielding the output of `predict` for each mini batch
+        """
+        Lazily run `predict` over `text` one mini batch at a time.
+
+        Only `mini_batch_size` texts are tokenized and held in memory at once, and the results of each batch are
+        yielded as soon as they are ready, in the order of `text`
+        """
+        if isinstance(text, (str, Sentence)): text = [text]
+        for batch in chunked(text, mini_batch_size):
+            yield self.predict(batch, mini_batch_size=mini_batch_size, **kwargs)
+
+    def quantize(
+        self,
+        method:str='dynamic-int8', # How to quantize the model, only 'dynamic-int8' is supported
+        sample:List[str]=None # Held-out texts to compare the predictions of the original and quantized model on
+    ):
+        """
+        Quantizes the `nn.Linear` layers of the model for CPU inference.
+
+        How the predictions of the quantized model compare to the original ones on `sample` is logged and stored in `quantization_report`
+        """
+        if method != 'dynamic-int8':
+            raise ValueError(f"`{method}` is not a valid quantization method. Only 'dynamic-int8' is supported")
+        if is_quantized(self.model): return
+        quantized = quantize_dynamic_int8(self.model)
+        self.quantization_report = quantization_report(self.model, quantized, self.tokenizer, ifnone(sample, _QUANTIZATION_SAMPLE))
+        logger.info(f'Quantized model agrees with the original on {self.quantization_report["agreement"]:.2%} of predictions '
+                    f'over {self.quantization_report["samples"]} sample texts')
+        self.set_model(quantized)
+        if hasattr(self, 'device'): self.device = torch.device('cpu')
+
+    def save_quantized(
+        self,
+        path:Union[str, Path] # A directory to save the model, its config, and its tokenizer in
+    ):
+        "Saves a quantized model so `load` can reload it from `path` without quantizing it again"
+        if not is_quantized(self.model): raise ValueError("The model is not quantized, call `quantize` first")
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        self.model.config.save_pretrained(path)
+        self.tokenizer.save_pretrained(path)
+        torch.save(self.model.state_dict(), path/QUANTIZED_WEIGHTS_NAME)
\ No newline at end of file
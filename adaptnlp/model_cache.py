@@ -0,0 +1,253 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/21_model_cache.ipynb (unless otherwise specified).
+
+__all__ = ['logger', 'model_nbytes', 'ModelCache', 'shared_model_cache', 'CachedModels']
+
+# Cell
+import logging, os, time
+from collections import OrderedDict
+from threading import Lock, RLock
+from typing import Callable, Hashable, Iterator
+
+import torch
+from torch import nn
+
+# Cell
+logger = logging.getLogger(__name__)
+
+# Internal Cell
+# Where the inference models keep their network: `AdaptiveModel`s in `model`, `FlairTokenTagger` in `tagger`,
+# and `FlairSequenceClassifier` in `classifier`
+_MODULE_ATTRS = ['model', 'tagger', 'classifier']
+
+def _tensors(o):
+    "All the tensors in `o`, a state dict value that may be a tuple of them like the packed parameters of a quantized layer"
+    if isinstance(o, torch.Tensor): yield o
+    elif isinstance(o, (tuple, list)):
+        for x in o: yield from _tensors(x)
+
+# Cell
+def model_nbytes(
+    model # An `nn.Module`, or an object holding one in `model`, `tagger`, or `classifier`, such as an `AdaptiveModel`
+) -> int: # The bytes taken by the parameters and buffers of `model`
+    "Counts the bytes of every tensor in the state dict of `model`, once for tensors shared between layers"
+    if isinstance(model, nn.Module): module = model
+    else: module = next((o for o in (getattr(model, attr, None) for attr in _MODULE_ATTRS) if isinstance(o, nn.Module)), None)
+    if module is None: return 0
+    seen, total = set(), 0
+    for value in module.state_dict(keep_vars=True).values():
+        for t in _tensors(value):
+            if t.data_ptr() in seen: continue
+            seen.add(t.data_ptr())
+            total += t.numel() * t.element_size()
+    return total
+
+# Internal Cell
+class _CacheEntry:
+    "A cached model with its size and the last time it was used"
+    def __init__(self, model, nbytes):
+        self.model, self.nbytes, self.last_used = model, nbytes, time.monotonic()
+
+# Cell
+class ModelCache:
+    """
+    A thread-safe cache of loaded models, bounded by the bytes they take and how long they may go unused.
+
+    Models are kept in the order they were last used, and the least recently used are evicted first
+    """
+    def __init__(
+        self,
+        max_bytes:int=None, # The bytes the cached models may take, unbounded if `None`
+        idle_timeout:float=None, # The seconds a model may go unused before being evicted, never if `None`
+    ):
+        self.max_bytes, self.idle_timeout = max_bytes, idle_timeout
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._lock = RLock()
+        self.hits = self.misses = self.evictions = 0
+
+    def configure(
+        self,
+        max_bytes:int=None, # The bytes the cached models may take, unbounded if `None`
+        idle_timeout:float=None, # The seconds a model may go unused before being evicted, never if `None`
+    ):
+        "Sets the bounds of the cache, evicting the models that are now out of them"
+        with self._lock:
+            self.max_bytes, self.idle_timeout = max_bytes, idle_timeout
+            self._evict()
+
+    @property
+    def nbytes(self) -> int:
+        "The bytes taken by the cached models"
+        with self._lock: return sum(e.nbytes for e in self._entries.values())
+
+    def __len__(self): return len(self._entries)
+    def __contains__(self, key): return key in self._entries
+    def keys(self):
+        "The keys of the cached models, from the least to the most recently used"
+        with self._lock: return list(self._entries)
+
+    def get(
+        self,
+        key:Hashable, # The key of a model
+        default=None # What to return if `key` isn't cached
+    ):
+        "Gets the model of `key` and marks it as used, without counting towards the hits and misses"
+        with self._lock:
+            self._evict_idle()
+            if key not in self._entries: return default
+            return self._touch(key).model
+
+    def get_or_load(
+        self,
+        key:Hashable, # The key of a model, such as its task and name
+        load:Callable # Loads the model when it isn't cached, a returned `None` isn't cached
+    ):
+        "Gets the model of `key`, loading and caching it with `load` if needed. Concurrent calls for the same `key` only load it once"
+        with self._lock:
+            self._evict_idle()
+            if key in self._entries:
+                self.hits += 1
+                return self._touch(key).model
+            key_lock = self._loading.setdefault(key, Lock())
+        # Other models stay available while this one loads
+        with key_lock:
+            with self._lock:
+                if key in self._entries:
+                    self.hits += 1
+                    return self._touch(key).model
+                self.misses += 1
+            try:
+                model = load()
+                if model is not None: self.put(key, model)
+            finally:
+                with self._lock: self._loading.pop(key, None)
+        return model
+
+    def put(
+        self,
+        key:Hashable, # The key of the model
+        model # The model to cache
+    ):
+        "Caches `model` under `key` as the most recently used model, evicting others until it fits in `max_bytes`"
+        nbytes = model_nbytes(model)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = _CacheEntry(model, nbytes)
+            if self.max_bytes is not None and nbytes > self.max_bytes:
+                logger.warning(f'{key} takes {nbytes} bytes, more than the {self.max_bytes} bytes of the model cache')
+            self._evict()
+
+    def pop(
+        self,
+        key:Hashable, # The key of a model
+        default=None # What to return if `key` isn't cached
+    ):
+        "Removes the model of `key` from the cache and returns it"
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return default if entry is None else entry.model
+
+    def clear(self):
+        "Removes every model, and resets the counters"
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+        self._free()
+
+    def stats(self) -> dict:
+        "The number of hits, misses, and evictions, along with the models that are cached and the bytes they take"
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'models': len(self._entries),
+                'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+            }
+
+    def _touch(self, key):
+        "Marks the model of `key` as the most recently used"
+        entry = self._entries[key]
+        entry.last_used = time.monotonic()
+        self._entries.move_to_end(key)
+        return entry
+
+    def _evict_idle(self):
+        "Evicts the models that went unused for longer than `idle_timeout`"
+        if self.idle_timeout is None: return
+        now = time.monotonic()
+        idle = [k for k,e in self._entries.items() if now - e.last_used > self.idle_timeout]
+        for key in idle: self._evict_one(key, 'idle')
+        if idle: self._free()
+
+    def _evict(self):
+        "Evicts idle models, then the least recently used until the rest fit in `max_bytes`, always keeping the most recent one"
+        self._evict_idle()
+        if self.max_bytes is None: return
+        nbytes, evicted = self.nbytes, False
+        while nbytes > self.max_bytes and len(self._entries) > 1:
+            key = next(iter(self._entries))
+            nbytes -= self._entries[key].nbytes
+            self._evict_one(key, 'over the memory budget')
+            evicted = True
+        if evicted: self._free()
+
+    def _evict_one(self, key, reason):
+        del self._entries[key]
+        self.evictions += 1
+        logger.info(f'Evicted {key} from the model cache, {reason}')
+
+    def _free(self):
+        "Returns the memory of evicted models on the GPU to the device"
+        if torch.cuda.is_available(): torch.cuda.empty_cache()
+
+# Internal Cell
+def _env_number(name, cast):
+    "The value of the environment variable `name` as `cast`, or `None` when it isn't set"
+    value = os.environ.get(name)
+    return None if value in (None, '') else cast(value)
+
+# Cell
+shared_model_cache = ModelCache(
+    max_bytes=_env_number('ADAPTNLP_MODEL_CACHE_MAX_BYTES', int),
+    idle_timeout=_env_number('ADAPTNLP_MODEL_CACHE_IDLE_TIMEOUT', float),
+)
+
+# Cell
+class CachedModels:
+    "The models of `task` in a `ModelCache` that were loaded or used through this view"
+    def __init__(
+        self,
+        task:str, # The task the models are cached under, such as 'token_classification'
+        cache:ModelCache=None # The cache to use, `shared_model_cache` by default
+    ):
+        self.task, self.cache = task, cache if cache is not None else shared_model_cache
+        self._names = OrderedDict()
+
+    def get_or_load(
+        self,
+        name:str, # The name of a model
+        load:Callable # Loads the model when it isn't cached, a returned `None` isn't cached
+    ):
+        "Gets the model of `name`, loading and caching it with `load` if needed"
+        model = self.cache.get_or_load((self.task, name), load)
+        if model is not None: self._names[name] = None
+        return model
+
+    def __getitem__(self, name):
+        return self.cache.get((self.task, name), False)
+
+    def __setitem__(self, name, model):
+        self.cache.put((self.task, name), model)
+        self._names[name] = None
+
+    def __delitem__(self, name):
+        self.cache.pop((self.task, name))
+        self._names.pop(name, None)
+
+    def __contains__(self, name): return (self.task, name) in self.cache
+    def keys(self) -> list: return [name for name in self._names if (self.task, name) in self.cache]
+    def __iter__(self) -> Iterator: return iter(self.keys())
+    def __len__(self): return len(self.keys())
+    def __repr__(self): return f'{type(self).__name__}({self.task!r}, {self.keys()})'
\ No newline at end of file
@@ -1,16 +1,27 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/02_model_hub.ipynb (unless otherwise specified).
 
-__all__ = ['HF_TASKS', 'FLAIR_TASKS', 'HFModelResult', 'HFModelHub', 'FLAIR_MODELS', 'FlairModelResult',
-           'FlairModelHub']
+__all__ = ['logger', 'HF_TASKS', 'FLAIR_TASKS', 'HFModelResult', 'HubIndex', 'hub_index', 'HFModelHub', 'FLAIR_MODELS',
+           'FlairModelResult', 'FlairModelHub']
 
 # Cell
-from fastcore.basics import Self, merge
+import json, logging, os, tempfile, time
+from collections import defaultdict
+from pathlib import Path
+from threading import Lock, Thread
+from types import SimpleNamespace
+
+from fastcore.basics import Self, merge, ifnone
 from fastcore.utils import dict2obj, obj2dict, mk_class
 from fastai.torch_core import apply
 from huggingface_hub.hf_api import ModelInfo, HfApi
 
 from typing import List, Dict
 
+from adaptnlp import cache_root
+
+# Cell
+logger = logging.getLogger(__name__)
+
 # Internal Cell
 _hf_tasks = {
     'FILL_MASK':'fill-mask',
@@ -95,6 +106,167 @@ class HFModelResult:
         "Returns `HFModelResult` as a dictionary"
         return {'model_name':self.name, 'tags':self.tags, 'tasks':self.tasks, 'model_info':self.info}
 
+# Internal Cell
+def _trigrams(s:str) -> set:
+    "Every substring of three characters of `s`"
+    return {s[i:i+3] for i in range(len(s)-2)}
+
+# Cell
+class HubIndex:
+    "An index of the metadata of every model on the HuggingFace hub, persisted to `path` and refreshed in the background once older than `ttl`"
+    def __init__(
+        self,
+        path:Path=None, # The file to save the index to, `adaptnlp.cache_root/'hub_index.json'` by default
+        ttl:float=24*60*60, # The seconds after which the index is refreshed
+        api:HfApi=None, # The `HfApi` to list the models with
+        retry_after:float=5*60, # The seconds to wait before trying to refresh again after a failed refresh
+    ):
+        self.path = Path(ifnone(path, cache_root/'hub_index.json'))
+        self.ttl, self.retry_after = ttl, retry_after
+        self.api = ifnone(api, HfApi())
+        self.fetched = None
+        self._state = None
+        self._lock, self._refresh_lock = Lock(), Lock()
+        self._retry_at = 0.
+        self._thread = None
+        self._queries = {}
+
+    @property
+    def models(self) -> List[ModelInfo]:
+        "Every model in the index"
+        self._ensure_fresh()
+        return self._state.models
+
+    def with_tag(
+        self,
+        tag:str # A tag, or task, such as 'flair' or 'summarization'
+    ) -> List[ModelInfo]:
+        "The models tagged with `tag`, or whose task is `tag`, in the order of the hub"
+        self._ensure_fresh()
+        if self.fetched is None: return self._query(filter=tag)
+        return self._state.by_tag.get(tag, [])
+
+    def search(
+        self,
+        name:str, # A part of the model ids to look for
+        tag:str=None, # Only return models tagged with `tag`
+        task:str=None, # Also return the models whose task is `task`
+    ) -> List[ModelInfo]:
+        "The models whose id contains `name`, in the order of the hub"
+        self._ensure_fresh()
+        if self.fetched is None: return self._search_hub(name, tag, task)
+        state = self._state
+        among = state.tag_pos.get(tag, []) if tag is not None else None
+        # Only the ids sharing every trigram of `name` can contain it, the rest are never looked at
+        postings = [state.grams.get(gram, []) for gram in _trigrams(name)]
+        if among is not None: postings.append(among)
+        if postings:
+            postings.sort(key=len)
+            found = set(postings[0])
+            for pos in postings[1:]:
+                if not found: break
+                found.intersection_update(pos)
+        else: found = range(len(state.models))
+        found = {i for i in found if name in state.models[i].modelId}
+        if task is not None:
+            with_task = state.task_pos.get(task, [])
+            found.update(with_task if among is None else set(with_task).intersection(among))
+        return [state.models[i] for i in sorted(found)]
+
+    @property
+    def is_stale(self) -> bool:
+        "Whether the index is older than `ttl`, or was never downloaded"
+        return self.fetched is None or time.time() - self.fetched > self.ttl
+
+    def refresh(self) -> bool: # Whether the index could be downloaded
+        "Downloads the metadata of every model on the hub and saves it, keeping the current index if that fails"
+        with self._refresh_lock:
+            try:
+                records = [
+                    {'modelId': m.modelId, 'tags': list(m.tags or []), 'pipeline_tag': m.pipeline_tag}
+                    for m in self.api.list_models()
+                ]
+            except Exception as e:
+                logger.warning(f'Could not download the model list of the HuggingFace hub: {e!r}')
+                self._retry_at = time.time() + self.retry_after
+                return False
+            fetched = time.time()
+            self._set(records, fetched)
+            self._save(records, fetched)
+            self._queries = {}
+            return True
+
+    def _set(self, records, fetched):
+        "Swaps the in-memory index for `records`"
+        models = [ModelInfo(r['modelId'], tags=r['tags'], pipeline_tag=r['pipeline_tag']) for r in records]
+        # Postings are the positions of the models in `models`, so they come out in the order of the hub
+        tag_pos, task_pos, grams = defaultdict(list), defaultdict(list), defaultdict(list)
+        for i, m in enumerate(models):
+            for tag in dict.fromkeys(m.tags + ([m.pipeline_tag] if m.pipeline_tag else [])): tag_pos[tag].append(i)
+            if m.pipeline_tag: task_pos[m.pipeline_tag].append(i)
+            for gram in _trigrams(m.modelId): grams[gram].append(i)
+        state = SimpleNamespace(
+            models=models,
+            by_tag={tag: [models[i] for i in pos] for tag, pos in tag_pos.items()},
+            tag_pos=dict(tag_pos),
+            task_pos=dict(task_pos),
+            grams=dict(grams),
+        )
+        with self._lock:
+            self._state, self.fetched = state, fetched
+
+    def _save(self, records, fetched):
+        "Writes the index to `path` atomically, so readers never see half of it"
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.path.parent, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f: json.dump({'fetched': fetched, 'models': records}, f)
+            os.replace(tmp, self.path)
+        except OSError as e: logger.warning(f'Could not save the hub index to {self.path}: {e!r}')
+
+    def _load(self) -> bool:
+        "Reads the index saved at `path`, if there is a readable one"
+        try:
+            with open(self.path) as f: saved = json.load(f)
+            self._set(saved['models'], saved['fetched'])
+            return True
+        except (OSError, ValueError, KeyError): return False
+
+    def _query(self, **kwargs) -> List[ModelInfo]:
+        "The models the hub lists for `kwargs`, asked for once until the index is downloaded"
+        key = tuple(sorted(kwargs.items()))
+        if key in self._queries: return self._queries[key]
+        if time.time() < self._retry_at: return []
+        try: models = list(self.api.list_models(**kwargs))
+        except Exception as e:
+            logger.warning(f'Could not search the HuggingFace hub: {e!r}')
+            self._retry_at = time.time() + self.retry_after
+            return []
+        self._queries[key] = models
+        return models
+
+    def _search_hub(self, name, tag=None, task=None) -> List[ModelInfo]:
+        "`search` through the hub itself, asking only for the models tagged `tag` or, without one, whose id contains `name`"
+        found = [m for m in (self._query(filter=tag) if tag is not None else self._query(search=name))
+                 if name in m.modelId or (task is not None and m.pipeline_tag == task)]
+        if tag is None and task is not None:
+            ids = {m.modelId for m in found}
+            found += [m for m in self._query(filter=task) if m.pipeline_tag == task and m.modelId not in ids]
+        return found
+
+    def _ensure_fresh(self):
+        "Loads the index on first use, and starts a background refresh once it is stale or was never downloaded"
+        if self._state is None:
+            with self._refresh_lock:
+                if self._state is None and not self._load():
+                    self._set([], None)
+        if self.is_stale and time.time() >= self._retry_at and (self._thread is None or not self._thread.is_alive()):
+            self._thread = Thread(target=self.refresh, daemon=True)
+            self._thread.start()
+
+# Cell
+hub_index = HubIndex()
+
 # Cell
 class HFModelHub:
     "A class for interacting with the HF model hub API, and searching for models by name or task"
@@ -102,9 +274,11 @@ class HFModelHub:
     def __init__(
         self,
         username:str=None, # Your HuggingFace username
-        password:str=None # Your HuggingFace password
+        password:str=None, # Your HuggingFace password
+        index:HubIndex=None # The index to search, `hub_index` by default
     ):
         self.api = HfApi()
+        self.index = ifnone(index, hub_index)
         if username and password:
             self.token = self.api.login(username, password)
         elif username or password:
@@ -117,9 +291,9 @@ class HFModelHub:
         user_uploaded:bool=False # Whether to filter out user-uploaded results
     ) -> (List[HFModelResult], Dict[str, HFModelResult]): # A list of `HFModelResult`s
         "Takes raw HuggingFace API results and makes them easier to read and work with"
-        results = apply(HFModelResult, results)
         if not user_uploaded:
-            results = [r for r in results if '/' not in r.name]
+            results = [r for r in results if '/' not in r.modelId]
+        results = apply(HFModelResult, results)
         if as_dict:
             dicts = apply(Self.to_dict(), results)
             results = {m['model_name'] : m for m in dicts}
@@ -131,13 +305,13 @@ class HFModelHub:
         as_dict:bool=False, # Whether to return as a dictionary or list
         user_uploaded:bool=False # Whether to filter out user-uploaded results
     ) -> (List[HFModelResult], Dict[str, HFModelResult]): # A list of `HFModelResult`s
-        "Searches HuggingFace Model API for all pretrained models relating to `task`"
+        "Searches the hub index for all pretrained models relating to `task`"
         if task not in _hf_tasks.values():
             raise ValueError(f'''`{task}` is not a valid task.
 
             Please choose a valid one available from HuggingFace: (https://huggingface.co/transformers/task_summary.html)
             Or with the `HF_TASKS` object''')
-        models = self.api.list_models(task)
+        models = self.index.with_tag(task)
         return self._format_results(models, as_dict, user_uploaded)
 
     def search_model_by_name(
@@ -146,14 +320,13 @@ class HFModelHub:
         as_dict:bool=False, # Whether to return as a dictionary or list
         user_uploaded:bool=False # Whether to filter out user-uploaded results
     ) -> (List[HFModelResult], Dict[str, HFModelResult]): # A list of `HFModelResult`s
-        "Searches HuggingFace Model API for all pretrained models containing `name`"
+        "Searches the hub index for all pretrained models containing `name`"
         if user_uploaded:
-            models = self.api.list_models()
+            models = self.index.search(name)
             models = self._format_results(models, as_dict, user_uploaded)
-            models = [m for m in models if name in m.name]
 
         else:
-            models = self.api.list_models(name)
+            models = self.index.with_tag(name)
             models = self._format_results(models, as_dict, user_uploaded)
         return models
 
@@ -393,14 +566,20 @@ class FlairModelHub:
     def __init__(
         self,
         username:str=None, # HuggingFace username
-        password:str=None # HuggingFace password
+        password:str=None, # HuggingFace password
+        index:HubIndex=None # The index to search, `hub_index` by default
     ):
         self.api = HfApi()
+        self.index = ifnone(index, hub_index)
         if username and password:
             self.token = self.api.login(username, password)
         elif username or password:
             print('Only a username or password was entered. You should include both to get authorized access')
-        self.models = self.api.list_models('flair') + FLAIR_MODELS
+
+    @property
+    def models(self) -> List[ModelInfo]:
+        "The Flair models in the hub index, followed by `FLAIR_MODELS`"
+        return self.index.with_tag('flair') + FLAIR_MODELS
 
     def _format_results(
         self,
@@ -409,9 +588,9 @@ class FlairModelHub:
         user_uploaded:bool=False # Whether to filter out user-uploaded results
     ) -> (List[FlairModelResult], Dict[str, FlairModelResult]): # A list of `FlairModelResult`s
         "Takes raw HuggingFace API results and makes them easier to read and work with"
-        results = apply(FlairModelResult, results)
         if not user_uploaded:
-            results = [r for r in results if 'flair/' in r.name or 'flairNLP/' in r.name]
+            results = [r for r in results if 'flair/' in r.modelId or 'flairNLP/' in r.modelId]
+        results = apply(FlairModelResult, results)
         if as_dict:
             dicts = apply(Self.to_dict(), results)
             results = {m['model_name'] : m for m in dicts}
@@ -423,8 +602,8 @@ class FlairModelHub:
         as_dict:bool=False, # Whether to return as a dictionary or list
         user_uploaded:bool=False # Whether to filter out user-uploaded results
     ) -> (List[FlairModelResult], Dict[str, FlairModelResult]): # A list of `FlairModelResult`s
-        "Searches HuggingFace Model API for all flair models containing `name`"
-        models = [m for m in self.models if name in m.modelId]
+        "Searches the hub index and `FLAIR_MODELS` for all flair models containing `name`"
+        models = self.index.search(name, tag='flair') + [m for m in FLAIR_MODELS if name in m.modelId]
         return self._format_results(models, as_dict, user_uploaded)
 
     def search_model_by_task(
@@ -433,11 +612,12 @@ class FlairModelHub:
         as_dict=False, # Whether to return as a dictionary or list
         user_uploaded=False # Whether to filter out user-uploaded results
     ) -> (List[FlairModelResult], Dict[str, FlairModelResult]): # A list of `FlairModelResult`s
-        "Searches HuggingFace Model API for all flair models for `task`"
+        "Searches the hub index and `FLAIR_MODELS` for all flair models for `task`"
         if (task not in _flair_tasks.values()) and (task != ''):
             raise ValueError(f'''`{task}` is not a valid task.
 
             Please choose a valid one available from Flair: (https://huggingface.co/flair)
             Or with the `FLAIR_TASKS` object''')
-        models = [m for m in self.models if task in m.modelId or task == m.pipeline_tag]
+        models = self.index.search(task, tag='flair', task=task)
+        models += [m for m in FLAIR_MODELS if task in m.modelId or task == m.pipeline_tag]
         return self._format_results(models, as_dict, user_uploaded)
\ No newline at end of file